@@ -108,5 +108,9 @@ print_warning "Next steps:"
 echo "1. Edit .env file with your actual configuration"
 echo "2. Configure Nginx (see nginx.conf.example)"
 echo "3. Set up Gunicorn service (see gunicorn.service.example)"
+echo "   The WSGI app is the default. Under it a slow geocoding lookup holds a worker thread"
+echo "   until the service answers. The ASGI app avoids that, but runs every other (sync) view"
+echo "   one at a time per worker, so only switch if geocoding waits are the bottleneck:"
+echo "   gunicorn it_support_project.asgi:application -k uvicorn.workers.UvicornWorker"
 echo "4. Set up SSL certificate if needed"
 echo "5. Configure firewall settings"
@@ -120,6 +120,37 @@ EMAIL_HOST_USER = config('EMAIL_HOST_USER', default='')
 EMAIL_HOST_PASSWORD = config('EMAIL_HOST_PASSWORD', default='')
 DEFAULT_FROM_EMAIL = config('DEFAULT_FROM_EMAIL', default='noreply@example.com')
 
+# Outgoing notifications
+# Seconds a worker keeps using its active email templates before looking
+# them up again; the worker that edits a template sees the change at once
+NOTIFICATION_TEMPLATE_LOOKUP_SECONDS = config('NOTIFICATION_TEMPLATE_LOOKUP_SECONDS', default=60, cast=int)
+
+# Incoming email processing
+EMAIL_MAX_MESSAGE_SIZE = config('EMAIL_MAX_MESSAGE_SIZE', default=5 * 1024 * 1024, cast=int)
+EMAIL_LEASE_SECONDS = config('EMAIL_LEASE_SECONDS', default=600, cast=int)
+EMAIL_RETRY_MAX_ATTEMPTS = config('EMAIL_RETRY_MAX_ATTEMPTS', default=5, cast=int)
+# Backoff before retrying a failed email: doubles from the base up to the max
+EMAIL_RETRY_BASE_SECONDS = config('EMAIL_RETRY_BASE_SECONDS', default=300, cast=int)
+EMAIL_RETRY_MAX_SECONDS = config('EMAIL_RETRY_MAX_SECONDS', default=6 * 3600, cast=int)
+EMAIL_BACKLOG_MAX_BATCH_SIZE = config('EMAIL_BACKLOG_MAX_BATCH_SIZE', default=500, cast=int)
+
+# Geocoding
+GEOCODE_CACHE_TTL = config('GEOCODE_CACHE_TTL', default=30 * 24 * 3600, cast=int)
+GEOCODE_NEGATIVE_CACHE_TTL = config('GEOCODE_NEGATIVE_CACHE_TTL', default=24 * 3600, cast=int)
+# Requests per second to the geocoding service, shared by all workers via
+# the cache (Nominatim's usage policy allows 1)
+GEOCODE_RATE_LIMIT = config('GEOCODE_RATE_LIMIT', default=1, cast=float)
+GEOCODE_TIMEOUT = config('GEOCODE_TIMEOUT', default=5, cast=int)
+# CSV of our sites, buildings and cities (name,latitude,longitude[,display_name]),
+# looked up in memory before the remote service
+GEOCODE_GAZETTEER_PATH = config('GEOCODE_GAZETTEER_PATH', default='')
+
+# Ticket assignment
+# Open tickets a technician already working next to a new ticket is credited
+# with when picking the least-loaded one (0 = load only)
+ASSIGNMENT_PROXIMITY_WEIGHT = config('ASSIGNMENT_PROXIMITY_WEIGHT', default=0, cast=float)
+ASSIGNMENT_PROXIMITY_RADIUS_KM = config('ASSIGNMENT_PROXIMITY_RADIUS_KM', default=10, cast=float)
+
 # Security settings
 SECURE_BROWSER_XSS_FILTER = True
 SECURE_CONTENT_TYPE_NOSNIFF = True
@@ -183,6 +214,9 @@ CACHES = {
     }
 }
 
+# Seconds cached page data is kept; changes invalidate it at once
+VIEW_CACHE_TTL = config('VIEW_CACHE_TTL', default=300, cast=int)
+
 # Session configuration
 SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
 SESSION_CACHE_ALIAS = 'default'
@@ -160,6 +160,11 @@ LOGGING = {
             'level': 'INFO',
             'propagate': False,
         },
+        'workorders.email': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
         'django': {
             'handlers': ['console'],
             'level': 'INFO',
@@ -9,8 +9,13 @@ cd /home/greg/it_support_system
 # Activate virtual environment
 source venv/bin/activate
 
-# Run the email processing command
-python manage.py process_emails
+# Run the email processing command; work through any backlog oldest first
+# for up to four minutes across all accounts, leaving a minute for retries
+# and notifications so that runs do not overlap
+python manage.py process_emails --backlog 240
+
+# Deliver queued confirmation emails
+python manage.py send_notifications
 
 # Log the result with timestamp
 echo "$(date): Email processing completed" >> /var/log/it_support_email_processing.log
@@ -1,9 +1,12 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.contrib.auth.models import User
 from django.contrib.auth.admin import UserAdmin
+from django.utils import timezone
 from .models import (
     TaskType, TaskCategory, WorkOrder, WorkOrderComment, 
-    UserProfile, KPIReport, EmailAccount, ProcessedEmail, EmailTemplate
+    UserProfile, KPIReport, EmailAccount, ProcessedEmail, EmailTemplate,
+    OutboundEmail, EmailMessageIndex, EmailProcessingRun, EmailAccountLease, GeocodeCache,
+    POP3SeenMessage
 )
 
 
@@ -122,7 +125,10 @@ class EmailAccountAdmin(admin.ModelAdmin):
             'classes': ('collapse',)
         }),
         ('Ticket Settings', {
-            'fields': ('default_task_type', 'default_task_category', 'default_priority', 'auto_assign_to')
+            'fields': (
+                'default_task_type', 'default_task_category', 'default_priority',
+                'auto_assign_to', 'auto_assign_least_loaded'
+            )
         }),
         ('Statistics', {
             'fields': ('last_processed', 'processed_count', 'created_at', 'updated_at'),
@@ -143,12 +149,13 @@ class ProcessedEmailInline(admin.TabularInline):
 class ProcessedEmailAdmin(admin.ModelAdmin):
     list_display = [
         'subject', 'sender_email', 'sender_name', 'email_account', 
-        'processing_status', 'received_date', 'processed_date', 'work_order'
+        'processing_status', 'attempts', 'next_attempt_at', 'received_date', 'processed_date', 'work_order'
     ]
     list_filter = ['processing_status', 'email_account', 'received_date']
     search_fields = ['subject', 'sender_email', 'sender_name', 'message_id']
-    readonly_fields = ['message_id', 'received_date', 'processed_date']
+    readonly_fields = ['message_id', 'received_date', 'processed_date', 'attempts']
     ordering = ['-received_date']
+    actions = ['requeue']
     
     fieldsets = (
         ('Email Information', {
@@ -157,7 +164,26 @@ class ProcessedEmailAdmin(admin.ModelAdmin):
         ('Processing', {
             'fields': ('processing_status', 'processing_notes', 'processed_date', 'work_order')
         }),
+        ('Retries', {
+            'fields': ('attempts', 'next_attempt_at')
+        }),
     )
+    
+    @admin.action(description='Retry the selected failed emails on the next run')
+    def requeue(self, request, queryset):
+        failed = queryset.filter(processing_status='failed')
+        # Emails that failed before retries existed were not kept
+        requeued = failed.filter(retry_data__has_key='body').update(
+            attempts=0, next_attempt_at=timezone.now()
+        )
+        self.message_user(request, f'{requeued} email(s) will be retried on the next run.')
+        skipped = failed.count() - requeued
+        if skipped:
+            self.message_user(
+                request,
+                f'{skipped} email(s) cannot be retried because their content was not kept.',
+                messages.WARNING
+            )
 
 
 @admin.register(EmailTemplate)
@@ -184,6 +210,60 @@ class EmailTemplateAdmin(admin.ModelAdmin):
     readonly_fields = ['created_at', 'updated_at']
 
 
+@admin.register(OutboundEmail)
+class OutboundEmailAdmin(admin.ModelAdmin):
+    list_display = [
+        'subject', 'recipient', 'work_order', 'status',
+        'attempts', 'next_attempt_at', 'created_at', 'sent_at'
+    ]
+    list_filter = ['status', 'created_at']
+    search_fields = ['subject', 'recipient']
+    readonly_fields = ['attempts', 'last_error', 'created_at', 'sent_at']
+    ordering = ['-created_at']
+
+
+@admin.register(EmailMessageIndex)
+class EmailMessageIndexAdmin(admin.ModelAdmin):
+    list_display = ['message_id', 'work_order', 'direction', 'created_at']
+    list_filter = ['direction']
+    search_fields = ['message_id', 'work_order__ticket_number']
+    raw_id_fields = ['work_order']
+    ordering = ['-created_at']
+
+
+@admin.register(EmailProcessingRun)
+class EmailProcessingRunAdmin(admin.ModelAdmin):
+    list_display = [
+        'email_account', 'started_at', 'duration_seconds', 'fetched_messages',
+        'fetched_bytes', 'created', 'comments', 'duplicates', 'errors', 'dry_run'
+    ]
+    list_filter = ['email_account', 'dry_run', 'started_at']
+    readonly_fields = [field.name for field in EmailProcessingRun._meta.fields]
+    ordering = ['-started_at']
+
+
+@admin.register(EmailAccountLease)
+class EmailAccountLeaseAdmin(admin.ModelAdmin):
+    list_display = ['email_account', 'owner', 'expires_at']
+    readonly_fields = ['email_account', 'owner', 'expires_at']
+
+
+@admin.register(POP3SeenMessage)
+class POP3SeenMessageAdmin(admin.ModelAdmin):
+    list_display = ['email_account', 'uid', 'seen_at', 'error']
+    list_filter = ['email_account']
+    search_fields = ['uid', 'error']
+    readonly_fields = ['email_account', 'uid', 'seen_at', 'error']
+
+
+@admin.register(GeocodeCache)
+class GeocodeCacheAdmin(admin.ModelAdmin):
+    list_display = ['query', 'found', 'latitude', 'longitude', 'expires_at']
+    list_filter = ['found']
+    search_fields = ['query', 'display_name']
+    ordering = ['query']
+
+
 # Re-register UserAdmin
 admin.site.unregister(User)
 admin.site.register(User, CustomUserAdmin)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class WorkordersConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'workorders'
+
+    def ready(self):
+        # Connect notification, assignment and cache invalidation signal handlers
+        from . import assignment, caching, notifications, reference  # noqa: F401
@@ -0,0 +1,195 @@
+"""
+Load-aware assignment of new tickets.
+
+The number of open tickets of each staff member is kept in the Django
+cache. Assigning, unassigning, resolving, reopening and deleting tickets
+adjust it with cache.incr() once the transaction commits, so picking an
+assignee never counts tickets. A count that is not cached, or has
+expired, is recounted with one grouped query on the next read, which
+also heals any drift from bulk updates that bypass the signals.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.signals import m2m_changed, post_save, pre_delete
+from django.dispatch import receiver
+from .models import WorkOrder
+from .reference import get_reference_data
+from .spatial import nearby
+
+
+OPEN_STATUSES = ('open', 'in_progress', 'waiting')
+
+Assignment = WorkOrder.assigned_to.through
+
+
+def get_open_ticket_count_ttl():
+    """Seconds a cached count is trusted before it is recounted"""
+    return getattr(settings, 'ASSIGNMENT_COUNT_TTL', 3600)
+
+
+def get_proximity_weight():
+    """Open tickets a technician working right next to a ticket is credited with; 0 turns it off"""
+    return getattr(settings, 'ASSIGNMENT_PROXIMITY_WEIGHT', 0)
+
+
+def get_proximity_radius_km():
+    """Distance beyond which a technician's open tickets give no proximity credit; 0 turns it off"""
+    return getattr(settings, 'ASSIGNMENT_PROXIMITY_RADIUS_KM', 10)
+
+
+def open_ticket_key(user_id):
+    return f'workorders:open_tickets:{user_id}'
+
+
+def eligible_staff():
+    """Users new tickets may be assigned to"""
+    return get_reference_data().active_staff_users()
+
+
+def get_open_ticket_counts(user_ids):
+    """User id -> number of open tickets assigned to them"""
+    keys = {open_ticket_key(user_id): user_id for user_id in user_ids}
+    counts = {keys[key]: count for key, count in cache.get_many(keys).items()}
+    missing = [user_id for user_id in user_ids if user_id not in counts]
+    if missing:
+        recounted = dict(
+            Assignment.objects.filter(
+                user_id__in=missing, workorder__status__in=OPEN_STATUSES
+            ).values_list('user_id').annotate(Count('id')).order_by()
+        )
+        for user_id in missing:
+            counts[user_id] = recounted.get(user_id, 0)
+            # add() keeps a count another process stored in the meantime, and
+            # that one is used instead. An increment that lands after the
+            # recount query but before add() finds no key and is lost, so the
+            # count can be off by it until the TTL runs out and it is recounted.
+            key = open_ticket_key(user_id)
+            if not cache.add(key, counts[user_id], timeout=get_open_ticket_count_ttl()):
+                counts[user_id] = cache.get(key, counts[user_id])
+    return counts
+
+
+def adjust_open_ticket_counts(user_ids, delta):
+    """Add ``delta`` to the cached counts of some users once the transaction commits"""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+
+    def apply():
+        for user_id in user_ids:
+            try:
+                cache.incr(open_ticket_key(user_id), delta)
+            except ValueError:
+                # Not cached: it is recounted when it is next needed
+                pass
+
+    transaction.on_commit(apply)
+
+
+def forget_open_ticket_counts(user_ids):
+    """Drop cached counts after changes made without signals, e.g. bulk inserts"""
+    cache.delete_many([open_ticket_key(user_id) for user_id in user_ids])
+
+
+def nearest_open_ticket_km(user_ids, latitude, longitude, radius_km):
+    """User id -> distance to the closest open ticket they are assigned to, within radius_km"""
+    located = nearby(
+        WorkOrder.objects.filter(status__in=OPEN_STATUSES).only('latitude', 'longitude', 'geohash'),
+        latitude, longitude, radius_km
+    )
+    distances = {work_order.pk: work_order.distance_km for work_order in located}
+    nearest = {}
+    for user_id, work_order_id in Assignment.objects.filter(
+        workorder_id__in=distances, user_id__in=user_ids
+    ).values_list('user_id', 'workorder_id'):
+        nearest[user_id] = min(nearest.get(user_id, radius_km), distances[work_order_id])
+    return nearest
+
+
+def pick_assignee(latitude=None, longitude=None, candidates=None):
+    """
+    The eligible staff member with the fewest open tickets, or None if
+    there is nobody to assign.
+
+    With ASSIGNMENT_PROXIMITY_WEIGHT set and coordinates given, a
+    technician whose open tickets are close to the new one is credited
+    with up to that many fewer tickets, so nearby work is bundled.
+    """
+    candidates = list(candidates if candidates is not None else eligible_staff())
+    if not candidates:
+        return None
+    user_ids = [user.pk for user in candidates]
+    counts = get_open_ticket_counts(user_ids)
+
+    weight = get_proximity_weight()
+    radius = get_proximity_radius_km()
+    proximity = weight and radius > 0 and latitude is not None and longitude is not None
+    distances = {}
+    if proximity:
+        distances = nearest_open_ticket_km(user_ids, latitude, longitude, radius)
+
+    def score(user):
+        load = counts[user.pk]
+        if proximity:
+            load -= weight * (1 - distances.get(user.pk, radius) / radius)
+        return load, counts[user.pk], user.pk
+
+    return min(candidates, key=score)
+
+
+@receiver(post_save, sender=WorkOrder)
+def count_status_change(sender, instance, created, **kwargs):
+    """Resolving a ticket frees its assignees; reopening it adds it back"""
+    # Set by WorkOrder.from_db() and save()
+    previous_status = getattr(instance, '_loaded_status', None)
+    if created or previous_status is None or 'status' not in instance.__dict__:
+        return
+    is_open = instance.status in OPEN_STATUSES
+    if (previous_status in OPEN_STATUSES) == is_open:
+        return
+    assignees = Assignment.objects.filter(workorder_id=instance.pk).values_list('user_id', flat=True)
+    adjust_open_ticket_counts(assignees, 1 if is_open else -1)
+
+
+@receiver(m2m_changed, sender=Assignment)
+def count_assignment_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """Adding or removing assignees changes their counts if the ticket is open"""
+    if action == 'pre_clear':
+        # The rows are gone by post_clear, so remember who loses how many
+        if reverse:
+            open_count = Assignment.objects.filter(
+                user_id=instance.pk, workorder__status__in=OPEN_STATUSES
+            ).count()
+            instance._cleared_assignments = {instance.pk: open_count}
+        elif instance.status in OPEN_STATUSES:
+            instance._cleared_assignments = dict.fromkeys(
+                Assignment.objects.filter(workorder_id=instance.pk).values_list('user_id', flat=True), 1
+            )
+        return
+    if action == 'post_clear':
+        for user_id, count in getattr(instance, '_cleared_assignments', {}).items():
+            if count:
+                adjust_open_ticket_counts([user_id], -count)
+        instance._cleared_assignments = {}
+        return
+    if action not in ('post_add', 'post_remove') or not pk_set:
+        return
+
+    delta = 1 if action == 'post_add' else -1
+    if reverse:
+        # user.assigned_tickets.add(...): pk_set holds work orders
+        open_count = WorkOrder.objects.filter(pk__in=pk_set, status__in=OPEN_STATUSES).count()
+        if open_count:
+            adjust_open_ticket_counts([instance.pk], delta * open_count)
+    elif instance.status in OPEN_STATUSES:
+        adjust_open_ticket_counts(pk_set, delta)
+
+
+@receiver(pre_delete, sender=WorkOrder)
+def count_deleted_work_order(sender, instance, **kwargs):
+    """Deleting an open ticket removes it from its assignees' counts"""
+    if instance.status in OPEN_STATUSES:
+        assignees = list(Assignment.objects.filter(workorder_id=instance.pk).values_list('user_id', flat=True))
+        adjust_open_ticket_counts(assignees, -1)
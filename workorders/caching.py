@@ -0,0 +1,119 @@
+"""
+Caching of page data that is expensive to build on every view.
+
+Cache keys include a version number for each kind of data they were
+built from. The versions live in the shared cache and are bumped by
+signals once a change is committed, so an entry built before a change is
+simply never looked up again and expires on its own.
+"""
+import time
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save
+from django.dispatch import receiver
+from .models import TaskCategory, TaskType, UserProfile, WorkOrder
+
+
+def get_view_cache_ttl():
+    """Seconds cached page data is kept; changes are seen at once regardless"""
+    return getattr(settings, 'VIEW_CACHE_TTL', 300)
+
+
+def version_key(name):
+    return f'workorders:version:{name}'
+
+
+def new_version():
+    # A lost version restarts from the clock, not from 1, so entries
+    # cached under the old numbers cannot be served again
+    return time.time_ns() // 1000
+
+
+def get_versions(*names):
+    """The current versions of some kinds of data, as one key fragment"""
+    keys = [version_key(name) for name in names]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, new_version(), timeout=None)
+            versions[key] = cache.get(key)
+    return '.'.join(str(versions[key]) for key in keys)
+
+
+def bump_versions(*names):
+    """Invalidate everything cached from some kinds of data once the transaction commits"""
+    def apply():
+        for name in names:
+            try:
+                cache.incr(version_key(name))
+            except ValueError:
+                cache.add(version_key(name), new_version(), timeout=None)
+
+    transaction.on_commit(apply)
+
+
+def cached(name, depends_on, compute, *key_parts):
+    """
+    The value of ``compute()``, cached under ``name`` and ``key_parts``
+    until one of the kinds of data in ``depends_on`` changes.
+    """
+    key = ':'.join(['workorders:view', name, get_versions(*depends_on), *map(str, key_parts)])
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.set(key, value, timeout=get_view_cache_ttl())
+    return value
+
+
+@receiver(post_save, sender=WorkOrder)
+@receiver(post_delete, sender=WorkOrder)
+def work_order_changed(sender, **kwargs):
+    bump_versions('workorder')
+
+
+@receiver(m2m_changed, sender=WorkOrder.assigned_to.through)
+def assignment_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_versions('workorder', 'assignment')
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def user_profile_changed(sender, **kwargs):
+    bump_versions('userprofile')
+
+
+@receiver(post_save, sender=TaskType)
+@receiver(post_delete, sender=TaskType)
+@receiver(post_save, sender=TaskCategory)
+@receiver(post_delete, sender=TaskCategory)
+def task_classification_changed(sender, **kwargs):
+    bump_versions('taskclassification')
+
+
+def staff_user_changed(instance, update_fields=None):
+    """
+    Whether saving or deleting a user can change the cached staff lists:
+    only staff users are listed, so the user must be staff now or have
+    been when loaded. Logging in only updates last_login, which no cached
+    data shows.
+    """
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return False
+    # A deferred is_staff is not known, so it is taken to matter
+    return instance.__dict__.get('is_staff', True) or instance._loaded_is_staff
+
+
+@receiver(post_init, sender=User)
+def remember_loaded_staff(sender, instance, **kwargs):
+    """Keep whether a user was loaded as staff, to see demotions"""
+    instance._loaded_is_staff = instance.__dict__.get('is_staff', True)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def staff_changed(sender, instance, update_fields=None, **kwargs):
+    if staff_user_changed(instance, update_fields):
+        bump_versions('staff')
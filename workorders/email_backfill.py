@@ -0,0 +1,237 @@
+"""
+Bulk import of historical emails as tickets.
+
+Messages are parsed in a pool of worker processes while the calling
+process, the only one touching the database, writes the parsed records
+in batched inserts.
+"""
+import itertools
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+import django
+from django.db import connections, transaction
+from .assignment import forget_open_ticket_counts
+from .caching import bump_versions
+from .email_service import EmailProcessor, TICKET_TAG_RE, get_max_message_size, parse_raw_email
+from .models import EmailMessageIndex, ProcessedEmail, WorkOrder, WorkOrderComment
+
+
+logger = logging.getLogger('workorders.email')
+
+
+class EmailBackfill:
+    """Import a mailbox's history for an email account"""
+
+    def __init__(self, email_account, status='closed', batch_size=500, workers=None):
+        self.email_account = email_account
+        self.status = status
+        self.batch_size = batch_size
+        self.workers = workers or os.cpu_count() or 1
+        # Used for sender resolution and its in-run user cache
+        self.processor = EmailProcessor(email_account)
+        # Message-ID or ticket number -> WorkOrder for threads seen so far
+        self._threads = {}
+        self.results = {
+            'read': 0,
+            'created': 0,
+            'comments': 0,
+            'duplicates': 0,
+            'errors': 0,
+        }
+
+    def run(self, raw_messages, progress=None):
+        """
+        Import an iterable of raw messages, oldest first.
+
+        While one batch is being written the workers already parse the
+        next one, so at most two batches are held in memory. ``progress``
+        is called with the running results after every batch. A lease
+        taken with ``self.processor.acquire_lease()`` is renewed as batches
+        are written.
+        """
+        max_size = get_max_message_size()
+        chunksize = max(1, self.batch_size // (self.workers * 4))
+        raw_messages = iter(raw_messages)
+
+        # Forked workers must not share the parent's database connections
+        for connection in connections.all(initialized_only=True):
+            if not connection.in_atomic_block:
+                connection.close()
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=django.setup) as executor:
+            pending = None
+            while True:
+                batch = list(itertools.islice(raw_messages, self.batch_size))
+                parsing = None
+                if batch:
+                    self.results['read'] += len(batch)
+                    parsing = executor.map(
+                        parse_raw_email, batch, itertools.repeat(max_size), chunksize=chunksize
+                    )
+                    del batch
+
+                if pending is not None:
+                    if not self.processor._keep_lease():
+                        raise RuntimeError(
+                            f'Lost the lease on {self.email_account.name} to another runner'
+                        )
+                    self._write_batch(list(pending))
+                    if progress:
+                        progress(self.results)
+
+                if parsing is None:
+                    break
+                pending = parsing
+
+        return self.results
+
+    def _write_batch(self, records):
+        """Write one batch of parsed emails in a single transaction"""
+        parsed = [record for record in records if record]
+        self.results['errors'] += len(records) - len(parsed)
+        results = dict(self.results)
+        threads = dict(self._threads)
+        try:
+            with transaction.atomic():
+                self._insert_batch(parsed)
+        except Exception as e:
+            # Nothing from the batch was recorded, so a rerun picks it up
+            # again; forget the rows that were rolled back
+            logger.exception(f"Error writing backfill batch: {e}")
+            self.results = results
+            self.results['errors'] += len(parsed)
+            self._threads = threads
+            self.processor._user_cache.clear()
+
+    def _insert_batch(self, records):
+        # Skip emails imported before and repeats within the batch
+        message_ids = {record['message_id'] for record in records}
+        seen = set(
+            ProcessedEmail.objects.filter(
+                email_account=self.email_account,
+                message_id__in=message_ids
+            ).values_list('message_id', flat=True)
+        )
+        fresh = []
+        for record in records:
+            if record['message_id'] in seen:
+                self.results['duplicates'] += 1
+                continue
+            seen.add(record['message_id'])
+            fresh.append(record)
+        if not fresh:
+            return
+
+        self.processor._prime_user_cache(fresh)
+        self._load_threads(fresh)
+
+        ticket_count = WorkOrder.objects.count()
+        work_orders = []
+        comments = []
+        processed_emails = []
+        index_entries = []
+        for record in fresh:
+            user = self.processor._get_or_create_user_from_email(record)
+            work_order = self._find_thread(record)
+            if not user:
+                work_order = None
+                status = 'failed'
+                self.results['errors'] += 1
+            elif work_order:
+                comment = WorkOrderComment(
+                    work_order=work_order,
+                    author=user,
+                    comment=record['body'] or record['subject']
+                )
+                comments.append((comment, record))
+                status = 'success'
+                self.results['comments'] += 1
+            else:
+                ticket_count += 1
+                work_order = WorkOrder(
+                    ticket_number=f"WO-{ticket_count:06d}",
+                    title=record['subject'][:200],
+                    description=record['body'],
+                    task_type=self.email_account.default_task_type,
+                    task_category=self.email_account.default_task_category,
+                    priority=self.email_account.default_priority,
+                    status=self.status,
+                    requester=user
+                )
+                work_orders.append((work_order, record))
+                self._threads[work_order.ticket_number] = work_order
+                status = 'success'
+                self.results['created'] += 1
+
+            if work_order and record['message_id']:
+                self._threads[record['message_id']] = work_order
+                index_entries.append(EmailMessageIndex(
+                    message_id=record['message_id'][:255],
+                    work_order=work_order,
+                    direction='inbound'
+                ))
+            processed_emails.append(ProcessedEmail(
+                email_account=self.email_account,
+                message_id=record['message_id'],
+                subject=record['subject'][:500],
+                sender_email=record['sender_email'],
+                sender_name=record['sender_name'][:255],
+                received_date=record['received_date'],
+                work_order=work_order,
+                processing_status=status,
+                processing_notes='Imported by backfill'
+            ))
+
+        WorkOrder.objects.bulk_create([work_order for work_order, record in work_orders])
+        WorkOrderComment.objects.bulk_create([comment for comment, record in comments])
+
+        # auto_now_add stamped the import time; keep the email's date instead
+        for obj, record in work_orders + comments:
+            obj.created_at = record['received_date']
+        WorkOrder.objects.bulk_update([work_order for work_order, record in work_orders], ['created_at'])
+        WorkOrderComment.objects.bulk_update([comment for comment, record in comments], ['created_at'])
+
+        if self.email_account.auto_assign_to:
+            Assignment = WorkOrder.assigned_to.through
+            Assignment.objects.bulk_create([
+                Assignment(workorder=work_order, user=self.email_account.auto_assign_to)
+                for work_order, record in work_orders
+            ])
+            # bulk_create sends no m2m_changed; count the user's tickets again
+            forget_open_ticket_counts([self.email_account.auto_assign_to.pk])
+        if work_orders or comments:
+            # Nor post_save: drop the pages and list rows cached from tickets
+            bump_versions('workorder', 'assignment')
+
+        EmailMessageIndex.objects.bulk_create(index_entries, ignore_conflicts=True)
+        ProcessedEmail.objects.bulk_create(processed_emails)
+
+    def _load_threads(self, records):
+        """Look up every thread the batch refers to with one query per kind"""
+        message_ids = set()
+        ticket_numbers = set()
+        for record in records:
+            message_ids.update(record['in_reply_to'] + record['references'])
+            ticket_numbers.update(TICKET_TAG_RE.findall(record['subject']))
+
+        message_ids -= set(self._threads)
+        if message_ids:
+            for entry in EmailMessageIndex.objects.filter(
+                message_id__in=message_ids
+            ).select_related('work_order'):
+                self._threads[entry.message_id] = entry.work_order
+
+        ticket_numbers -= set(self._threads)
+        if ticket_numbers:
+            for work_order in WorkOrder.objects.filter(ticket_number__in=ticket_numbers):
+                self._threads[work_order.ticket_number] = work_order
+
+    def _find_thread(self, record):
+        """The work order an email replies to, if it is known"""
+        for key in (
+            record['in_reply_to'] + record['references']
+            + TICKET_TAG_RE.findall(record['subject'])
+        ):
+            if key in self._threads:
+                return self._threads[key]
+        return None
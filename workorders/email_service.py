@@ -2,29 +2,192 @@
 Email service for processing emails and automatically creating tickets.
 """
 import imaplib
+import logging
+import os
 import poplib
-import email
 import re
-from datetime import datetime, timezone
+import socket
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from email.feedparser import BytesFeedParser
 from email.header import decode_header
+from email.message import Message
 from email.utils import parsedate_tz, mktime_tz
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F, Q
 from django.utils import timezone as django_timezone
-from django.core.mail import send_mail
-from django.conf import settings
-from django.template import Context, Template
-from .models import EmailAccount, ProcessedEmail, WorkOrder, EmailTemplate
+from .assignment import pick_assignee
+from .html_text import html_to_text
+from .models import (
+    EmailAccount, EmailAccountLease, EmailMessageIndex, EmailProcessingRun, POP3SeenMessage,
+    ProcessedEmail, WorkOrder, WorkOrderComment
+)
+from .notifications import queue_email, render_notification
+from .reference import get_reference_data
+
+logger = logging.getLogger('workorders.email')
+
+# "[WO-000123]" in a subject refers to an existing ticket
+TICKET_TAG_RE = re.compile(r'\[(WO-\d+)\]')
+MESSAGE_ID_RE = re.compile(r'<[^<>\s]+>')
+
+# Raw message bytes handed to the MIME parser at a time
+PARSE_CHUNK_SIZE = 64 * 1024
+
+
+def get_max_message_size():
+    """Largest number of bytes read from a single message (0 for no limit)"""
+    return getattr(settings, 'EMAIL_MAX_MESSAGE_SIZE', 5 * 1024 * 1024)
+
+
+def get_lease_seconds():
+    """How long an account stays reserved for a runner without renewal"""
+    return getattr(settings, 'EMAIL_LEASE_SECONDS', 600)
+
+
+def get_retry_max_attempts():
+    """Failed processing attempts after which an email is no longer retried"""
+    return getattr(settings, 'EMAIL_RETRY_MAX_ATTEMPTS', 5)
+
+
+def get_retry_delay(attempts):
+    """Capped exponential backoff for an email that failed ``attempts`` times"""
+    base = getattr(settings, 'EMAIL_RETRY_BASE_SECONDS', 300)
+    cap = getattr(settings, 'EMAIL_RETRY_MAX_SECONDS', 6 * 3600)
+    return timedelta(seconds=min(cap, base * 2 ** (attempts - 1)))
+
+
+def get_backlog_max_batch_size():
+    """Most emails fetched in one batch when draining a backlog"""
+    return getattr(settings, 'EMAIL_BACKLOG_MAX_BATCH_SIZE', 500)
+
+
+def get_max_body_length():
+    """Longest ticket description produced from an HTML email body"""
+    return getattr(settings, 'EMAIL_MAX_BODY_LENGTH', 100000)
+
+
+class BodyOnlyMessage(Message):
+    """
+    Message that does not keep payloads it will never be asked for.
+    
+    Only text parts are ever turned into ticket descriptions, so the
+    payload of attachments and other binary parts is dropped as soon as
+    the parser hands it over instead of living on in the message tree.
+    """
+    
+    def set_payload(self, payload, charset=None):
+        if (self.get_content_disposition() == 'attachment'
+                or self.get_content_maintype() not in ('text', 'multipart')):
+            payload = ''
+        super().set_payload(payload, charset)
+
+
+def parse_message_bytes(data, max_size=None):
+    """
+    Parse a raw RFC822 message with a streaming feed parser.
+    
+    ``data`` is either the message bytes or an iterable of byte chunks.
+    At most ``max_size`` bytes are parsed; anything past that point
+    (normally the tail of a large attachment) is never looked at.
+    """
+    if max_size is None:
+        max_size = get_max_message_size()
+    
+    if isinstance(data, (bytes, bytearray)):
+        view = memoryview(data)
+        data = (view[i:i + PARSE_CHUNK_SIZE] for i in range(0, len(view), PARSE_CHUNK_SIZE))
+    
+    parser = BytesFeedParser(_factory=BodyOnlyMessage)
+    fed = 0
+    for chunk in data:
+        if max_size and fed + len(chunk) > max_size:
+            parser.feed(bytes(chunk[:max_size - fed]))
+            break
+        parser.feed(bytes(chunk))
+        fed += len(chunk)
+    return parser.close()
+
+
+class PipelineStats:
+    """Wall-clock time and item counts per stage of the email pipeline"""
+    
+    STAGES = ['connect', 'fetch', 'parse', 'dedup', 'create', 'notify']
+    
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.bytes = defaultdict(int)
+    
+    @contextmanager
+    def stage(self, name, count=1):
+        """Time a block of work and count the items it handled"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+            self.counts[name] += count
+    
+    def add(self, name, count=0, size=0):
+        """Count items or bytes for a stage outside of a timed block"""
+        self.counts[name] += count
+        self.bytes[name] += size
+    
+    def as_dict(self):
+        """
+        Stage -> {'seconds', 'count', 'per_second'} in pipeline order, plus
+        'bytes' for stages that moved any
+        """
+        stages = {}
+        for name in self.STAGES + sorted(set(self.seconds) - set(self.STAGES)):
+            if name not in self.seconds:
+                continue
+            seconds = self.seconds[name]
+            count = self.counts[name]
+            stages[name] = {
+                'seconds': round(seconds, 6),
+                'count': count,
+                'per_second': round(count / seconds, 1) if seconds else None,
+            }
+            if self.bytes[name]:
+                stages[name]['bytes'] = self.bytes[name]
+        return stages
 
 
 class EmailProcessor:
     """Process emails and create tickets"""
     
-    def __init__(self, email_account):
+    def __init__(self, email_account, source=None, dry_run=False):
         self.email_account = email_account
         self.connection = None
+        # Local mailbox (see mail_sources) read instead of the mail server
+        self.source = source
+        # Leave the mailbox untouched and roll back every database change
+        self.dry_run = dry_run
+        self.stats = PipelineStats()
+        # Why the mail server could not be reached, for the run history
+        self.connection_error = ''
+        # Identifies this runner in the account's lease
+        self.lease_owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self._lease_renewed_at = None
+        # POP3 message sizes from the last LIST
+        self._pop3_sizes = []
+        # POP3 message number -> unique id from the last UIDL
+        self._pop3_uids = {}
+        # Sender email -> User, shared by every batch handled in this run
+        self._user_cache = {}
     
     def connect(self):
         """Connect to email server"""
+        if self.source:
+            return True
+        
         try:
             if self.email_account.protocol == 'imap':
                 if self.email_account.use_ssl:
@@ -43,9 +206,47 @@ class EmailProcessor:
             
             return True
         except Exception as e:
-            print(f"Failed to connect to email server: {e}")
+            logger.error(f"Failed to connect to email server for {self.email_account.name}: {e}")
+            self.connection_error = str(e)
             return False
     
+    def acquire_lease(self):
+        """
+        Reserve the account for this runner.
+        
+        Returns False while another runner holds an unexpired lease, so
+        that concurrent pollers split the accounts between them instead of
+        reading the same mailbox twice.
+        """
+        EmailAccountLease.objects.get_or_create(email_account=self.email_account)
+        return self._extend_lease()
+    
+    def release_lease(self):
+        """Free the account for other runners"""
+        EmailAccountLease.objects.filter(
+            email_account=self.email_account,
+            owner=self.lease_owner
+        ).update(owner='', expires_at=None)
+        self._lease_renewed_at = None
+    
+    def _extend_lease(self):
+        # A single conditional UPDATE, so only one runner can win
+        now = django_timezone.now()
+        acquired = EmailAccountLease.objects.filter(
+            Q(owner=self.lease_owner) | Q(expires_at__isnull=True) | Q(expires_at__lt=now),
+            email_account=self.email_account
+        ).update(owner=self.lease_owner, expires_at=now + timedelta(seconds=get_lease_seconds()))
+        self._lease_renewed_at = time.monotonic() if acquired else None
+        return bool(acquired)
+    
+    def _keep_lease(self):
+        """Renew the lease once half of it has passed; False if it was lost"""
+        if self._lease_renewed_at is None:
+            return True
+        if time.monotonic() - self._lease_renewed_at < get_lease_seconds() / 2:
+            return True
+        return self._extend_lease()
+    
     def disconnect(self):
         """Disconnect from email server"""
         if self.connection:
@@ -61,75 +262,195 @@ class EmailProcessor:
     
     def fetch_emails(self, limit=50):
         """Fetch new emails from the server"""
-        if not self.connection:
-            if not self.connect():
-                return []
+        if self.source:
+            return self._fetch_source_emails(limit)
         
         emails = []
         try:
-            if self.email_account.protocol == 'imap':
-                emails = self._fetch_imap_emails(limit)
-            else:  # POP3
-                emails = self._fetch_pop3_emails(limit)
+            # The newest ones
+            message_numbers = self.list_messages()
+            if message_numbers:
+                emails = self.fetch_messages(message_numbers[-limit:])
         except Exception as e:
-            print(f"Error fetching emails: {e}")
+            logger.exception(f"Error fetching emails for {self.email_account.name}: {e}")
         
         return emails
     
-    def _fetch_imap_emails(self, limit):
-        """Fetch emails using IMAP"""
-        # Search for unread emails
-        status, messages = self.connection.search(None, 'UNSEEN')
-        if status != 'OK':
-            return []
+    def _ensure_connected(self):
+        if not self.connection:
+            with self.stats.stage('connect'):
+                return self.connect()
+        return True
+    
+    def list_messages(self, skip_processed=False):
+        """
+        Server numbers of the messages to process, oldest first, or None if
+        the server cannot be reached.
         
-        email_ids = messages[0].split()
-        emails = []
+        For IMAP these are the unread messages. POP3 has no read flag, so
+        the messages whose unique id was handled in an earlier run are left
+        out instead (see POP3SeenMessage). With ``skip_processed`` the
+        headers of the remaining ones are read as well, to leave out those
+        that already have a ProcessedEmail.
+        """
+        if not self._ensure_connected():
+            return None
         
-        # Limit the number of emails processed
-        for email_id in email_ids[-limit:]:
-            try:
-                status, msg_data = self.connection.fetch(email_id, '(RFC822)')
-                if status == 'OK':
-                    email_message = email.message_from_bytes(msg_data[0][1])
-                    parsed_email = self._parse_email(email_message)
-                    if parsed_email:
-                        emails.append(parsed_email)
-            except Exception as e:
-                print(f"Error processing email {email_id}: {e}")
+        if self.email_account.protocol == 'imap':
+            status, messages = self.connection.search(None, 'UNSEEN')
+            if status != 'OK':
+                return []
+            return messages[0].split()
         
-        return emails
+        # Message sizes ("<number> <octets>" per message)
+        self._pop3_sizes = [int(entry.split()[1]) for entry in self.connection.list()[1]]
+        message_numbers = self._skip_seen_pop3(list(range(1, len(self._pop3_sizes) + 1)))
+        if skip_processed:
+            message_numbers = self._skip_processed_pop3(message_numbers)
+        return message_numbers
     
-    def _fetch_pop3_emails(self, limit):
-        """Fetch emails using POP3"""
-        # Get message count
-        num_messages = len(self.connection.list()[1])
-        emails = []
+    def _skip_seen_pop3(self, message_numbers):
+        try:
+            listing = self.connection.uidl()[1]
+        except poplib.error_proto as e:
+            # UIDL is optional in POP3; without it every message is listed
+            logger.warning(f"{self.email_account.name} does not support UIDL: {e}")
+            self._pop3_uids = {}
+            return message_numbers
+        
+        # "<number> <unique id>" per message
+        self._pop3_uids = {
+            int(number): uid.decode('ascii', 'replace')
+            for number, uid in (entry.split() for entry in listing)
+        }
+        with self.stats.stage('dedup', count=0):
+            seen_messages = POP3SeenMessage.objects.filter(email_account=self.email_account)
+            seen = set(seen_messages.values_list('uid', flat=True))
+            # Forget the messages that were deleted from the mailbox
+            gone = list(seen.difference(self._pop3_uids.values()))
+            for start in range(0, len(gone), 500):
+                seen_messages.filter(uid__in=gone[start:start + 500]).delete()
+        return [number for number in message_numbers if self._pop3_uids.get(number) not in seen]
+    
+    def _remember_seen_pop3(self, uids, error=''):
+        """
+        Store the unique ids of handled POP3 messages so later runs skip them.
         
-        # Process the last N messages
-        start = max(1, num_messages - limit + 1)
-        for i in range(start, num_messages + 1):
+        ``error`` records why messages that could not be parsed were given up.
+        """
+        POP3SeenMessage.objects.bulk_create(
+            [POP3SeenMessage(email_account=self.email_account, uid=uid, error=error) for uid in uids if uid],
+            ignore_conflicts=True
+        )
+    
+    def _skip_processed_pop3(self, message_numbers):
+        message_ids = {}
+        with self.stats.stage('dedup', count=len(message_numbers)):
+            for number in message_numbers:
+                headers = parse_message_bytes(
+                    (line + b'\n' for line in self.connection.top(number, 0)[1]), 0
+                )
+                message_ids[number] = (headers['Message-ID'] or '').strip()
+            processed = set()
+            ids = [message_id for message_id in message_ids.values() if message_id]
+            for start in range(0, len(ids), 500):
+                processed.update(ProcessedEmail.objects.filter(
+                    email_account=self.email_account,
+                    message_id__in=ids[start:start + 500]
+                ).values_list('message_id', flat=True))
+            self._remember_seen_pop3(
+                self._pop3_uids.get(number) for number in message_numbers
+                if message_ids[number] in processed
+            )
+        return [number for number in message_numbers if message_ids[number] not in processed]
+    
+    def fetch_messages(self, message_numbers):
+        """Download and parse the given messages from the server"""
+        max_size = get_max_message_size()
+        fetch = self._fetch_imap_message if self.email_account.protocol == 'imap' else self._fetch_pop3_message
+        emails = []
+        for number in message_numbers:
             try:
-                # Get message
-                server_msg = self.connection.retr(i)
-                email_message = email.message_from_bytes(b'\n'.join(server_msg[1]))
-                parsed_email = self._parse_email(email_message)
+                parsed_email = fetch(number, max_size)
                 if parsed_email:
                     emails.append(parsed_email)
             except Exception as e:
-                print(f"Error processing email {i}: {e}")
+                logger.exception(f"Error processing email {number}: {e}")
+        return emails
+    
+    def _fetch_imap_message(self, email_id, max_size):
+        # Only download the part of each message the parser will read; a
+        # dry run peeks so that messages stay unread
+        section = 'BODY.PEEK[]' if self.dry_run else 'BODY[]'
+        fetch_items = f'({section}<0.{max_size}>)' if max_size else f'({section})'
+        
+        with self.stats.stage('fetch'):
+            status, msg_data = self.connection.fetch(email_id, fetch_items)
+        if status != 'OK':
+            return None
+        self.stats.add('fetch', size=len(msg_data[0][1]))
+        return self._parse_raw_email(msg_data[0][1], max_size)
+    
+    def _fetch_pop3_message(self, number, max_size):
+        # Get message, or only its headers and first lines if it is too
+        # large to download in full
+        with self.stats.stage('fetch'):
+            if max_size and self._pop3_sizes[number - 1] > max_size:
+                server_msg = self.connection.top(number, max_size // 100)
+            else:
+                server_msg = self.connection.retr(number)
+        self.stats.add('fetch', size=server_msg[2])
+        uid = self._pop3_uids.get(number)
+        try:
+            parsed_email = self._parse_raw_email(
+                (line + b'\n' for line in server_msg[1]), max_size
+            )
+        except Exception as e:
+            # Downloading it again would not help, so later runs skip it
+            self._remember_seen_pop3([uid], error=str(e) or type(e).__name__)
+            raise
+        if not parsed_email:
+            self._remember_seen_pop3([uid], error='Could not parse the message')
+            return None
+        parsed_email['pop3_uid'] = uid
+        return parsed_email
+    
+    def _fetch_source_emails(self, limit):
+        """Read emails from a local mailbox file"""
+        emails = []
+        max_size = get_max_message_size()
+        messages = self.source.iter_raw_messages(limit)
+        
+        while True:
+            with self.stats.stage('fetch', count=0):
+                raw_message = next(messages, None)
+            if raw_message is None:
+                break
+            self.stats.add('fetch', count=1, size=len(raw_message))
+            parsed_email = self._parse_raw_email(raw_message, max_size)
+            if parsed_email:
+                emails.append(parsed_email)
         
         return emails
     
+    def _parse_raw_email(self, data, max_size):
+        """Parse raw message bytes (or chunks) into an email dict"""
+        with self.stats.stage('parse'):
+            return self._parse_email(parse_message_bytes(data, max_size))
+    
     def _parse_email(self, email_message):
         """Parse email message and extract relevant information"""
         try:
             # Extract basic information
             subject = self._decode_header(email_message['Subject'] or '')
             sender = self._decode_header(email_message['From'] or '')
-            message_id = email_message['Message-ID'] or ''
+            message_id = (email_message['Message-ID'] or '').strip()
             date_str = email_message['Date'] or ''
             
+            # Message-IDs this email replies to
+            in_reply_to = MESSAGE_ID_RE.findall(email_message['In-Reply-To'] or '')
+            references = MESSAGE_ID_RE.findall(email_message['References'] or '')
+            
             # Parse date
             received_date = django_timezone.now()
             if date_str:
@@ -167,10 +488,11 @@ class EmailProcessor:
                 'sender_name': sender_name,
                 'received_date': received_date,
                 'body': body,
-                'raw_message': email_message
+                'in_reply_to': in_reply_to,
+                'references': references,
             }
         except Exception as e:
-            print(f"Error parsing email: {e}")
+            logger.exception(f"Error parsing email: {e}")
             return None
     
     def _decode_header(self, header):
@@ -199,19 +521,23 @@ class EmailProcessor:
         
         if email_message.is_multipart():
             for part in email_message.walk():
+                # Attachments are never decoded, even text ones
+                if part.get_content_disposition() == 'attachment':
+                    continue
                 if part.get_content_type() == 'text/plain':
                     payload = part.get_payload(decode=True)
                     if payload:
                         charset = part.get_content_charset() or 'utf-8'
-                        body += payload.decode(charset, errors='ignore')
+                        body = payload.decode(charset, errors='ignore')
+                        # The plain text body is all we need
+                        break
                 elif part.get_content_type() == 'text/html' and not body:
                     # Fall back to HTML if no plain text
                     payload = part.get_payload(decode=True)
                     if payload:
                         charset = part.get_content_charset() or 'utf-8'
                         html_body = payload.decode(charset, errors='ignore')
-                        # Simple HTML to text conversion
-                        body = re.sub(r'<[^>]+>', '', html_body)
+                        body = html_to_text(html_body, max_length=get_max_body_length())
         else:
             payload = email_message.get_payload(decode=True)
             if payload:
@@ -220,145 +546,477 @@ class EmailProcessor:
         
         return body.strip()
     
-    def process_emails(self):
-        """Process emails and create tickets"""
-        emails = self.fetch_emails()
+    def process_emails(self, limit=50, retry_only=False, time_budget=None):
+        """
+        Process emails and create tickets.
+        
+        Failed emails that are due for a retry are processed again after
+        the new ones; with ``retry_only`` the mailbox is not read at all.
+        With a ``time_budget`` in seconds the whole backlog is drained
+        oldest first instead of reading the newest ``limit`` emails (see
+        _drain_backlog).
+        In a dry run everything happens inside a transaction that is rolled
+        back at the end, and the results list what would have been done.
+        """
+        if not self.acquire_lease():
+            logger.info(f"Skipping {self.email_account.name}: another runner holds its lease")
+            return {'skipped': 'Another runner is processing this account'}
+        
+        started_at = django_timezone.now()
+        start = time.perf_counter()
+        try:
+            if self.dry_run:
+                with transaction.atomic():
+                    results = self._process_emails(limit, retry_only, time_budget)
+                    transaction.set_rollback(True)
+            else:
+                results = self._process_emails(limit, retry_only, time_budget)
+        except Exception as e:
+            self._record_run(started_at, time.perf_counter() - start, {}, error=str(e))
+            raise
+        finally:
+            self.release_lease()
+        
+        results['seconds'] = round(time.perf_counter() - start, 6)
+        self._record_run(started_at, results['seconds'], results, error=self.connection_error)
+        return results
+    
+    def _record_run(self, started_at, duration, results, error=''):
+        """
+        Log the run's stage timings as structured lines and save them to
+        the run history.
+        """
+        stages = self.stats.as_dict()
+        fetch = stages.get('fetch', {})
+        counters = {
+            name: results.get(name, 0)
+            for name in ('processed', 'created', 'comments', 'duplicates', 'errors')
+        }
+        
+        account = self.email_account.name
+        for name, stage in stages.items():
+            logger.info(
+                'email_stage account="%s" stage=%s seconds=%.6f count=%d bytes=%d',
+                account, name, stage['seconds'], stage['count'], stage.get('bytes', 0)
+            )
+        logger.info(
+            'email_run account="%s" dry_run=%s seconds=%.6f fetched=%d bytes=%d %s%s',
+            account, self.dry_run, duration, fetch.get('count', 0), fetch.get('bytes', 0),
+            ' '.join(f'{name}={count}' for name, count in counters.items()),
+            f' error="{error}"' if error else ''
+        )
+        
+        try:
+            EmailProcessingRun.objects.create(
+                email_account=self.email_account,
+                source=str(self.source) if self.source else '',
+                dry_run=self.dry_run,
+                started_at=started_at,
+                duration_seconds=round(duration, 6),
+                fetched_messages=fetch.get('count', 0),
+                fetched_bytes=fetch.get('bytes', 0),
+                stages=stages,
+                error=error,
+                **counters
+            )
+        except Exception as e:
+            logger.exception(f"Error saving processing run for {account}: {e}")
+    
+    def _process_emails(self, limit, retry_only=False, time_budget=None):
         results = {
             'processed': 0,
             'created': 0,
+            'comments': 0,
             'duplicates': 0,
+            'retried': 0,
             'errors': 0
         }
+        if self.dry_run:
+            results['items'] = []
         
-        for email_data in emails:
-            try:
-                # Check if email already processed
-                if ProcessedEmail.objects.filter(
-                    email_account=self.email_account,
-                    message_id=email_data['message_id']
-                ).exists():
-                    results['duplicates'] += 1
-                    continue
-                
-                # Create work order from email
-                work_order = self._create_work_order_from_email(email_data)
-                
-                # Record processed email
-                processed_email = ProcessedEmail.objects.create(
-                    email_account=self.email_account,
-                    message_id=email_data['message_id'],
-                    subject=email_data['subject'],
-                    sender_email=email_data['sender_email'],
-                    sender_name=email_data['sender_name'],
-                    received_date=email_data['received_date'],
-                    work_order=work_order,
-                    processing_status='success' if work_order else 'failed'
-                )
-                
-                if work_order:
-                    results['created'] += 1
-                    # Send confirmation email
-                    self._send_confirmation_email(work_order, email_data['sender_email'])
-                else:
-                    results['errors'] += 1
-                
-                results['processed'] += 1
-                
-            except Exception as e:
-                print(f"Error processing email {email_data.get('message_id', 'unknown')}: {e}")
-                results['errors'] += 1
-                
-                # Record failed processing
-                try:
-                    ProcessedEmail.objects.create(
-                        email_account=self.email_account,
-                        message_id=email_data['message_id'],
-                        subject=email_data['subject'],
-                        sender_email=email_data['sender_email'],
-                        sender_name=email_data['sender_name'],
-                        received_date=email_data['received_date'],
-                        processing_status='failed',
-                        processing_notes=str(e)
-                    )
-                except:
-                    pass
+        if time_budget:
+            self._drain_backlog(results, limit, time_budget)
+        elif not retry_only:
+            self._process_batch(self.fetch_emails(limit), results)
+        
+        self._retry_failed_emails(results, limit)
         
         # Update email account stats
         self.email_account.last_processed = django_timezone.now()
         self.email_account.processed_count += results['processed']
-        self.email_account.save()
+        self.email_account.save(update_fields=['last_processed', 'processed_count', 'updated_at'])
         
+        results['stages'] = self.stats.as_dict()
         return results
     
-    def _create_work_order_from_email(self, email_data):
-        """Create a work order from email data"""
+    def _drain_backlog(self, results, first_batch_size, time_budget):
+        """
+        Work through every waiting message, oldest first, until the time
+        budget runs out.
+        
+        The first batch has ``first_batch_size`` messages. Every following
+        batch is as large as the time left allows at the per-message
+        latency measured so far, up to EMAIL_BACKLOG_MAX_BATCH_SIZE. The
+        number of messages left waiting is reported as ``backlog``.
+        """
+        if self.source:
+            raise ValueError('Backlog mode reads from the mail server, not a local mailbox')
+        
+        deadline = time.monotonic() + time_budget
+        max_batch_size = get_backlog_max_batch_size()
         try:
-            # Find or create user from email
-            user = self._get_or_create_user_from_email(email_data)
-            if not user:
-                return None
+            pending = self.list_messages(skip_processed=True)
+        except Exception as e:
+            logger.exception(f"Error listing emails for {self.email_account.name}: {e}")
+            pending = None
+        if pending is None:
+            return
+        
+        batch_size = min(first_batch_size, max_batch_size)
+        seconds_per_message = None
+        while pending:
+            batch, pending = pending[:batch_size], pending[batch_size:]
+            start = time.monotonic()
+            lease_kept = self._process_batch(self.fetch_messages(batch), results)
+            elapsed = time.monotonic() - start
             
-            # Create work order
-            work_order = WorkOrder.objects.create(
-                title=email_data['subject'][:200],  # Limit to 200 chars
-                description=email_data['body'],
-                task_type=self.email_account.default_task_type,
-                task_category=self.email_account.default_task_category,
-                priority=self.email_account.default_priority,
-                requester=user
+            # Weigh the latest batch most, but do not forget earlier ones
+            latency = elapsed / len(batch)
+            seconds_per_message = latency if seconds_per_message is None else (seconds_per_message + latency) / 2
+            remaining = deadline - time.monotonic()
+            batch_size = min(max_batch_size, int(remaining / seconds_per_message)) if seconds_per_message else max_batch_size
+            if not lease_kept or batch_size < 1:
+                break
+        
+        results['backlog'] = len(pending)
+        results['seconds_per_message'] = round(seconds_per_message or 0, 6)
+    
+    def _process_batch(self, emails, results):
+        """Process fetched emails; returns False if the lease was lost part way"""
+        # Resolve every sender in the batch up front with a single query
+        self._prime_user_cache(emails)
+        
+        # POP3 messages handled so far, which later runs need not download
+        seen_uids = []
+        try:
+            for email_data in emails:
+                if not self._keep_lease():
+                    logger.warning(
+                        f"Lost the lease on {self.email_account.name}; leaving the rest to its new owner"
+                    )
+                    return False
+                try:
+                    # Check if email already processed
+                    with self.stats.stage('dedup'):
+                        duplicate = ProcessedEmail.objects.filter(
+                            email_account=self.email_account,
+                            message_id=email_data['message_id']
+                        ).exists()
+                    if duplicate:
+                        results['duplicates'] += 1
+                        self._record_item(results, 'duplicate', email_data)
+                    else:
+                        self._count_outcome(results, email_data, *self._ingest_email(email_data))
+                    
+                except Exception as e:
+                    logger.exception(f"Error processing email {email_data.get('message_id', 'unknown')}: {e}")
+                    results['errors'] += 1
+                    self._record_item(results, 'error', email_data)
+                    self._record_failure(email_data, str(e))
+                seen_uids.append(email_data.get('pop3_uid'))
+        finally:
+            self._remember_seen_pop3(seen_uids)
+        
+        return True
+    
+    def _ingest_email(self, email_data, record=None):
+        """
+        Turn an email into a ticket or a comment and record the outcome.
+        
+        ``record`` is the ProcessedEmail of an earlier failed attempt,
+        which is updated instead of creating a new one. Returns the new
+        work order, the work order replied to and the new comment.
+        """
+        try:
+            with self.stats.stage('create'), transaction.atomic():
+                # Replies to an existing ticket become comments on it
+                thread_work_order = self._find_thread_work_order(email_data)
+                if thread_work_order:
+                    comment = self._add_reply_comment(thread_work_order, email_data)
+                    work_order = None
+                    self._save_processed_email(
+                        email_data, record, thread_work_order, succeeded=bool(comment),
+                        notes=f"Added as a comment to {thread_work_order.ticket_number}" if comment else ''
+                    )
+                else:
+                    # Create work order from email
+                    comment = None
+                    work_order = self._create_work_order_from_email(email_data)
+                    self._save_processed_email(email_data, record, work_order, succeeded=bool(work_order))
+        except Exception:
+            # A user created for the sender was rolled back with the rest
+            self._forget_sender(email_data)
+            raise
+        return work_order, thread_work_order, comment
+    
+    def _count_outcome(self, results, email_data, work_order, thread_work_order, comment):
+        if comment:
+            results['comments'] += 1
+            self._record_item(results, 'comment', email_data, thread_work_order)
+        elif work_order:
+            results['created'] += 1
+            self._record_item(results, 'create', email_data, work_order)
+            # Send confirmation email
+            with self.stats.stage('notify'):
+                self._send_confirmation_email(work_order, email_data['sender_email'])
+        else:
+            results['errors'] += 1
+            self._record_item(results, 'error', email_data, thread_work_order)
+        
+        results['processed'] += 1
+    
+    def _save_processed_email(self, email_data, record, work_order, succeeded, notes=''):
+        """Record the outcome of processing an email, scheduling a retry if it failed"""
+        if record is None:
+            record = ProcessedEmail(
+                email_account=self.email_account,
+                message_id=email_data['message_id'],
+                subject=email_data['subject'],
+                sender_email=email_data['sender_email'],
+                sender_name=email_data['sender_name'],
+                received_date=email_data['received_date'],
+            )
+        record.work_order = work_order
+        record.processing_notes = notes
+        if succeeded:
+            record.processing_status = 'success'
+            record.next_attempt_at = None
+            record.retry_data = {}
+        else:
+            self._schedule_retry(record, email_data)
+        record.save()
+    
+    def _record_failure(self, email_data, error, record=None):
+        """Record an email whose processing raised, scheduling a retry"""
+        try:
+            self._save_processed_email(email_data, record, None, succeeded=False, notes=error)
+        except Exception as e:
+            logger.exception(f"Error recording failed email {email_data.get('message_id', 'unknown')}: {e}")
+    
+    def _schedule_retry(self, record, email_data):
+        record.processing_status = 'failed'
+        record.attempts += 1
+        if record.attempts >= get_retry_max_attempts():
+            # Given up; only the admin "requeue" action retries it now
+            record.next_attempt_at = None
+        else:
+            record.next_attempt_at = django_timezone.now() + get_retry_delay(record.attempts)
+        record.retry_data = {
+            'body': email_data['body'],
+            'in_reply_to': email_data['in_reply_to'],
+            'references': email_data['references'],
+        }
+        if not record.processing_notes:
+            record.processing_notes = 'Could not create a ticket or comment from this email'
+    
+    def _retry_failed_emails(self, results, limit):
+        """Process failed emails that are due again from what was stored, without fetching them"""
+        due = list(
+            ProcessedEmail.objects.filter(
+                email_account=self.email_account,
+                processing_status='failed',
+                next_attempt_at__lte=django_timezone.now()
+            ).order_by('next_attempt_at')[:limit]
+        )
+        emails = [
+            dict(
+                record.retry_data,
+                message_id=record.message_id,
+                subject=record.subject,
+                sender_email=record.sender_email,
+                sender_name=record.sender_name,
+                received_date=record.received_date,
             )
-            if self.email_account.auto_assign_to:
-                work_order.assigned_to.add(self.email_account.auto_assign_to)
-            return work_order
+            for record in due
+        ]
+        self._prime_user_cache(emails)
+        
+        for record, email_data in zip(due, emails):
+            if not self._keep_lease():
+                break
+            try:
+                outcome = self._ingest_email(email_data, record)
+            except Exception as e:
+                logger.exception(f"Error retrying email {record.message_id}: {e}")
+                results['errors'] += 1
+                self._record_item(results, 'error', email_data)
+                self._record_failure(email_data, str(e), record)
+                continue
+            if record.processing_status == 'success':
+                results['retried'] += 1
+            self._count_outcome(results, email_data, *outcome)
+    
+    def _record_item(self, results, action, email_data, work_order=None):
+        """List what happened to an email; only done in dry runs"""
+        if 'items' in results:
+            results['items'].append({
+                'action': action,
+                'subject': email_data['subject'],
+                'sender_email': email_data['sender_email'],
+                'ticket_number': work_order.ticket_number if work_order else '',
+            })
+    
+    def _create_work_order_from_email(self, email_data):
+        """Create a work order from email data"""
+        try:
+            # A savepoint, so that a database error here leaves the
+            # caller's transaction usable for recording the failure
+            with transaction.atomic():
+                # Find or create user from email
+                user = self._get_or_create_user_from_email(email_data)
+                if not user:
+                    return None
+                
+                # Create work order; the account's defaults come from the
+                # reference data cache instead of a query per account
+                reference = get_reference_data()
+                work_order = WorkOrder.objects.create(
+                    title=email_data['subject'][:200],  # Limit to 200 chars
+                    description=email_data['body'],
+                    task_type=reference.task_type(self.email_account.default_task_type_id),
+                    task_category=reference.task_category(self.email_account.default_task_category_id),
+                    priority=self.email_account.default_priority,
+                    requester=user
+                )
+                assignee = self.email_account.auto_assign_to
+                if not assignee and self.email_account.auto_assign_least_loaded:
+                    assignee = pick_assignee()
+                if assignee:
+                    work_order.assigned_to.add(assignee)
+                self._index_message_id(email_data, work_order)
+                return work_order
         except Exception as e:
-            print(f"Error creating work order from email: {e}")
+            logger.exception(f"Error creating work order from email: {e}")
+            self._forget_sender(email_data)
+            return None
+    
+    def _find_thread_work_order(self, email_data):
+        """Find the work order an email replies to, if any"""
+        message_ids = email_data['in_reply_to'] + email_data['references']
+        ticket_numbers = TICKET_TAG_RE.findall(email_data['subject'])
+        if not message_ids and not ticket_numbers:
             return None
+        
+        # Both lookups hit unique indexes, so this is one cheap query
+        query = Q()
+        if message_ids:
+            query |= Q(message_ids__message_id__in=message_ids)
+        if ticket_numbers:
+            query |= Q(ticket_number__in=ticket_numbers)
+        return WorkOrder.objects.filter(query).order_by('-pk').first()
+    
+    def _add_reply_comment(self, work_order, email_data):
+        """Append a reply email to a work order as a comment"""
+        try:
+            with transaction.atomic():
+                user = self._get_or_create_user_from_email(email_data)
+                if not user:
+                    return None
+                
+                comment = WorkOrderComment.objects.create(
+                    work_order=work_order,
+                    author=user,
+                    comment=email_data['body'] or email_data['subject']
+                )
+                self._index_message_id(email_data, work_order)
+                return comment
+        except Exception as e:
+            logger.exception(f"Error adding reply to work order {work_order.ticket_number}: {e}")
+            self._forget_sender(email_data)
+            return None
+    
+    def _index_message_id(self, email_data, work_order):
+        """Remember an inbound Message-ID so replies to it find the work order"""
+        if email_data['message_id']:
+            EmailMessageIndex.objects.get_or_create(
+                message_id=email_data['message_id'][:255],
+                defaults={'work_order': work_order, 'direction': 'inbound'}
+            )
+    
+    def _prime_user_cache(self, emails):
+        """Load existing users for all senders in a batch with one query"""
+        addresses = {
+            email_data['sender_email'] for email_data in emails
+            if email_data['sender_email'] not in self._user_cache
+        }
+        if not addresses:
+            return
+        
+        # Senders without an account are cached as None so they are not
+        # looked up again; the lowest pk wins when an address is shared
+        self._user_cache.update(dict.fromkeys(addresses))
+        for user in User.objects.filter(email__in=addresses).order_by('-pk'):
+            self._user_cache[user.email] = user
+    
+    def _forget_sender(self, email_data):
+        """Drop a sender from the user cache after a rollback that may have undone their user"""
+        self._user_cache.pop(email_data['sender_email'], None)
     
     def _get_or_create_user_from_email(self, email_data):
         """Get or create user from email address"""
         try:
-            # Try to find existing user by email
-            try:
-                user = User.objects.get(email=email_data['sender_email'])
+            # Try the in-run cache first, then the database
+            sender_email = email_data['sender_email']
+            if sender_email in self._user_cache:
+                user = self._user_cache[sender_email]
+            else:
+                user = User.objects.filter(email=sender_email).order_by('pk').first()
+            if user:
+                self._user_cache[sender_email] = user
                 return user
-            except User.DoesNotExist:
-                pass
             
             # Create new user
             # Generate username from email
-            username = email_data['sender_email'].split('@')[0]
-            counter = 1
-            original_username = username
-            
-            while User.objects.filter(username=username).exists():
-                username = f"{original_username}_{counter}"
-                counter += 1
+            username = self._generate_unique_username(sender_email.split('@')[0])
             
             # Create user
             user = User.objects.create_user(
                 username=username,
-                email=email_data['sender_email'],
+                email=sender_email,
                 first_name=email_data['sender_name'].split()[0] if email_data['sender_name'] else '',
                 last_name=' '.join(email_data['sender_name'].split()[1:]) if email_data['sender_name'] and len(email_data['sender_name'].split()) > 1 else ''
             )
             
+            self._user_cache[sender_email] = user
             return user
         except Exception as e:
-            print(f"Error creating user from email: {e}")
+            logger.exception(f"Error creating user from email: {e}")
             return None
     
+    def _generate_unique_username(self, original_username):
+        """Return the first free username of the form name, name_1, name_2, ..."""
+        # Only the name and its numbered variants, not every username it starts
+        taken = set(
+            User.objects.filter(username__regex=rf'^{re.escape(original_username)}(_[0-9]+)?$')
+            .values_list('username', flat=True)
+        )
+        
+        username = original_username
+        counter = 1
+        while username in taken:
+            username = f"{original_username}_{counter}"
+            counter += 1
+        return username
+    
     def _send_confirmation_email(self, work_order, sender_email):
-        """Send confirmation email to the requester"""
+        """Queue a confirmation email to the requester"""
         try:
-            # Get email template
-            template = EmailTemplate.objects.filter(
-                template_type='ticket_created',
-                is_active=True
-            ).first()
+            # Render the custom template from the compiled template cache
+            rendered = render_notification('ticket_created', work_order)
             
-            if not template:
+            if not rendered:
                 # Use default template
-                subject = f"Ticket Created: {work_order.ticket_number}"
+                subject = f"Ticket Created: [{work_order.ticket_number}]"
                 body = f"""
 Dear {work_order.requester.first_name or 'User'},
 
@@ -377,49 +1035,62 @@ Best regards,
 IT Support Team
 """
             else:
-                # Use custom template
-                subject_template = Template(template.subject)
-                body_template = Template(template.body)
-                
-                context = Context({
-                    'ticket_number': work_order.ticket_number,
-                    'title': work_order.title,
-                    'status': work_order.get_status_display(),
-                    'priority': work_order.get_priority_display(),
-                    'requester': work_order.requester,
-                    'assigned_to': work_order.assigned_to,
-                    'created_at': work_order.created_at,
-                })
-                
-                subject = subject_template.render(context)
-                body = body_template.render(context)
+                subject, body = rendered
             
-            # Send email
-            send_mail(
-                subject=subject,
-                message=body,
-                from_email=getattr(settings, 'DEFAULT_FROM_EMAIL', 'noreply@example.com'),
-                recipient_list=[sender_email],
-                fail_silently=True
-            )
+            # Queue email; the outbox worker delivers it
+            queue_email(sender_email, subject, body, work_order=work_order)
             
         except Exception as e:
-            print(f"Error sending confirmation email: {e}")
+            logger.exception(f"Error queueing confirmation email: {e}")
 
 
-def process_all_email_accounts():
-    """Process emails for all active email accounts"""
-    active_accounts = EmailAccount.objects.filter(is_active=True)
+# EmailProcessor that parse_raw_email() parses with, one per process
+_parse_processor = None
+
+
+def parse_raw_email(data, max_size=None):
+    """
+    Parse raw message bytes into an email dict.
+    
+    A module-level function so that it can be handed to worker processes.
+    Each process builds its EmailProcessor on the first message it parses
+    and reuses it for the rest.
+    """
+    global _parse_processor
+    if _parse_processor is None:
+        _parse_processor = EmailProcessor(None)
+    return _parse_processor._parse_email(parse_message_bytes(data, max_size))
+
+
+def process_all_email_accounts(dry_run=False, retry_only=False, time_budget=None):
+    """
+    Process emails for all active email accounts.
+    
+    A ``time_budget`` is shared by all the accounts: each one drains its
+    backlog for whatever is left of it, and the accounts reached after it
+    ran out are skipped. The least recently processed accounts go first,
+    so that those are the first ones on the next run.
+    """
+    active_accounts = EmailAccount.objects.filter(is_active=True).order_by(
+        F('last_processed').asc(nulls_first=True), 'name'
+    )
+    deadline = time.monotonic() + time_budget if time_budget else None
     results = {}
     
     for account in active_accounts:
+        remaining = None
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                results[account.name] = {'skipped': 'The time budget ran out on other accounts'}
+                continue
         try:
-            processor = EmailProcessor(account)
-            result = processor.process_emails()
+            processor = EmailProcessor(account, dry_run=dry_run)
+            result = processor.process_emails(retry_only=retry_only, time_budget=remaining)
             processor.disconnect()
             results[account.name] = result
         except Exception as e:
-            print(f"Error processing emails for account {account.name}: {e}")
+            logger.exception(f"Error processing emails for account {account.name}: {e}")
             results[account.name] = {'error': str(e)}
     
     return results
@@ -1,9 +1,17 @@
 from django import forms
 from django.contrib.auth.models import User
+from .assignment import pick_assignee
 from .models import WorkOrder, WorkOrderComment, TaskType, TaskCategory
+from .reference import get_reference_data
 
 
 class WorkOrderForm(forms.ModelForm):
+    auto_assign = forms.BooleanField(
+        required=False,
+        label='Assign to the least-loaded technician',
+        help_text='Used when nobody is selected above'
+    )
+    
     class Meta:
         model = WorkOrder
         fields = [
@@ -27,13 +35,29 @@ class WorkOrderForm(forms.ModelForm):
         if user:
             self.instance.requester = user
         
-        # Filter assigned_to to only include staff users
+        # Filter assigned_to to only include staff users; the options are
+        # listed from the reference data cache, the queryset only validates
+        self.reference = get_reference_data()
         self.fields['assigned_to'].queryset = User.objects.filter(is_staff=True)
+        self.fields['assigned_to'].choices = [(user.pk, str(user)) for user in self.reference.staff_users]
         
         # Add Bootstrap classes
         for field_name, field in self.fields.items():
-            if field_name not in ['latitude', 'longitude']:
+            if field_name not in ['latitude', 'longitude', 'auto_assign']:
                 field.widget.attrs['class'] = 'form-control'
+        self.fields['auto_assign'].widget.attrs['class'] = 'form-check-input'
+    
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('auto_assign') and not cleaned_data.get('assigned_to'):
+            assignee = pick_assignee(
+                latitude=cleaned_data.get('latitude'),
+                longitude=cleaned_data.get('longitude'),
+                candidates=self.reference.active_staff_users()
+            )
+            if assignee:
+                cleaned_data['assigned_to'] = [assignee]
+        return cleaned_data
 
 
 class WorkOrderCommentForm(forms.ModelForm):
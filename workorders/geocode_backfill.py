@@ -0,0 +1,111 @@
+"""
+Fill in coordinates for work orders that only have a location name.
+
+Every distinct location is resolved once through the geocoding cache and
+the rate-limited client, and the coordinates are written back with
+bulk_update. Work orders that got coordinates are no longer selected and
+results stay cached, so an interrupted run simply picks up where it
+stopped.
+"""
+import time
+from collections import defaultdict
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .caching import bump_versions
+from .geocoding import GeocodingError, GeocodingRateLimited, geocode, normalize_location
+from .models import WorkOrder
+
+
+class GeocodeBackfill:
+    """Geocode the locations of work orders without coordinates"""
+
+    def __init__(self, batch_size=500, sleep=time.sleep):
+        self.batch_size = batch_size
+        # Waits for the rate limiter; replaceable in tests
+        self.sleep = sleep
+        self._pending = []
+        self.results = {
+            'locations': 0,
+            'resolved': 0,
+            'not_found': 0,
+            'errors': 0,
+            'updated': 0,
+        }
+
+    @staticmethod
+    def missing_coordinates():
+        return WorkOrder.objects.exclude(location_name='').filter(
+            Q(latitude__isnull=True) | Q(longitude__isnull=True)
+        )
+
+    def locations(self):
+        """Normalized location -> the location names written that way"""
+        names = self.missing_coordinates().values_list('location_name', flat=True).distinct()
+        locations = defaultdict(list)
+        for name in names:
+            key = normalize_location(name)
+            if key:
+                locations[key].append(name)
+        return locations
+
+    def run(self, limit=None, progress=None):
+        """
+        Resolve up to ``limit`` distinct locations. ``progress`` is called
+        with the running results after each location.
+        """
+        locations = sorted(self.locations().items())[:limit]
+        try:
+            for key, names in locations:
+                self.results['locations'] += 1
+                result = self._resolve(names[0])
+                if result:
+                    self.results['resolved'] += 1
+                    self._queue(names, result)
+                elif result is None:
+                    self.results['not_found'] += 1
+                if progress:
+                    progress(self.results, len(locations))
+        finally:
+            # Keep what was resolved even if the run is interrupted
+            self._flush()
+        return self.results
+
+    def _resolve(self, location_name):
+        """Geocode one location, waiting out the rate limit; False on errors"""
+        while True:
+            try:
+                return geocode(location_name)
+            except GeocodingRateLimited as e:
+                self.sleep(e.retry_after)
+            except GeocodingError:
+                self.results['errors'] += 1
+                return False
+
+    def _queue(self, names, result):
+        for work_order in self.missing_coordinates().filter(location_name__in=names).only('pk'):
+            work_order.latitude = result['latitude']
+            work_order.longitude = result['longitude']
+            work_order.geohash = work_order.compute_geohash()
+            self._pending.append(work_order)
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        # bulk_update sends no post_save, so no notifications or point
+        # awards are triggered by the backfill. It does not touch auto_now
+        # fields either; updated_at is set here so that pages keyed by it
+        # (ETags, cached list rows) show the new coordinates.
+        now = timezone.now()
+        for work_order in self._pending:
+            work_order.updated_at = now
+        with transaction.atomic():
+            WorkOrder.objects.bulk_update(
+                self._pending, ['latitude', 'longitude', 'geohash', 'updated_at'],
+                batch_size=self.batch_size
+            )
+            bump_versions('workorder', 'assignment')
+        self.results['updated'] += len(self._pending)
+        self._pending = []
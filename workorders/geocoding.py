@@ -0,0 +1,681 @@
+"""
+Geocoding of work order locations.
+
+Lookups go through the backends listed in GEOCODE_BACKENDS. Local ones,
+like the gazetteer of our own sites, are asked first and need no network.
+Results of the remote ones, including "not found" ones, are cached per normalized location
+string in the GeocodeCache table, with a small in-process LRU in front of
+it, so repeated lookups of the same address never reach the network.
+Lookups that do go out share one pooled HTTP session per process and a
+rate limit shared by every worker through the Django cache.
+
+ageocode() is the same lookup for async views: the cache is read with the
+async ORM and remote services are asked with an async HTTP client, so a
+slow service does not hold a worker thread while it answers.
+"""
+import asyncio
+import bisect
+import csv
+import itertools
+import logging
+import math
+import os
+import re
+import threading
+import time
+import weakref
+from array import array
+from collections import Counter, OrderedDict, defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .models import GeocodeCache
+
+
+NOMINATIM_URL = 'https://nominatim.openstreetmap.org/search'
+
+# Characters that do not change where a place is
+SEPARATORS_RE = re.compile(r'[\s,;]+')
+
+# Longest key stored in GeocodeCache; longer ones are only kept in memory
+MAX_QUERY_LENGTH = 255
+
+DEFAULT_BACKENDS = [
+    'workorders.geocoding.GazetteerBackend',
+    'workorders.geocoding.NominatimBackend',
+]
+
+logger = logging.getLogger('workorders.geocoding')
+
+
+class GeocodingError(Exception):
+    """The geocoding service could not be asked; nothing is cached"""
+
+
+class GeocodingRateLimited(GeocodingError):
+    """No request may be sent right now; try again after ``retry_after`` seconds"""
+
+    def __init__(self, retry_after):
+        self.retry_after = max(1, math.ceil(retry_after))
+        super().__init__(
+            f'Too many location lookups right now. Please try again in {self.retry_after} seconds.'
+        )
+
+
+def normalize_location(location_name):
+    """The cache key of a location: case, spacing and separators do not matter"""
+    return SEPARATORS_RE.sub(' ', location_name.casefold()).strip(' .')
+
+
+class LRUCache:
+    """Thread-safe least-recently-used mapping whose entries expire"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # key -> (expiry on the monotonic clock, value)
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """Return (True, value) for a live entry, (False, None) otherwise"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def get_cache_ttl(found):
+    """Seconds a result stays cached; "not found" is kept for less time"""
+    if found:
+        return getattr(settings, 'GEOCODE_CACHE_TTL', 30 * 24 * 3600)
+    return getattr(settings, 'GEOCODE_NEGATIVE_CACHE_TTL', 24 * 3600)
+
+
+recent_results = LRUCache(getattr(settings, 'GEOCODE_LRU_SIZE', 1024))
+
+
+def geocode(location_name):
+    """
+    Return {'latitude', 'longitude', 'display_name'} for a location, or
+    None if no geocoding backend knows it.
+
+    Raises GeocodingError when a remote service cannot be reached and no
+    other backend found the location.
+    """
+    key = normalize_location(location_name)
+    if not key:
+        return None
+
+    hit, result = search_locally(key, location_name)
+    if hit:
+        return result
+
+    now = timezone.now()
+    entry = None
+    if len(key) <= MAX_QUERY_LENGTH:
+        entry = GeocodeCache.objects.filter(query=key, expires_at__gt=now).first()
+    if entry:
+        return cached_result(key, entry, now)
+
+    error = None
+    for backend in get_backends():
+        if backend.local:
+            continue
+        try:
+            result = backend.search(location_name.strip())
+        except GeocodingError as e:
+            error = error or e
+            continue
+        if result:
+            break
+    if not result and error:
+        # "Not found" is only cached when every service could be asked
+        raise error
+    store_result(key, result)
+    return result
+
+
+async def ageocode(location_name):
+    """geocode() for async views"""
+    key = normalize_location(location_name)
+    if not key:
+        return None
+
+    hit, result = search_locally(key, location_name)
+    if hit:
+        return result
+
+    now = timezone.now()
+    entry = None
+    if len(key) <= MAX_QUERY_LENGTH:
+        entry = await GeocodeCache.objects.filter(query=key, expires_at__gt=now).afirst()
+    if entry:
+        return cached_result(key, entry, now)
+
+    error = None
+    for backend in get_backends():
+        if backend.local:
+            continue
+        try:
+            result = await backend.asearch(location_name.strip())
+        except GeocodingError as e:
+            error = error or e
+            continue
+        if result:
+            break
+    if not result and error:
+        raise error
+    await astore_result(key, result)
+    return result
+
+
+def search_locally(key, location_name):
+    """
+    Look a location up in memory: returns (True, result) when a local
+    backend found it or the LRU has it, (False, None) otherwise.
+    """
+    # Local backends answer faster than the cache and their data can
+    # change at any time, so they are asked first and never cached
+    for backend in get_backends():
+        if backend.local:
+            result = backend.search(location_name)
+            if result:
+                return True, result
+    return recent_results.get(key)
+
+
+def cached_result(key, entry, now):
+    """The result stored in a GeocodeCache entry, remembered in the LRU"""
+    result = {
+        'latitude': entry.latitude,
+        'longitude': entry.longitude,
+        'display_name': entry.display_name,
+    } if entry.found else None
+    ttl = min(get_cache_ttl(entry.found), (entry.expires_at - now).total_seconds())
+    recent_results.set(key, result, ttl)
+    return result
+
+
+def cache_defaults(result, ttl):
+    """GeocodeCache fields for a lookup result"""
+    return {
+        'found': result is not None,
+        'latitude': result['latitude'] if result else None,
+        'longitude': result['longitude'] if result else None,
+        'display_name': result['display_name'][:500] if result else '',
+        'expires_at': timezone.now() + timedelta(seconds=ttl),
+    }
+
+
+def store_result(key, result):
+    """Cache a lookup result, or None for "not found", under a normalized key"""
+    ttl = get_cache_ttl(result is not None)
+    recent_results.set(key, result, ttl)
+    if len(key) <= MAX_QUERY_LENGTH:
+        GeocodeCache.objects.update_or_create(query=key, defaults=cache_defaults(result, ttl))
+
+
+async def astore_result(key, result):
+    """store_result() for async code"""
+    ttl = get_cache_ttl(result is not None)
+    recent_results.set(key, result, ttl)
+    if len(key) <= MAX_QUERY_LENGTH:
+        await GeocodeCache.objects.aupdate_or_create(query=key, defaults=cache_defaults(result, ttl))
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every worker process through the Django cache.
+
+    Time is cut into slots of ``1 / rate`` seconds, each worth one token.
+    Taking a token claims the oldest free slot among the current one and
+    the ``burst - 1`` before it with cache.add(), which every cache backend
+    does atomically (SET NX on Redis), so workers need no lock. Past slots
+    left unclaimed are the tokens saved up while idle, so at most ``burst``
+    requests go out at once and about ``burst + rate * t`` in any ``t``
+    seconds; a fixed window refilled all at once would let twice ``burst``
+    through across its boundary.
+    """
+
+    def __init__(self, key, rate, burst=1):
+        self.key = key
+        self.rate = rate
+        self.burst = burst
+
+    @property
+    def interval(self):
+        return 1 / self.rate
+
+    def take(self):
+        """Take a token; returns 0, or the seconds to wait for the next one"""
+        now = time.time()
+        paused_until = cache.get(f'{self.key}:paused')
+        if paused_until and paused_until > now:
+            return paused_until - now
+
+        keys, timeout = self._slots(now)
+        claimed = cache.get_many(keys)
+        for key in keys:
+            if key not in claimed and cache.add(key, 1, timeout=timeout):
+                return 0
+        return self._wait(now)
+
+    async def atake(self):
+        """take() for async code"""
+        now = time.time()
+        paused_until = await cache.aget(f'{self.key}:paused')
+        if paused_until and paused_until > now:
+            return paused_until - now
+
+        keys, timeout = self._slots(now)
+        claimed = await cache.aget_many(keys)
+        for key in keys:
+            if key not in claimed and await cache.aadd(key, 1, timeout=timeout):
+                return 0
+        return self._wait(now)
+
+    def _slots(self, now):
+        """Cache keys of the slots a token can be taken from, oldest first, and their timeout"""
+        current = int(now // self.interval)
+        keys = [f'{self.key}:{slot}' for slot in range(current - self.burst + 1, current + 1)]
+        return keys, math.ceil(self.burst * self.interval) + 1
+
+    def _wait(self, now):
+        """Seconds until the next slot starts"""
+        return (int(now // self.interval) + 1) * self.interval - now
+
+    def pause(self, seconds):
+        """Stop handing out tokens, e.g. when the service asks us to back off"""
+        cache.set(f'{self.key}:paused', time.time() + seconds, timeout=math.ceil(seconds) + 1)
+
+    async def apause(self, seconds):
+        await cache.aset(f'{self.key}:paused', time.time() + seconds, timeout=math.ceil(seconds) + 1)
+
+
+class GeocodingClient:
+    """
+    Nominatim search client for one process.
+
+    Requests go through a pooled requests.Session that keeps connections
+    alive, and each one needs a token from the shared RateLimiter. When
+    there is none the client raises GeocodingRateLimited at once instead
+    of waiting for it. asearch() does the same with an httpx.AsyncClient
+    per event loop, which is only worth it on the long-lived loop of an
+    ASGI server: each client stays open for as long as its loop exists.
+    """
+
+    def __init__(self, url=None, rate=None, burst=None, timeout=None):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.url = url or getattr(settings, 'GEOCODE_URL', NOMINATIM_URL)
+        # Nominatim's usage policy allows one request per second
+        self.limiter = RateLimiter(
+            'workorders:geocode:tokens',
+            rate=rate or getattr(settings, 'GEOCODE_RATE_LIMIT', 1),
+            burst=burst or getattr(settings, 'GEOCODE_BURST', 1),
+        )
+        self.timeout = timeout or getattr(settings, 'GEOCODE_TIMEOUT', 5)
+        self.headers = {
+            'User-Agent': getattr(settings, 'GEOCODE_USER_AGENT', 'IT-Support-System/1.0 (Django Application)'),
+            'Accept': 'application/json',
+        }
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=10, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # Event loop -> httpx.AsyncClient; a client only works on its own loop
+        self._async_sessions = weakref.WeakKeyDictionary()
+
+    def params(self, location_name):
+        return {'format': 'json', 'q': location_name, 'limit': 1, 'addressdetails': 1}
+
+    def search(self, location_name):
+        """Return the best match for a location, or None if there is none"""
+        import requests
+
+        wait = self.limiter.take()
+        if wait:
+            raise GeocodingRateLimited(wait)
+
+        try:
+            response = self.session.get(self.url, params=self.params(location_name), timeout=self.timeout)
+        except requests.exceptions.Timeout:
+            raise GeocodingError('Request timed out. Please try again.')
+        except requests.exceptions.ConnectionError:
+            raise GeocodingError(
+                'Could not connect to geocoding service. Please check your internet connection.'
+            )
+        except requests.exceptions.RequestException as e:
+            raise GeocodingError(f'Network error: {str(e)}')
+
+        retry_after = self.throttled_for(response)
+        if retry_after is not None:
+            # Throttled: make every worker back off, not just this one
+            self.limiter.pause(retry_after)
+            raise GeocodingRateLimited(retry_after)
+        return self.parse(response, location_name)
+
+    async def asearch(self, location_name):
+        """search() for async code"""
+        import httpx
+
+        wait = await self.limiter.atake()
+        if wait:
+            raise GeocodingRateLimited(wait)
+
+        try:
+            response = await self.async_session().get(self.url, params=self.params(location_name))
+        except httpx.TimeoutException:
+            raise GeocodingError('Request timed out. Please try again.')
+        except httpx.NetworkError:
+            raise GeocodingError(
+                'Could not connect to geocoding service. Please check your internet connection.'
+            )
+        except httpx.HTTPError as e:
+            raise GeocodingError(f'Network error: {str(e)}')
+
+        retry_after = self.throttled_for(response)
+        if retry_after is not None:
+            await self.limiter.apause(retry_after)
+            raise GeocodingRateLimited(retry_after)
+        return self.parse(response, location_name)
+
+    def async_session(self):
+        """The pooled httpx.AsyncClient of the running event loop"""
+        import httpx
+
+        loop = asyncio.get_running_loop()
+        session = self._async_sessions.get(loop)
+        if session is None:
+            session = httpx.AsyncClient(
+                headers=self.headers,
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=10, max_keepalive_connections=10),
+            )
+            self._async_sessions[loop] = session
+        return session
+
+    @staticmethod
+    def throttled_for(response):
+        """Seconds a 429 or 503 response asks us to wait, None for other responses"""
+        if response.status_code not in (429, 503):
+            return None
+        try:
+            return float(response.headers.get('Retry-After', 60))
+        except ValueError:
+            return 60
+
+    @staticmethod
+    def parse(response, location_name):
+        """The best match in a requests or httpx response"""
+        if response.status_code != 200:
+            raise GeocodingError(f'Geocoding service returned status {response.status_code}')
+
+        try:
+            data = response.json()
+            if not data:
+                return None
+            location = data[0]
+            return {
+                'latitude': float(location['lat']),
+                'longitude': float(location['lon']),
+                'display_name': location.get('display_name', location_name),
+            }
+        except (ValueError, KeyError, IndexError) as e:
+            raise GeocodingError(f'Invalid response from geocoding service: {str(e)}')
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """The process-wide GeocodingClient"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = GeocodingClient()
+        return _client
+
+
+class NominatimBackend:
+    """
+    Geocoding backend asking the remote service through get_client().
+
+    Remote backends provide search() and, for ageocode(), asearch();
+    local ones only search(), which must not wait on the network.
+    """
+
+    local = False
+
+    def search(self, location_name):
+        return get_client().search(location_name)
+
+    async def asearch(self, location_name):
+        return await get_client().asearch(location_name)
+
+
+def trigrams(key):
+    """The three-letter pieces of each word, padded as in PostgreSQL's pg_trgm"""
+    grams = set()
+    for word in key.split():
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class Gazetteer:
+    """
+    In-memory index of known places.
+
+    A name is found by its normalized spelling, else by the best trigram
+    similarity, which also covers typos. The longest known name the query
+    starts with ("Building A, 3rd floor"), or else a unique known name
+    starting with the query, breaks ties between equally similar names
+    and is the answer when no name is similar enough; the beginning of
+    several known names is not guessed at. Short words and numbers, like
+    building letters and floor numbers, are never corrected: "Building C"
+    does not find "Building A".
+    Names are kept once in a sorted list; the trigram postings are arrays
+    of positions in it.
+    """
+
+    def __init__(self, places=(), min_similarity=0.6):
+        self.min_similarity = min_similarity
+        by_key = {}
+        for name, result in places:
+            key = normalize_location(name)
+            if key:
+                by_key.setdefault(key, result)
+        self.keys = sorted(by_key)
+        self.results = [by_key[key] for key in self.keys]
+        self._positions = {key: i for i, key in enumerate(self.keys)}
+        self._trigram_counts = array('H')
+        postings = defaultdict(lambda: array('I'))
+        for i, key in enumerate(self.keys):
+            grams = trigrams(key)
+            self._trigram_counts.append(min(len(grams), 0xFFFF))
+            for gram in grams:
+                postings[gram].append(i)
+        self._postings = dict(postings)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def from_csv(cls, path, **kwargs):
+        """
+        Load a CSV file with a header row and the columns name, latitude,
+        longitude and optionally display_name. Rows that cannot be read
+        are logged and skipped.
+        """
+        places = []
+        with open(path, newline='', encoding='utf-8') as f:
+            for line, row in enumerate(csv.DictReader(f), 2):
+                try:
+                    name = row['name'].strip()
+                    result = {
+                        'latitude': float(row['latitude']),
+                        'longitude': float(row['longitude']),
+                        'display_name': (row.get('display_name') or '').strip() or name,
+                    }
+                except (KeyError, TypeError, ValueError, AttributeError):
+                    logger.warning(f'Skipping line {line} of gazetteer {path}: {row}')
+                    continue
+                places.append((name, result))
+        return cls(places, **kwargs)
+
+    def search(self, location_name):
+        """Return the place a location name refers to, or None"""
+        key = normalize_location(location_name)
+        if not key:
+            return None
+        i = self._lookup(key)
+        return dict(self.results[i]) if i is not None else None
+
+    def _lookup(self, key):
+        if key in self._positions:
+            return self._positions[key]
+        prefixes = self._prefix_matches(key)
+        if len(prefixes) > 1:
+            # The beginning of several places: do not guess
+            return None
+        prefix = prefixes[0] if prefixes else None
+        similar = self._most_similar(key, prefix)
+        return similar if similar is not None else prefix
+
+    def _prefix_matches(self, key):
+        # A known place followed by details such as the floor or room
+        end = key.rfind(' ')
+        while end > 0:
+            if key[:end] in self._positions:
+                return [self._positions[key[:end]]]
+            end = key.rfind(' ', 0, end)
+
+        # The beginning of known places
+        if len(key) < 3:
+            return []
+        start = bisect.bisect_left(self.keys, key)
+        return range(start, bisect.bisect_left(self.keys, key + '\uffff', start))
+
+    def _most_similar(self, key, preferred=None):
+        grams = trigrams(key)
+        shared = Counter(itertools.chain.from_iterable(self._postings.get(gram, ()) for gram in grams))
+        # Similarity can be no higher than the share of the query's trigrams found
+        min_count = self.min_similarity * len(grams)
+        exact_words = {word for word in key.split() if len(word) < 4 or any(c.isdigit() for c in word)}
+        best_similarity, best = 0, []
+        for i, count in shared.items():
+            if count < min_count:
+                continue
+            similarity = count / (len(grams) + self._trigram_counts[i] - count)
+            if similarity < self.min_similarity or similarity < best_similarity:
+                continue
+            if exact_words and not exact_words.issubset(self.keys[i].split()):
+                continue
+            if similarity > best_similarity:
+                best_similarity, best = similarity, [i]
+            else:
+                best.append(i)
+        if preferred in best:
+            return preferred
+        # Two places are as close as each other: do not guess
+        if best and all(self.results[i] == self.results[best[0]] for i in best):
+            return best[0]
+        return None
+
+
+NOT_LOADED = object()
+
+
+class GazetteerBackend:
+    """
+    Local geocoding backend for our own sites, buildings and cities.
+
+    The CSV file named by GEOCODE_GAZETTEER_PATH is loaded on first use
+    and again whenever it changes. Without one the backend knows nothing.
+    """
+
+    local = True
+
+    def __init__(self, path=None):
+        self.path = path or getattr(settings, 'GEOCODE_GAZETTEER_PATH', '')
+        self.min_similarity = getattr(settings, 'GEOCODE_GAZETTEER_MIN_SIMILARITY', 0.6)
+        self._lock = threading.Lock()
+        self._gazetteer = Gazetteer()
+        # Modification time of the loaded file; None if it could not be read
+        self._mtime = NOT_LOADED
+
+    @property
+    def gazetteer(self):
+        if not self.path:
+            return self._gazetteer
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    self._load(mtime)
+        return self._gazetteer
+
+    def _load(self, mtime):
+        if mtime is None:
+            logger.warning(f'Gazetteer {self.path} cannot be read')
+            self._gazetteer = Gazetteer()
+        else:
+            try:
+                self._gazetteer = Gazetteer.from_csv(self.path, min_similarity=self.min_similarity)
+            except (OSError, UnicodeDecodeError, csv.Error) as e:
+                logger.warning(f'Gazetteer {self.path} cannot be read: {e}')
+                self._gazetteer = Gazetteer()
+            else:
+                logger.info(f'Loaded {len(self._gazetteer)} places from gazetteer {self.path}')
+        self._mtime = mtime
+
+    def search(self, location_name):
+        return self.gazetteer.search(location_name)
+
+
+_backends = None
+_backends_lock = threading.Lock()
+
+
+def get_backends():
+    """The process-wide geocoding backends, in the order they are asked"""
+    global _backends
+    with _backends_lock:
+        if _backends is None:
+            _backends = [
+                import_string(path)()
+                for path in getattr(settings, 'GEOCODE_BACKENDS', DEFAULT_BACKENDS)
+            ]
+        return _backends
+
+
+def reset_backends():
+    """Build the backends again from the settings on next use"""
+    global _backends
+    with _backends_lock:
+        _backends = None
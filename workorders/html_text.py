@@ -0,0 +1,134 @@
+"""
+HTML to plain text conversion for email bodies.
+
+This is not faster than the tag-stripping regex it replaced. On
+well-formed bodies it does more work (dropping styles and scripts,
+decoding entities, placing line breaks) and takes roughly five times as
+long; only bodies several times larger than the output cap come out
+ahead, because just their start is converted. What it buys is readable
+tickets and a linear worst case: the old regex was quadratic on text with
+unclosed '<', which took close to a second on a 120 kB body.
+"""
+import html
+import re
+from itertools import chain, repeat
+
+
+# Elements whose content is never shown to the reader
+SKIPPED_TAGS = (
+    'head', 'style', 'script', 'noscript', 'template', 'title', 'xml', 'svg', 'object',
+)
+
+# Elements that start on a new line, and those set off by a blank line
+LINE_TAGS = frozenset([
+    'address', 'br', 'dd', 'div', 'dt', 'footer', 'header', 'hr', 'li', 'section', 'tr',
+])
+PARAGRAPH_TAGS = frozenset([
+    'blockquote', 'dl', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ol', 'p', 'pre', 'table', 'ul',
+])
+
+# Placeholders for line breaks until the text is assembled; source line
+# breaks are only whitespace, so real '\n' cannot be used before the end
+LINE_BREAK = '\x01'
+PARAGRAPH_BREAK = '\x02'
+
+# What each tag is replaced with; any other tag is dropped
+TAG_TEXT = {'li': LINE_BREAK + '- ', 'td': ' ', '/td': ' ', 'th': ' ', '/th': ' '}
+for name in LINE_TAGS:
+    TAG_TEXT.setdefault(name, LINE_BREAK)
+    TAG_TEXT['/' + name] = LINE_BREAK
+for name in PARAGRAPH_TAGS:
+    TAG_TEXT[name] = TAG_TEXT['/' + name] = PARAGRAPH_BREAK
+
+# One split of the document into text and markup. Ordinary tags, by far the
+# most common markup, are the first alternative. None of the alternatives
+# can rescan the rest of the document on malformed input: tags stop at the
+# next '<', and comments and skipped elements left open simply run to the
+# end (or, for skipped elements, to <body>), so the split stays linear.
+SPLIT_RE = re.compile(
+    r'''
+    <(?:
+        (?P<tag>/[a-zA-Z][a-zA-Z0-9:-]*|(?!(?i:%(skipped)s)\b)[a-zA-Z][a-zA-Z0-9:-]*)[^<>]*>
+        | !--[^-]*(?:-(?!->)[^-]*)*(?:-->)?
+        | (?i:(?P<skipped>%(skipped)s))\b[^<>]*>
+          [^<]*(?:<(?!/(?i:(?P=skipped))\s*>|(?i:body)\b)[^<]*)*
+          (?:</(?i:(?P=skipped))\s*>)?
+        | [!?][^<>]*>
+    )
+    ''' % {'skipped': '|'.join(SKIPPED_TAGS)},
+    re.VERBOSE,
+)
+
+# Common entities, replaced without html.unescape()'s call per reference
+COMMON_ENTITIES = (
+    ('&nbsp;', ' '), ('&quot;', '"'), ('&lt;', '<'), ('&gt;', '>'), ('&#39;', "'"),
+)
+
+PLACEHOLDERS = str.maketrans('', '', LINE_BREAK + PARAGRAPH_BREAK)
+
+# Characters of HTML per character of text assumed when only the start of
+# a long body is converted; Outlook mail is about 3
+MARKUP_RATIO = 4
+
+
+def convert(html_body):
+    """Text of a whole HTML document, without placeholder characters in it"""
+    parts = SPLIT_RE.split(html_body)
+    # parts is text, tag name, skipped element name, text, ...; every
+    # step below runs per tag inside C code, not in a Python callback
+    names = parts[1::3]
+    tag_text = {name: TAG_TEXT.get(name.lower(), '') for name in set(names) if name}
+    text = ''.join(chain.from_iterable(zip(parts[0::3], map(tag_text.get, names, repeat('')))))
+    text += parts[-1]
+
+    if '&' in text:
+        for entity, character in COMMON_ENTITIES:
+            text = text.replace(entity, character)
+        if text.count('&') == text.count('&amp;'):
+            text = text.replace('&amp;', '&')
+        else:
+            # Character references to control characters decode to nothing
+            text = html.unescape(text)
+
+    # Line breaks in the HTML source are just whitespace
+    text = ' '.join(text.split())
+    for placeholder in (LINE_BREAK, PARAGRAPH_BREAK):
+        text = text.replace(' ' + placeholder, placeholder).replace(placeholder + ' ', placeholder)
+    # Breaks that follow each other merge into the largest of them
+    while LINE_BREAK * 2 in text:
+        text = text.replace(LINE_BREAK * 2, LINE_BREAK)
+    text = text.replace(LINE_BREAK + PARAGRAPH_BREAK, PARAGRAPH_BREAK)
+    text = text.replace(PARAGRAPH_BREAK + LINE_BREAK, PARAGRAPH_BREAK)
+    while PARAGRAPH_BREAK * 2 in text:
+        text = text.replace(PARAGRAPH_BREAK * 2, PARAGRAPH_BREAK)
+    return text.replace(LINE_BREAK, '\n').replace(PARAGRAPH_BREAK, '\n\n').strip()
+
+
+def html_to_text(html_body, max_length=None):
+    """
+    Convert an HTML email body to readable plain text.
+
+    Styles, scripts and other non-content elements are dropped, entities
+    are decoded and whitespace is collapsed. With ``max_length``, only as
+    much of the start of a long body is converted as that needs.
+    """
+    if LINE_BREAK in html_body or PARAGRAPH_BREAK in html_body:
+        html_body = html_body.translate(PLACEHOLDERS)
+    if not max_length:
+        return convert(html_body)
+
+    size = MARKUP_RATIO * max_length
+    while size < len(html_body):
+        # Cut before a '<', or between words in plain text, so that no tag
+        # or entity is split: the start then converts as in the whole body
+        cut = html_body.rfind('<', 0, size)
+        if cut < 0:
+            cut = html_body.rfind(' ', 0, size)
+        if cut > 0:
+            text = convert(html_body[:cut])
+            if len(text) > max_length:
+                break
+        size *= 2
+    else:
+        text = convert(html_body)
+    return text[:max_length].rstrip()
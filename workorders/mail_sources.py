@@ -0,0 +1,95 @@
+"""
+Mailboxes read in bulk instead of polling a mail server for new emails.
+"""
+import mailbox
+from .email_service import EmailProcessor
+
+
+class LocalMailboxSource:
+    """Read raw messages from an mbox file or a Maildir directory"""
+
+    KINDS = {
+        'mbox': mailbox.mbox,
+        'maildir': mailbox.Maildir,
+    }
+
+    def __init__(self, kind, path):
+        if kind not in self.KINDS:
+            raise ValueError(f'Unknown mailbox type "{kind}" (expected one of: {", ".join(self.KINDS)})')
+        self.kind = kind
+        self.path = path
+
+    @classmethod
+    def from_spec(cls, spec):
+        """Build a source from a "mbox:/path" or "maildir:/path" string"""
+        kind, separator, path = spec.partition(':')
+        if not separator or not path:
+            raise ValueError(f'Invalid mailbox source "{spec}" (expected mbox:/path or maildir:/path)')
+        return cls(kind.lower(), path)
+
+    def __str__(self):
+        return f'{self.kind}:{self.path}'
+
+    def _open(self):
+        if self.kind == 'maildir':
+            return mailbox.Maildir(self.path, factory=None, create=False)
+        return mailbox.mbox(self.path, create=False)
+
+    def count(self):
+        """Number of messages in the mailbox"""
+        box = self._open()
+        try:
+            return len(box)
+        finally:
+            box.close()
+
+    def iter_raw_messages(self, limit=None):
+        """Yield the raw bytes of each message, oldest first"""
+        box = self._open()
+        try:
+            for index, key in enumerate(box.iterkeys()):
+                if limit is not None and index >= limit:
+                    break
+                yield box.get_bytes(key)
+        finally:
+            box.close()
+
+
+class ImapFolderSource:
+    """Read every message in a folder of an IMAP email account, read-only"""
+
+    # Messages requested per IMAP FETCH command
+    FETCH_BATCH_SIZE = 100
+
+    def __init__(self, email_account, folder):
+        self.email_account = email_account
+        self.folder = folder
+
+    def __str__(self):
+        return f'imap:{self.folder}'
+
+    def iter_raw_messages(self, limit=None, max_size=None):
+        """Yield the raw bytes of each message, oldest first"""
+        processor = EmailProcessor(self.email_account)
+        if not processor.connect():
+            raise ConnectionError(f'Could not connect to {self.email_account.host}')
+        try:
+            # Read-only, so the backfill never marks anything as seen
+            status, _ = processor.connection.select(self.folder, readonly=True)
+            if status != 'OK':
+                raise ValueError(f'Could not open IMAP folder "{self.folder}"')
+            status, data = processor.connection.search(None, 'ALL')
+            message_numbers = data[0].split()[:limit]
+
+            section = f'BODY.PEEK[]<0.{max_size}>' if max_size else 'BODY.PEEK[]'
+            for start in range(0, len(message_numbers), self.FETCH_BATCH_SIZE):
+                batch = message_numbers[start:start + self.FETCH_BATCH_SIZE]
+                status, data = processor.connection.fetch(b','.join(batch), f'({section})')
+                if status != 'OK':
+                    continue
+                # Message literals come back as (envelope, bytes) tuples
+                for item in data:
+                    if isinstance(item, tuple):
+                        yield item[1]
+        finally:
+            processor.disconnect()
@@ -0,0 +1,105 @@
+"""
+Django management command to import a mailbox's history as tickets.
+"""
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from workorders.email_backfill import EmailBackfill
+from workorders.email_service import get_max_message_size
+from workorders.mail_sources import ImapFolderSource, LocalMailboxSource
+from workorders.models import EmailAccount
+
+
+class Command(BaseCommand):
+    help = 'Import historical emails from a mailbox as tickets, parsing on all CPU cores'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--account',
+            type=str,
+            required=True,
+            help='Email account (by name) whose ticket defaults are used',
+        )
+        parser.add_argument(
+            '--source',
+            type=str,
+            required=True,
+            help='mbox:/path, maildir:/path, or imap:FOLDER on the account\'s server',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            help='Number of parser processes (default: number of CPU cores)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of emails written per transaction',
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            help='Maximum number of emails to read',
+        )
+        parser.add_argument(
+            '--status',
+            choices=['open', 'closed'],
+            default='closed',
+            help='Status given to imported tickets',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            account = EmailAccount.objects.get(name=options['account'])
+        except EmailAccount.DoesNotExist:
+            raise CommandError(f'Email account "{options["account"]}" not found')
+
+        if options['source'].startswith('imap:'):
+            source = ImapFolderSource(account, options['source'][len('imap:'):])
+            raw_messages = source.iter_raw_messages(options['limit'], get_max_message_size())
+        else:
+            try:
+                source = LocalMailboxSource.from_spec(options['source'])
+            except ValueError as e:
+                raise CommandError(str(e))
+            raw_messages = source.iter_raw_messages(options['limit'])
+
+        backfill = EmailBackfill(
+            account,
+            status=options['status'],
+            batch_size=options['batch_size'],
+            workers=options['workers'],
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Importing {source} for account {account.name} '
+                f'with {backfill.workers} parser processes at {timezone.now()}'
+            )
+        )
+
+        if not backfill.processor.acquire_lease():
+            raise CommandError(f'Another runner is processing account "{account.name}"')
+
+        start = time.perf_counter()
+
+        def progress(results):
+            elapsed = time.perf_counter() - start
+            self.stdout.write(
+                f'  {results["read"]} read, {results["created"]} created, '
+                f'{results["comments"]} comments, {results["duplicates"]} duplicates, '
+                f'{results["errors"]} errors ({results["read"] / elapsed:.0f} messages/s)'
+            )
+
+        try:
+            results = backfill.run(raw_messages, progress=progress)
+        finally:
+            backfill.processor.release_lease()
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write(self.style.SUCCESS(f'Backfill completed in {elapsed:.1f}s'))
+        self.stdout.write(f'  Read: {results["read"]}')
+        self.stdout.write(f'  Created: {results["created"]}')
+        self.stdout.write(f'  Replies added as comments: {results["comments"]}')
+        self.stdout.write(f'  Duplicates: {results["duplicates"]}')
+        self.stdout.write(f'  Errors: {results["errors"]}')
@@ -0,0 +1,101 @@
+"""
+Django management command to benchmark email ingestion against a local fake mail server.
+"""
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from workorders.email_service import EmailProcessor
+from workorders.tests_support.fake_mail_servers import FakeIMAPServer, FakePOP3Server, generate_messages
+from workorders.models import EmailAccount, TaskCategory, TaskType
+
+
+class QueryCounter:
+    """Database execute wrapper counting the queries that go through it"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure messages/second and queries/message of process_emails for generated '
+        'mailboxes served by an in-process IMAP or POP3 server. Every run is rolled back.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            type=int,
+            nargs='+',
+            default=[100, 1000, 10000],
+            help='Mailbox sizes to benchmark (default: 100 1000 10000)',
+        )
+        parser.add_argument(
+            '--protocol',
+            choices=['imap', 'pop3'],
+            default='imap',
+            help='Protocol of the fake mail server (default: imap)',
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Seed for the generated messages',
+        )
+        parser.add_argument(
+            '--stages',
+            action='store_true',
+            help='Also show the time spent in each pipeline stage',
+        )
+
+    def handle(self, *args, **options):
+        server_class = FakeIMAPServer if options['protocol'] == 'imap' else FakePOP3Server
+
+        self.stdout.write(
+            f'{"messages":>9} {"created":>8} {"comments":>9} {"seconds":>9} '
+            f'{"msg/s":>9} {"queries":>9} {"q/msg":>7}'
+        )
+        for size in options['sizes']:
+            messages = generate_messages(size, seed=options['seed'])
+            with server_class(messages) as server:
+                results, seconds, queries = self.run(server, options['protocol'], size)
+
+            self.stdout.write(
+                f'{size:>9} {results["created"]:>8} {results["comments"]:>9} {seconds:>9.2f} '
+                f'{size / seconds:>9.1f} {queries:>9} {queries / size:>7.2f}'
+            )
+            if options['stages']:
+                for name, stage in results['stages'].items():
+                    self.stdout.write(f'{"":>9} {name:<8} {stage["seconds"]:>9.3f}s')
+
+    def run(self, server, protocol, size):
+        """Process the whole mailbox once inside a transaction that is rolled back"""
+        counter = QueryCounter()
+        with transaction.atomic():
+            account = EmailAccount.objects.create(
+                name='Benchmark',
+                email_address='benchmark@example.invalid',
+                protocol=protocol,
+                host=server.host,
+                port=server.port,
+                username=server.username,
+                password=server.password,
+                use_ssl=False,
+                default_task_type=TaskType.objects.get_or_create(name='Email benchmark')[0],
+                default_task_category=TaskCategory.objects.get_or_create(name='Email benchmark')[0],
+            )
+
+            processor = EmailProcessor(account)
+            start = time.perf_counter()
+            with connection.execute_wrapper(counter):
+                results = processor.process_emails(limit=size)
+            seconds = time.perf_counter() - start
+            processor.disconnect()
+
+            transaction.set_rollback(True)
+
+        return results, seconds, counter.count
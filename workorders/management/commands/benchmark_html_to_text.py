@@ -0,0 +1,96 @@
+"""
+Django management command to benchmark HTML email body conversion.
+
+Timings are only meaningful on real mail, so a corpus directory is
+required; export a few hundred HTML messages from the helpdesk mailbox as
+.eml files.
+"""
+import re
+import time
+from email import message_from_binary_file, policy
+from pathlib import Path
+from django.core.management.base import BaseCommand
+from workorders.html_text import html_to_text
+
+
+def regex_html_to_text(html):
+    """The tag-stripping regex email bodies used to be converted with"""
+    return re.sub(r'<[^>]+>', '', html)
+
+
+def load_corpus(path):
+    """Read HTML bodies from .html/.htm files and the HTML parts of .eml files"""
+    samples = []
+    for file_path in sorted(Path(path).rglob('*')):
+        suffix = file_path.suffix.lower()
+        if suffix in ('.html', '.htm'):
+            samples.append((file_path.name, file_path.read_text(errors='ignore')))
+        elif suffix == '.eml':
+            with open(file_path, 'rb') as f:
+                message = message_from_binary_file(f, policy=policy.default)
+            part = message.get_body(preferencelist=('html',))
+            if part is not None:
+                samples.append((file_path.name, part.get_content()))
+    return samples
+
+
+class Command(BaseCommand):
+    help = 'Compare html_to_text with the old regex tag stripping'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--corpus',
+            type=str,
+            required=True,
+            help='Directory of .html/.htm/.eml files, e.g. messages exported from the helpdesk mailbox',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            help='Number of timed runs per sample; the fastest is reported',
+        )
+        parser.add_argument(
+            '--max-length',
+            type=int,
+            default=100000,
+            help='Output length cap passed to html_to_text',
+        )
+
+    def handle(self, *args, **options):
+        samples = load_corpus(options['corpus'])
+        if not samples:
+            self.stdout.write(self.style.ERROR(f'No HTML found in {options["corpus"]}'))
+            return
+
+        self.stdout.write(
+            f'{"sample":<28} {"size":>10} {"regex ms":>10} {"new ms":>10} {"new/regex":>10}'
+        )
+        regex_total = parser_total = 0
+        for name, html in samples:
+            regex_time = self.best_time(regex_html_to_text, html, options['repeat'])
+            parser_time = self.best_time(
+                lambda text: html_to_text(text, max_length=options['max_length']),
+                html,
+                options['repeat'],
+            )
+            self.stdout.write(
+                f'{name[:28]:<28} {len(html):>10} {regex_time * 1000:>10.2f} '
+                f'{parser_time * 1000:>10.2f} {parser_time / regex_time:>9.2f}x'
+            )
+            regex_total += regex_time
+            parser_total += parser_time
+        self.stdout.write(
+            f'{"total":<28} {sum(len(html) for _, html in samples):>10} '
+            f'{regex_total * 1000:>10.2f} {parser_total * 1000:>10.2f} '
+            f'{parser_total / regex_total:>9.2f}x'
+        )
+
+    def best_time(self, function, html, repeat):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function(html)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
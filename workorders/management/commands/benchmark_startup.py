@@ -0,0 +1,91 @@
+"""
+Django management command to measure the import time of manage.py startup.
+"""
+import re
+import statistics
+import subprocess
+import sys
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+# "import time: <self us> | <cumulative us> | <indented module name>"
+IMPORT_TIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$')
+
+# Slow libraries that must only be imported by the code that uses them
+LAZY_MODULES = ['folium', 'branca', 'jinja2', 'numpy', 'requests', 'httpx']
+
+
+def parse_import_times(output):
+    """Module name -> (cumulative microseconds, nesting depth) from -X importtime output"""
+    modules = {}
+    for line in output.splitlines():
+        match = IMPORT_TIME_RE.match(line)
+        if match:
+            modules[match.group(4)] = (int(match.group(2)), len(match.group(3)) // 2)
+    return modules
+
+
+class Command(BaseCommand):
+    help = (
+        'Run a manage.py command under python -X importtime and report the time spent '
+        'importing modules. Fails if a library that should be imported lazily is loaded.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--command',
+            default='check',
+            help='manage.py command line to start (default: check)',
+        )
+        parser.add_argument(
+            '--runs',
+            type=int,
+            default=5,
+            help='Number of startups to measure; the median is reported (default: 5)',
+        )
+        parser.add_argument(
+            '--top',
+            type=int,
+            default=10,
+            help='Number of slowest top-level imports to show (default: 10)',
+        )
+        parser.add_argument(
+            '--lazy',
+            nargs='*',
+            default=LAZY_MODULES,
+            help=f'Modules that must not be imported at startup (default: {" ".join(LAZY_MODULES)})',
+        )
+
+    def handle(self, *args, **options):
+        command = [sys.executable, '-X', 'importtime', str(settings.BASE_DIR / 'manage.py')]
+        command += options['command'].split()
+
+        totals = []
+        walls = []
+        for _ in range(max(1, options['runs'])):
+            start = time.perf_counter()
+            process = subprocess.run(command, capture_output=True, text=True)
+            walls.append(time.perf_counter() - start)
+            if process.returncode:
+                raise CommandError(f'{" ".join(command[3:])} failed:\n{process.stderr[-2000:]}')
+            modules = parse_import_times(process.stderr)
+            totals.append(sum(cumulative for cumulative, depth in modules.values() if depth == 0))
+
+        self.stdout.write(f'Command: manage.py {options["command"]}')
+        self.stdout.write(f'Startup wall time: {statistics.median(walls) * 1000:.1f} ms')
+        self.stdout.write(f'Startup import time: {statistics.median(totals) / 1000:.1f} ms')
+        self.stdout.write(f'Modules imported: {len(modules)}')
+
+        top_level = sorted(
+            ((cumulative, name) for name, (cumulative, depth) in modules.items() if depth == 0),
+            reverse=True
+        )
+        for cumulative, name in top_level[:options['top']]:
+            self.stdout.write(f'{cumulative / 1000:>9.1f} ms  {name}')
+
+        imported = [name for name in options['lazy'] if name in modules]
+        if imported:
+            raise CommandError(f'Imported at startup: {", ".join(imported)}')
+        self.stdout.write(self.style.SUCCESS('No lazily imported module was loaded at startup'))
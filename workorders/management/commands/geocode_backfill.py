@@ -0,0 +1,62 @@
+"""
+Django management command to add coordinates to work orders that only have a location name.
+"""
+import time
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from workorders.geocode_backfill import GeocodeBackfill
+
+
+class Command(BaseCommand):
+    help = (
+        'Geocode each distinct location of work orders without coordinates once, through the '
+        'geocoding cache and rate limit, and save the coordinates. Safe to interrupt and rerun.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--limit',
+            type=int,
+            help='Resolve at most this many distinct locations',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Work orders saved per bulk update (default: 500)',
+        )
+        parser.add_argument(
+            '--progress-every',
+            type=int,
+            default=25,
+            help='Report progress after this many locations (default: 25)',
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            self.style.SUCCESS(f'Starting geocoding backfill at {timezone.now()}')
+        )
+
+        backfill = GeocodeBackfill(batch_size=options['batch_size'])
+        start = time.perf_counter()
+
+        def progress(results, total):
+            if results['locations'] % options['progress_every'] and results['locations'] != total:
+                return
+            elapsed = time.perf_counter() - start
+            self.stdout.write(
+                f'  {results["locations"]}/{total} locations: {results["resolved"]} found, '
+                f'{results["not_found"]} not found, {results["errors"]} errors '
+                f'({results["locations"] / elapsed:.1f} locations/s)'
+            )
+
+        results = backfill.run(limit=options['limit'], progress=progress)
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Geocoding backfill completed at {timezone.now()}')
+        )
+        self.stdout.write(f'  Locations: {results["locations"]}')
+        self.stdout.write(f'  Found: {results["resolved"]}')
+        self.stdout.write(f'  Not found: {results["not_found"]}')
+        self.stdout.write(f'  Errors: {results["errors"]}')
+        self.stdout.write(f'  Work orders updated: {results["updated"]}')
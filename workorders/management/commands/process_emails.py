@@ -1,9 +1,10 @@
 """
 Django management command to process emails and create tickets.
 """
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
-from workorders.email_service import process_all_email_accounts
+from workorders.email_service import EmailProcessor, process_all_email_accounts
+from workorders.mail_sources import LocalMailboxSource
 from workorders.models import EmailAccount
 
 
@@ -21,38 +22,79 @@ class Command(BaseCommand):
             action='store_true',
             help='Show what would be processed without actually creating tickets',
         )
+        parser.add_argument(
+            '--source',
+            type=str,
+            help='Read emails from a local mailbox (mbox:/path or maildir:/path) '
+                 'instead of the mail server; requires --account for ticket defaults',
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            help='Maximum number of emails to read (default: 50 from a server, all from --source)',
+        )
+        parser.add_argument(
+            '--retry-only',
+            action='store_true',
+            help='Only retry failed emails that are due, without reading the mailbox',
+        )
+        parser.add_argument(
+            '--backlog',
+            type=int,
+            metavar='SECONDS',
+            help='Drain all waiting emails oldest first for up to SECONDS in total, shared by '
+                 'all accounts, in batches sized by the measured per-email time (--limit sets '
+                 'the first batch)',
+        )
 
     def handle(self, *args, **options):
         self.stdout.write(
             self.style.SUCCESS(f'Starting email processing at {timezone.now()}')
         )
 
+        if options['dry_run']:
+            self.stdout.write(
+                self.style.WARNING('DRY RUN MODE - No tickets will be created')
+            )
+
+        source = None
+        if options['source'] and options['retry_only']:
+            raise CommandError('--source cannot be combined with --retry-only')
+        if options['source'] and options['backlog']:
+            raise CommandError('--source already replays the whole mailbox oldest first; drop --backlog')
+        if options['source']:
+            if not options['account']:
+                raise CommandError('--source requires --account')
+            try:
+                source = LocalMailboxSource.from_spec(options['source'])
+            except ValueError as e:
+                raise CommandError(str(e))
+
         if options['account']:
             # Process specific account
             try:
                 account = EmailAccount.objects.get(name=options['account'])
-                if not account.is_active:
+                if not account.is_active and not source:
                     self.stdout.write(
                         self.style.WARNING(f'Account "{account.name}" is not active')
                     )
                     return
 
-                self.stdout.write(f'Processing emails for account: {account.name}')
-                
-                if options['dry_run']:
-                    self.stdout.write(
-                        self.style.WARNING('DRY RUN MODE - No tickets will be created')
-                    )
-                    # TODO: Implement dry run mode
-                    return
+                if source:
+                    self.stdout.write(f'Replaying {source} for account: {account.name}')
+                    limit = options['limit']
+                else:
+                    self.stdout.write(f'Processing emails for account: {account.name}')
+                    limit = options['limit'] or 50
 
-                from workorders.email_service import EmailProcessor
-                processor = EmailProcessor(account)
-                result = processor.process_emails()
+                processor = EmailProcessor(account, source=source, dry_run=options['dry_run'])
+                result = processor.process_emails(
+                    limit=limit, retry_only=options['retry_only'], time_budget=options['backlog']
+                )
                 processor.disconnect()
-                
+
                 self.display_results({account.name: result})
-                
+
             except EmailAccount.DoesNotExist:
                 self.stdout.write(
                     self.style.ERROR(f'Email account "{options["account"]}" not found')
@@ -60,15 +102,12 @@ class Command(BaseCommand):
                 return
         else:
             # Process all active accounts
-            if options['dry_run']:
-                self.stdout.write(
-                    self.style.WARNING('DRY RUN MODE - No tickets will be created')
-                )
-                # TODO: Implement dry run mode
-                return
-
             self.stdout.write('Processing emails for all active accounts...')
-            results = process_all_email_accounts()
+            results = process_all_email_accounts(
+                dry_run=options['dry_run'],
+                retry_only=options['retry_only'],
+                time_budget=options['backlog'],
+            )
             self.display_results(results)
 
         self.stdout.write(
@@ -79,7 +118,9 @@ class Command(BaseCommand):
         """Display processing results"""
         total_processed = 0
         total_created = 0
+        total_comments = 0
         total_duplicates = 0
+        total_retried = 0
         total_errors = 0
 
         for account_name, result in results.items():
@@ -88,18 +129,35 @@ class Command(BaseCommand):
                     self.style.ERROR(f'{account_name}: {result["error"]}')
                 )
                 continue
+            if 'skipped' in result:
+                self.stdout.write(
+                    self.style.WARNING(f'{account_name}: {result["skipped"]}')
+                )
+                continue
 
             self.stdout.write(
                 self.style.SUCCESS(f'{account_name}:')
             )
+            for item in result.get('items', []):
+                self.display_item(item)
             self.stdout.write(f'  Processed: {result["processed"]}')
             self.stdout.write(f'  Created: {result["created"]}')
+            self.stdout.write(f'  Replies added as comments: {result["comments"]}')
             self.stdout.write(f'  Duplicates: {result["duplicates"]}')
+            self.stdout.write(f'  Retried successfully: {result["retried"]}')
             self.stdout.write(f'  Errors: {result["errors"]}')
+            if 'backlog' in result:
+                self.stdout.write(
+                    f'  Remaining backlog: {result["backlog"]} '
+                    f'({result["seconds_per_message"] * 1000:.0f} ms per email)'
+                )
+            self.display_stages(result.get('stages', {}), result.get('seconds'))
 
             total_processed += result['processed']
             total_created += result['created']
+            total_comments += result['comments']
             total_duplicates += result['duplicates']
+            total_retried += result['retried']
             total_errors += result['errors']
 
         if len(results) > 1:
@@ -108,5 +166,36 @@ class Command(BaseCommand):
             )
             self.stdout.write(f'  Total Processed: {total_processed}')
             self.stdout.write(f'  Total Created: {total_created}')
+            self.stdout.write(f'  Total Replies added as comments: {total_comments}')
             self.stdout.write(f'  Total Duplicates: {total_duplicates}')
+            self.stdout.write(f'  Total Retried successfully: {total_retried}')
             self.stdout.write(f'  Total Errors: {total_errors}')
+
+    def display_item(self, item):
+        """Display what a dry run would have done with one email"""
+        descriptions = {
+            'create': f'would create {item["ticket_number"]}',
+            'comment': f'would add a comment to {item["ticket_number"]}',
+            'duplicate': 'already processed',
+            'error': 'would fail',
+        }
+        self.stdout.write(
+            f'  [{descriptions[item["action"]]}] {item["sender_email"]}: {item["subject"][:60]}'
+        )
+
+    def display_stages(self, stages, total_seconds=None):
+        """Display time spent and throughput per pipeline stage"""
+        if not stages:
+            return
+
+        self.stdout.write('  Throughput:')
+        for name, stage in stages.items():
+            rate = f'{stage["per_second"]:.1f}/s' if stage['per_second'] is not None else '-'
+            share = f'{stage["seconds"] / total_seconds:.0%}' if total_seconds else ''
+            size = f'{stage["bytes"] / 1024:.1f} KB' if stage.get('bytes') else ''
+            self.stdout.write(
+                f'    {name:<8} {stage["count"]:>7} in {stage["seconds"]:>8.3f}s {share:>5} '
+                f'{rate:>12} {size:>12}'.rstrip()
+            )
+        if total_seconds:
+            self.stdout.write(f'    {"total":<8} {"":>7}    {total_seconds:>8.3f}s')
@@ -0,0 +1,40 @@
+"""
+Django management command to deliver queued notification emails.
+"""
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from workorders.notifications import send_pending_emails
+
+
+class Command(BaseCommand):
+    help = 'Send pending notification emails from the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            help='Number of emails sent per batch over one SMTP connection',
+        )
+        parser.add_argument(
+            '--max-batches',
+            type=int,
+            help='Stop after this many batches (default: drain the outbox)',
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            self.style.SUCCESS(f'Starting notification delivery at {timezone.now()}')
+        )
+
+        results = send_pending_emails(
+            batch_size=options['batch_size'],
+            max_batches=options['max_batches'],
+        )
+
+        self.stdout.write(f'  Sent: {results["sent"]}')
+        self.stdout.write(f'  Deferred: {results["deferred"]}')
+        self.stdout.write(f'  Failed: {results["failed"]}')
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Notification delivery completed at {timezone.now()}')
+        )
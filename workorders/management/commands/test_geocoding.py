@@ -1,7 +1,5 @@
 from django.core.management.base import BaseCommand
-from django.contrib.auth.models import User
-from django.test import RequestFactory
-from workorders.views import geocode_location
+from workorders.geocoding import GeocodingError, geocode, get_client
 
 
 class Command(BaseCommand):
@@ -13,44 +11,32 @@ class Command(BaseCommand):
             type=str,
             help='Location to geocode',
         )
+        parser.add_argument(
+            '--no-cache',
+            action='store_true',
+            help='Ask the geocoding service even if the result is cached',
+        )
 
     def handle(self, *args, **options):
         location = options['location']
         
-        # Create a test user and request
-        user = User.objects.filter(is_staff=True).first()
-        if not user:
-            self.stdout.write(self.style.ERROR('No staff user found for testing'))
+        try:
+            if options['no_cache']:
+                result = get_client().search(location.strip())
+            else:
+                result = geocode(location)
+        except GeocodingError as e:
+            self.stdout.write(self.style.ERROR(f'Geocoding failed: {e}'))
             return
         
-        # Create a mock request
-        factory = RequestFactory()
-        request = factory.post('/geocode/', {'location_name': location})
-        request.user = user
-        
-        # Call the geocode function
-        response = geocode_location(request)
+        if result is None:
+            self.stdout.write(self.style.ERROR(f'Geocoding failed: No results found for "{location}"'))
+            return
         
-        # Parse and display the response
-        if hasattr(response, 'content'):
-            import json
-            try:
-                data = json.loads(response.content)
-                if data.get('success'):
-                    self.stdout.write(
-                        self.style.SUCCESS(
-                            f'Successfully found location: {data.get("display_name")}'
-                        )
-                    )
-                    self.stdout.write(f'Latitude: {data.get("latitude")}')
-                    self.stdout.write(f'Longitude: {data.get("longitude")}')
-                else:
-                    self.stdout.write(
-                        self.style.ERROR(f'Geocoding failed: {data.get("error")}')
-                    )
-            except json.JSONDecodeError:
-                self.stdout.write(
-                    self.style.ERROR(f'Invalid JSON response: {response.content}')
-                )
-        else:
-            self.stdout.write(self.style.ERROR('No response content'))
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Successfully found location: {result["display_name"]}'
+            )
+        )
+        self.stdout.write(f'Latitude: {result["latitude"]}')
+        self.stdout.write(f'Longitude: {result["longitude"]}')
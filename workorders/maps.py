@@ -0,0 +1,49 @@
+"""
+Map rendering with folium.
+
+folium pulls in jinja2, branca and numpy, which take longer to import than
+Django itself, so views import this module only when a map is drawn.
+"""
+import folium
+from .models import WorkOrder
+
+
+def create_work_order_map():
+    """Create a map with all work order locations"""
+    # Get work orders with location data
+    work_orders = WorkOrder.objects.filter(
+        latitude__isnull=False,
+        longitude__isnull=False
+    )
+    
+    if not work_orders.exists():
+        return None
+    
+    # Calculate center point
+    center_lat = sum(wo.latitude for wo in work_orders) / len(work_orders)
+    center_lng = sum(wo.longitude for wo in work_orders) / len(work_orders)
+    
+    # Create map
+    m = folium.Map(location=[center_lat, center_lng], zoom_start=10)
+    
+    # Add markers for each work order
+    for wo in work_orders:
+        color = {
+            'open': 'red',
+            'in_progress': 'orange',
+            'waiting': 'yellow',
+            'resolved': 'green',
+            'closed': 'blue'
+        }.get(wo.status, 'gray')
+        
+        folium.Marker(
+            [wo.latitude, wo.longitude],
+            popup=f"""<b>{wo.ticket_number}</b><br>
+                     {wo.title}<br>
+                     Status: {wo.get_status_display()}<br>
+                     Priority: {wo.get_priority_display()}""",
+            tooltip=wo.location_name,
+            icon=folium.Icon(color=color)
+        ).add_to(m)
+    
+    return m._repr_html_()
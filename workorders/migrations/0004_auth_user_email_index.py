@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """Index auth_user.email, which email ingestion uses to resolve senders."""
+
+    dependencies = [
+        ('workorders', '0003_multiple_assignees'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql='CREATE INDEX IF NOT EXISTS workorders_auth_user_email_idx ON auth_user (email);',
+            reverse_sql='DROP INDEX IF EXISTS workorders_auth_user_email_idx;',
+        ),
+    ]
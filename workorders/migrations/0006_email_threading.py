@@ -0,0 +1,34 @@
+# Generated by Django 5.2.4 on 2026-10-19 13:38
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workorders', '0005_outboundemail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboundemail',
+            name='message_id',
+            field=models.CharField(blank=True, help_text='Message-ID header the email is sent with', max_length=255),
+        ),
+        migrations.CreateModel(
+            name='EmailMessageIndex',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message_id', models.CharField(help_text='Email Message-ID header', max_length=255, unique=True)),
+                ('direction', models.CharField(choices=[('inbound', 'Inbound'), ('outbound', 'Outbound')], max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('work_order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='message_ids', to='workorders.workorder')),
+            ],
+            options={
+                'verbose_name': 'Email Message Index',
+                'verbose_name_plural': 'Email Message Index',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
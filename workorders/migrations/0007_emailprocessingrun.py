@@ -0,0 +1,40 @@
+# Generated by Django 5.2.4 on 2026-10-19 13:43
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workorders', '0006_email_threading'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailProcessingRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(blank=True, help_text='Local mailbox read instead of the mail server', max_length=500)),
+                ('dry_run', models.BooleanField(default=False)),
+                ('started_at', models.DateTimeField()),
+                ('duration_seconds', models.FloatField(default=0)),
+                ('fetched_messages', models.IntegerField(default=0)),
+                ('fetched_bytes', models.BigIntegerField(default=0)),
+                ('processed', models.IntegerField(default=0)),
+                ('created', models.IntegerField(default=0)),
+                ('comments', models.IntegerField(default=0)),
+                ('duplicates', models.IntegerField(default=0)),
+                ('errors', models.IntegerField(default=0)),
+                ('stages', models.JSONField(blank=True, default=dict)),
+                ('error', models.TextField(blank=True, help_text='Why the run failed or could not reach the mail server')),
+                ('email_account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='processing_runs', to='workorders.emailaccount')),
+            ],
+            options={
+                'verbose_name': 'Email Processing Run',
+                'verbose_name_plural': 'Email Processing Runs',
+                'ordering': ['-started_at'],
+                'indexes': [models.Index(fields=['email_account', 'started_at'], name='workorders__email_a_5fa42e_idx')],
+            },
+        ),
+    ]
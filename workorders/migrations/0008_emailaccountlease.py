@@ -0,0 +1,27 @@
+# Generated by Django 5.2.4 on 2026-10-19 13:53
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workorders', '0007_emailprocessingrun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailAccountLease',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('owner', models.CharField(blank=True, help_text='Runner holding the lease (host:pid:id)', max_length=255)),
+                ('expires_at', models.DateTimeField(blank=True, help_text='Other runners may take over after this time', null=True)),
+                ('email_account', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='lease', to='workorders.emailaccount')),
+            ],
+            options={
+                'verbose_name': 'Email Account Lease',
+                'verbose_name_plural': 'Email Account Leases',
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.4 on 2026-10-19 13:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workorders', '0008_emailaccountlease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='processedemail',
+            name='attempts',
+            field=models.IntegerField(default=0, help_text='Number of failed processing attempts'),
+        ),
+        migrations.AddField(
+            model_name='processedemail',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, help_text='When a failed email is retried; empty once given up', null=True),
+        ),
+        migrations.AddField(
+            model_name='processedemail',
+            name='retry_data',
+            field=models.JSONField(blank=True, default=dict, help_text='Parts of the parsed email not stored above, kept for retries'),
+        ),
+        migrations.AddIndex(
+            model_name='processedemail',
+            index=models.Index(fields=['processing_status', 'next_attempt_at'], name='workorders__process_84b6ea_idx'),
+        ),
+    ]
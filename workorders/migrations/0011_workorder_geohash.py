@@ -0,0 +1,74 @@
+# Generated by Django 5.2.4 on 2026-10-19 14:10
+
+from django.db import migrations, models
+
+
+# A copy of workorders.spatial.encode_geohash as of this migration, so that
+# later changes to that module cannot change what this migration writes
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def encode_geohash(latitude, longitude, precision=9):
+    """The geohash of a point"""
+    south, north = -90.0, 90.0
+    west, east = -180.0, 180.0
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        # Bits alternate between longitude and latitude, longitude first
+        if even:
+            middle = (west + east) / 2
+            bit = longitude >= middle
+            if bit:
+                west = middle
+            else:
+                east = middle
+        else:
+            middle = (south + north) / 2
+            bit = latitude >= middle
+            if bit:
+                south = middle
+            else:
+                north = middle
+        value = value * 2 + bit
+        bits += 1
+        even = not even
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bits = 0
+            value = 0
+    return ''.join(chars)
+
+
+def backfill_geohash(apps, schema_editor):
+    """Index the coordinates of existing work orders"""
+    WorkOrder = apps.get_model('workorders', 'WorkOrder')
+    located = WorkOrder.objects.filter(
+        latitude__isnull=False, longitude__isnull=False
+    ).only('latitude', 'longitude')
+    batch = []
+    for work_order in located.iterator(chunk_size=1000):
+        work_order.geohash = encode_geohash(work_order.latitude, work_order.longitude)
+        batch.append(work_order)
+        if len(batch) == 1000:
+            WorkOrder.objects.bulk_update(batch, ['geohash'])
+            batch = []
+    WorkOrder.objects.bulk_update(batch, ['geohash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workorders', '0010_geocodecache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='workorder',
+            name='geohash',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=12),
+        ),
+        migrations.RunPython(backfill_geohash, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-19 14:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workorders', '0011_workorder_geohash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailaccount',
+            name='auto_assign_least_loaded',
+            field=models.BooleanField(default=False, help_text='Without a fixed user, assign tickets to the staff member with the fewest open tickets'),
+        ),
+    ]
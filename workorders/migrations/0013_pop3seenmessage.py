@@ -0,0 +1,28 @@
+# Generated by Django 5.2.4 on 2026-10-19 14:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workorders', '0012_emailaccount_auto_assign_least_loaded'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='POP3SeenMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uid', models.CharField(help_text='Unique id the server lists the message under', max_length=70)),
+                ('seen_at', models.DateTimeField(auto_now_add=True)),
+                ('email_account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pop3_seen_messages', to='workorders.emailaccount')),
+            ],
+            options={
+                'verbose_name': 'POP3 Seen Message',
+                'verbose_name_plural': 'POP3 Seen Messages',
+                'unique_together': {('email_account', 'uid')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-19 15:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workorders', '0013_pop3seenmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pop3seenmessage',
+            name='error',
+            field=models.TextField(blank=True, help_text='Why the message could not be parsed, if it could not'),
+        ),
+    ]
@@ -7,6 +7,7 @@ from django.db.models.signals import post_save
 from django.dispatch import receiver
 from email_validator import validate_email, EmailNotValidError
 import logging
+from .spatial import encode_geohash
 
 
 class TaskType(models.Model):
@@ -74,6 +75,8 @@ class WorkOrder(models.Model):
     location_name = models.CharField(max_length=200, blank=True)
     latitude = models.FloatField(null=True, blank=True)
     longitude = models.FloatField(null=True, blank=True)
+    # Spatial index of the coordinates, kept in step by save(); see spatial.py
+    geohash = models.CharField(max_length=12, blank=True, db_index=True, editable=False)
     
     # Time Tracking
     created_at = models.DateTimeField(auto_now_add=True)
@@ -100,12 +103,36 @@ class WorkOrder(models.Model):
             self.resolved_at = timezone.now()
             self.calculate_points()
         
+        self.geohash = self.compute_geohash()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'latitude', 'longitude'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'geohash'}
+        
         super().save(*args, **kwargs)
+        # post_save handlers compared against the old status; now this one is stored
+        self._loaded_status = self.__dict__.get('status')
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # The status as stored (None if deferred), for the post_save handlers
+        # that act on status changes
+        instance._loaded_status = instance.__dict__.get('status')
+        return instance
+    
+    def compute_geohash(self):
+        """The geohash of the coordinates, empty without them"""
+        if self.latitude is None or self.longitude is None:
+            return ''
+        return encode_geohash(self.latitude, self.longitude)
     
     def calculate_points(self):
         """Calculate points based on task type, category, difficulty, and time to resolution"""
-        base_points = self.task_type.points_base
-        category_multiplier = self.task_category.multiplier
+        # Read from the reference data cache instead of two foreign key queries
+        from .reference import get_reference_data
+        reference = get_reference_data()
+        base_points = reference.task_type(self.task_type_id).points_base
+        category_multiplier = reference.task_category(self.task_category_id).multiplier
         difficulty_multiplier = self.difficulty_rating
         
         # Time bonus (completed within due date)
@@ -304,6 +331,7 @@ class EmailAccount(models.Model):
     default_task_category = models.ForeignKey(TaskCategory, on_delete=models.CASCADE, help_text="Default category for email tickets")
     default_priority = models.CharField(max_length=10, choices=WorkOrder.PRIORITY_CHOICES, default='medium')
     auto_assign_to = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, help_text="Automatically assign tickets to this user")
+    auto_assign_least_loaded = models.BooleanField(default=False, help_text="Without a fixed user, assign tickets to the staff member with the fewest open tickets")
     
     # Processing settings
     is_active = models.BooleanField(default=True, help_text="Enable/disable email processing for this account")
@@ -352,12 +380,20 @@ class ProcessedEmail(models.Model):
     ], default='success')
     processing_notes = models.TextField(blank=True, help_text="Notes about processing result")
     
+    # Retrying failed emails without fetching them again
+    attempts = models.IntegerField(default=0, help_text="Number of failed processing attempts")
+    next_attempt_at = models.DateTimeField(null=True, blank=True, help_text="When a failed email is retried; empty once given up")
+    retry_data = models.JSONField(default=dict, blank=True, help_text="Parts of the parsed email not stored above, kept for retries")
+    
     def __str__(self):
         return f"{self.sender_email} - {self.subject[:50]}"
     
     class Meta:
         ordering = ['-received_date']
         unique_together = ['email_account', 'message_id']
+        indexes = [
+            models.Index(fields=['processing_status', 'next_attempt_at']),
+        ]
         verbose_name = "Processed Email"
         verbose_name_plural = "Processed Emails"
 
@@ -388,3 +424,141 @@ class EmailTemplate(models.Model):
         unique_together = ['template_type']
         verbose_name = "Email Template"
         verbose_name_plural = "Email Templates"
+
+
+class OutboundEmail(models.Model):
+    """Outbox of notification emails waiting to be delivered"""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    ]
+    
+    recipient = models.EmailField()
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    message_id = models.CharField(max_length=255, blank=True, help_text="Message-ID header the email is sent with")
+    work_order = models.ForeignKey(WorkOrder, on_delete=models.SET_NULL, null=True, blank=True, related_name='outbound_emails')
+    
+    # Delivery state
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.IntegerField(default=0, help_text="Number of delivery attempts so far")
+    next_attempt_at = models.DateTimeField(default=timezone.now, help_text="Do not try to deliver before this time")
+    last_error = models.TextField(blank=True)
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    
+    def __str__(self):
+        return f"{self.recipient} - {self.subject[:50]}"
+    
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+        verbose_name = "Outbound Email"
+        verbose_name_plural = "Outbound Emails"
+
+
+class EmailMessageIndex(models.Model):
+    """Message-IDs of emails sent or received about a work order, used to thread replies"""
+    DIRECTION_CHOICES = [
+        ('inbound', 'Inbound'),
+        ('outbound', 'Outbound'),
+    ]
+    
+    message_id = models.CharField(max_length=255, unique=True, help_text="Email Message-ID header")
+    work_order = models.ForeignKey(WorkOrder, on_delete=models.CASCADE, related_name='message_ids')
+    direction = models.CharField(max_length=10, choices=DIRECTION_CHOICES)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f"{self.message_id} -> {self.work_order.ticket_number}"
+    
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name = "Email Message Index"
+        verbose_name_plural = "Email Message Index"
+
+
+class EmailProcessingRun(models.Model):
+    """Timings and counters of one email processing run for an account"""
+    email_account = models.ForeignKey(EmailAccount, on_delete=models.CASCADE, related_name='processing_runs')
+    source = models.CharField(max_length=500, blank=True, help_text="Local mailbox read instead of the mail server")
+    dry_run = models.BooleanField(default=False)
+    started_at = models.DateTimeField()
+    duration_seconds = models.FloatField(default=0)
+    
+    # Results
+    fetched_messages = models.IntegerField(default=0)
+    fetched_bytes = models.BigIntegerField(default=0)
+    processed = models.IntegerField(default=0)
+    created = models.IntegerField(default=0)
+    comments = models.IntegerField(default=0)
+    duplicates = models.IntegerField(default=0)
+    errors = models.IntegerField(default=0)
+    
+    # Stage -> {'seconds', 'count', 'per_second'[, 'bytes']}
+    stages = models.JSONField(default=dict, blank=True)
+    error = models.TextField(blank=True, help_text="Why the run failed or could not reach the mail server")
+    
+    def __str__(self):
+        return f"{self.email_account.name} - {self.started_at}"
+    
+    class Meta:
+        ordering = ['-started_at']
+        indexes = [
+            models.Index(fields=['email_account', 'started_at']),
+        ]
+        verbose_name = "Email Processing Run"
+        verbose_name_plural = "Email Processing Runs"
+
+
+class EmailAccountLease(models.Model):
+    """Which email processing runner owns an account, and until when"""
+    email_account = models.OneToOneField(EmailAccount, on_delete=models.CASCADE, related_name='lease')
+    owner = models.CharField(max_length=255, blank=True, help_text="Runner holding the lease (host:pid:id)")
+    expires_at = models.DateTimeField(null=True, blank=True, help_text="Other runners may take over after this time")
+    
+    def __str__(self):
+        return f"{self.email_account.name} - {self.owner or 'free'}"
+    
+    class Meta:
+        verbose_name = "Email Account Lease"
+        verbose_name_plural = "Email Account Leases"
+
+
+class POP3SeenMessage(models.Model):
+    """A message of a POP3 mailbox that was already handled, by its UIDL unique id"""
+    email_account = models.ForeignKey(EmailAccount, on_delete=models.CASCADE, related_name='pop3_seen_messages')
+    uid = models.CharField(max_length=70, help_text="Unique id the server lists the message under")
+    seen_at = models.DateTimeField(auto_now_add=True)
+    error = models.TextField(blank=True, help_text="Why the message could not be parsed, if it could not")
+    
+    def __str__(self):
+        return f"{self.email_account.name} - {self.uid}"
+    
+    class Meta:
+        unique_together = ['email_account', 'uid']
+        verbose_name = "POP3 Seen Message"
+        verbose_name_plural = "POP3 Seen Messages"
+
+
+class GeocodeCache(models.Model):
+    """Geocoding result for a normalized location string, including "not found" results"""
+    query = models.CharField(max_length=255, unique=True, help_text="Normalized location string")
+    found = models.BooleanField(default=True)
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+    display_name = models.CharField(max_length=500, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True, help_text="Looked up again after this time")
+    
+    def __str__(self):
+        return self.query
+    
+    class Meta:
+        ordering = ['query']
+        verbose_name = "Geocode Cache Entry"
+        verbose_name_plural = "Geocode Cache"
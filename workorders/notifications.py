@@ -0,0 +1,324 @@
+"""
+Outbound notification emails.
+
+Notifications are written to the OutboundEmail outbox while tickets are
+being created and delivered later by send_pending_emails(), so ticket
+ingestion never waits on the SMTP server.
+"""
+import smtplib
+import threading
+import time
+from datetime import timedelta
+from email.utils import make_msgid
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.core.mail.utils import DNS_NAME
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.template import Context, Template
+from django.utils import timezone
+from .models import EmailMessageIndex, EmailTemplate, OutboundEmail, WorkOrder
+
+
+# Errors that retrying will not fix; for SMTP reply errors the code decides
+PERMANENT_SMTP_ERRORS = (
+    smtplib.SMTPRecipientsRefused,
+    smtplib.SMTPSenderRefused,
+    smtplib.SMTPDataError,
+)
+
+
+# Template type sent when a ticket moves into a status
+STATUS_TEMPLATE_TYPES = {
+    'resolved': 'ticket_resolved',
+    'closed': 'ticket_closed',
+}
+
+def get_template_lookup_seconds():
+    """Seconds a process trusts its active templates before looking them up again"""
+    return getattr(settings, 'NOTIFICATION_TEMPLATE_LOOKUP_SECONDS', 60)
+
+
+class CompiledTemplateCache:
+    """
+    Compiled subject/body templates keyed by (template_type, updated_at).
+
+    Rendering a notification from a cached entry is just a render() call:
+    no query, no template parsing and no shared cache round trip.
+    EmailTemplate signals drop the active templates of the process that
+    changed them; other processes look theirs up again once they are
+    NOTIFICATION_TEMPLATE_LOOKUP_SECONDS old.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # template_type -> (template_type, updated_at) key, or None when the
+        # type has no active template
+        self._by_type = {}
+        # (template_type, updated_at) -> (subject Template, body Template)
+        self._compiled = {}
+        self._looked_up_at = None
+
+    def get(self, template_type):
+        """Return (subject, body) Templates for the active template, or None"""
+        now = time.monotonic()
+        with self._lock:
+            if self._looked_up_at is None or now - self._looked_up_at >= get_template_lookup_seconds():
+                self._by_type.clear()
+                self._looked_up_at = now
+            if template_type in self._by_type:
+                key = self._by_type[template_type]
+                return self._compiled[key] if key else None
+
+        template = EmailTemplate.objects.filter(
+            template_type=template_type,
+            is_active=True
+        ).first()
+
+        with self._lock:
+            if not template:
+                self._by_type[template_type] = None
+                return None
+
+            key = (template.template_type, template.updated_at)
+            compiled = self._compiled.get(key)
+            if compiled is None:
+                # Only re-parse when the template itself has changed
+                compiled = (Template(template.subject), Template(template.body))
+                for stale_key in [k for k in self._compiled if k[0] == template_type]:
+                    del self._compiled[stale_key]
+                self._compiled[key] = compiled
+            self._by_type[template_type] = key
+            return compiled
+
+    def invalidate(self):
+        """Look up the active templates again on the next render"""
+        with self._lock:
+            self._by_type.clear()
+
+
+compiled_templates = CompiledTemplateCache()
+
+
+def render_notification(template_type, work_order):
+    """
+    Render the active template of the given type for a work order.
+
+    Returns a (subject, body) tuple, or None when no template is active.
+    """
+    compiled = compiled_templates.get(template_type)
+    if not compiled:
+        return None
+
+    subject_template, body_template = compiled
+    context = Context({
+        'ticket_number': work_order.ticket_number,
+        'title': work_order.title,
+        'status': work_order.get_status_display(),
+        'priority': work_order.get_priority_display(),
+        'requester': work_order.requester,
+        'assigned_to': work_order.assigned_to,
+        'created_at': work_order.created_at,
+    })
+    return subject_template.render(context), body_template.render(context)
+
+
+def queue_email(recipient, subject, body, work_order=None):
+    """
+    Add a notification to the outbox.
+
+    The Message-ID is assigned now and indexed against the work order, so
+    replies to the notification are threaded back onto the ticket.
+    """
+    outbound = OutboundEmail.objects.create(
+        recipient=recipient,
+        subject=subject[:255],
+        body=body,
+        message_id=make_msgid(domain=DNS_NAME),
+        work_order=work_order,
+    )
+    if work_order:
+        EmailMessageIndex.objects.create(
+            message_id=outbound.message_id,
+            work_order=work_order,
+            direction='outbound',
+        )
+    return outbound
+
+
+def _retry_delay(attempts):
+    """Capped exponential backoff for the given number of failed attempts"""
+    base = getattr(settings, 'NOTIFICATION_RETRY_BASE_SECONDS', 60)
+    cap = getattr(settings, 'NOTIFICATION_RETRY_MAX_SECONDS', 3600)
+    return timedelta(seconds=min(cap, base * 2 ** (attempts - 1)))
+
+
+def _is_permanent_error(error):
+    """Tell whether a delivery error is worth retrying"""
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code >= 500
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        # Each refused recipient has its own reply; 4xx ones may be accepted later
+        return all(code >= 500 for code, message in error.recipients.values())
+    return isinstance(error, PERMANENT_SMTP_ERRORS)
+
+
+def _claim_batch(batch_size):
+    """Reserve a batch of due emails so that concurrent workers skip them"""
+    now = timezone.now()
+    claim_seconds = getattr(settings, 'NOTIFICATION_CLAIM_SECONDS', 300)
+
+    with transaction.atomic():
+        batch = list(
+            OutboundEmail.objects.select_for_update(skip_locked=True)
+            .filter(status='pending', next_attempt_at__lte=now)
+            .order_by('next_attempt_at')[:batch_size]
+        )
+        if batch:
+            OutboundEmail.objects.filter(pk__in=[outbound.pk for outbound in batch]).update(
+                next_attempt_at=now + timedelta(seconds=claim_seconds)
+            )
+    return batch
+
+
+def _handed_out(messages, handed):
+    """Yield messages, recording each one as the backend takes it"""
+    for message in messages:
+        handed.append(message)
+        yield message
+
+
+def _send_batch(connection, messages):
+    """
+    Send messages over one connection, returning the error for each (None if sent).
+
+    The whole batch goes to a single send_messages() call. Messages are
+    handed to the backend as it asks for them, and Django's backends send
+    each one before taking the next, so when it raises, the one it was
+    sending is the failure, those before it were delivered and the
+    rest go out in the next call. Only a backend that raises before taking
+    any message is retried one message at a time, to find the failing one.
+    """
+    errors = []
+    while len(errors) < len(messages):
+        pending = messages[len(errors):]
+        try:
+            # A no-op while the connection is alive
+            connection.open()
+        except Exception as e:
+            # Nothing in the batch can be sent until the server is back
+            errors.extend([e] * len(pending))
+            break
+
+        handed = []
+        try:
+            connection.send_messages(_handed_out(pending, handed))
+        except Exception as e:
+            if handed:
+                errors.extend([None] * (len(handed) - 1))
+                errors.append(e)
+            elif len(pending) == 1:
+                errors.append(e)
+            else:
+                connection.close()
+                errors.extend(_send_batch(connection, pending[:1]))
+                continue
+            # smtplib resets the session after a refused sender, recipient
+            # or message; anything else may have left it unusable
+            if not isinstance(e, PERMANENT_SMTP_ERRORS):
+                connection.close()
+        else:
+            errors.extend([None] * len(pending))
+    return errors
+
+
+def send_pending_emails(batch_size=None, max_batches=None):
+    """
+    Deliver due outbox emails over a single reused SMTP connection.
+
+    Returns a dict with the number of emails sent, deferred for a later
+    retry and failed permanently.
+    """
+    batch_size = batch_size or getattr(settings, 'NOTIFICATION_BATCH_SIZE', 50)
+    max_attempts = getattr(settings, 'NOTIFICATION_MAX_ATTEMPTS', 5)
+    from_email = getattr(settings, 'DEFAULT_FROM_EMAIL', 'noreply@example.com')
+    results = {
+        'sent': 0,
+        'deferred': 0,
+        'failed': 0,
+    }
+
+    connection = get_connection(fail_silently=False)
+    batches = 0
+    try:
+        while max_batches is None or batches < max_batches:
+            batch = _claim_batch(batch_size)
+            if not batch:
+                break
+            batches += 1
+
+            messages = [
+                EmailMessage(
+                    subject=outbound.subject,
+                    body=outbound.body,
+                    from_email=from_email,
+                    to=[outbound.recipient],
+                    connection=connection,
+                    headers={'Message-ID': outbound.message_id} if outbound.message_id else None,
+                )
+                for outbound in batch
+            ]
+            for outbound, error in zip(batch, _send_batch(connection, messages)):
+                outbound.attempts += 1
+                if error is not None:
+                    outbound.last_error = str(error)
+                    if _is_permanent_error(error) or outbound.attempts >= max_attempts:
+                        outbound.status = 'failed'
+                        results['failed'] += 1
+                    else:
+                        outbound.next_attempt_at = timezone.now() + _retry_delay(outbound.attempts)
+                        results['deferred'] += 1
+                else:
+                    outbound.status = 'sent'
+                    outbound.sent_at = timezone.now()
+                    outbound.last_error = ''
+                    results['sent'] += 1
+
+            OutboundEmail.objects.bulk_update(
+                batch, ['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at']
+            )
+    finally:
+        connection.close()
+
+    return results
+
+
+@receiver(post_save, sender=EmailTemplate)
+@receiver(post_delete, sender=EmailTemplate)
+def invalidate_compiled_template(sender, instance, **kwargs):
+    """Drop cached compiled templates when an EmailTemplate changes"""
+    # The type itself may have been edited, so every type is looked up again;
+    # compiled templates whose updated_at did not change are reused. Again
+    # after the commit, in case a render in between saw the old rows.
+    compiled_templates.invalidate()
+    transaction.on_commit(compiled_templates.invalidate)
+
+
+@receiver(post_save, sender=WorkOrder)
+def queue_status_notification(sender, instance, created, **kwargs):
+    """Notify the requester when a ticket changes status"""
+    # Set by WorkOrder.from_db() and save()
+    previous_status = getattr(instance, '_loaded_status', None)
+    if created or previous_status is None or previous_status == instance.status:
+        return
+
+    requester_email = instance.requester.email
+    if not requester_email:
+        return
+
+    template_type = STATUS_TEMPLATE_TYPES.get(instance.status, 'ticket_updated')
+    rendered = render_notification(template_type, instance)
+    if rendered:
+        subject, body = rendered
+        queue_email(requester_email, subject, body, work_order=instance)
@@ -0,0 +1,57 @@
+"""
+In-process cache of reference data: task types, task categories and
+staff users.
+
+These tables change a few times a year but are read on every list page,
+work order form, ingested email and resolved ticket. Each process keeps
+one snapshot of them in memory, tagged with the versions of the data it
+was loaded from (see caching.py). Reading it only compares those versions
+with the shared cache. The versions are only bumped once a change is
+committed, so every worker, including the one that made the change,
+reloads on its next read after the commit; a change that is rolled back
+bumps nothing.
+"""
+from django.contrib.auth.models import User
+from .caching import get_versions
+from .models import TaskCategory, TaskType
+
+
+REFERENCE_VERSIONS = ('taskclassification', 'staff')
+
+_snapshot = None
+
+
+class ReferenceData:
+    """One loaded copy of the reference tables; its objects must not be modified"""
+
+    def __init__(self, version):
+        self.version = version
+        self.task_types = {task_type.pk: task_type for task_type in TaskType.objects.all()}
+        self.task_categories = {category.pk: category for category in TaskCategory.objects.all()}
+        self.staff_users = list(User.objects.filter(is_staff=True).order_by('username'))
+
+    def task_type(self, pk):
+        # Rows created since the snapshot was loaded are read directly
+        return self.task_types.get(pk) or TaskType.objects.get(pk=pk)
+
+    def task_category(self, pk):
+        return self.task_categories.get(pk) or TaskCategory.objects.get(pk=pk)
+
+    def active_staff_users(self):
+        return [user for user in self.staff_users if user.is_active]
+
+
+def get_reference_data():
+    """The current reference data, reloaded if it changed since this process loaded it"""
+    global _snapshot
+    version = get_versions(*REFERENCE_VERSIONS)
+    snapshot = _snapshot
+    if snapshot is None or snapshot.version != version:
+        snapshot = _snapshot = ReferenceData(version)
+    return snapshot
+
+
+def forget_reference_data():
+    """Drop this process's snapshot, e.g. between tests whose changes are never committed"""
+    global _snapshot
+    _snapshot = None
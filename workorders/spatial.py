@@ -0,0 +1,150 @@
+"""
+Proximity queries on work order coordinates.
+
+Every located work order stores the geohash of its coordinates in an
+indexed column. A geohash names a cell of a fixed grid, and every cell
+inside it has a name starting with its name, so "near this point" becomes
+a few index range scans over the cells covering the search area. The
+exact distance is then only computed for the rows found there.
+"""
+import math
+from django.db.models import Q
+
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# Cells of 9 characters are about 5 m across
+GEOHASH_PRECISION = 9
+
+EARTH_RADIUS_KM = 6371.0088
+
+# More cells than this are not worth a range scan each; a coarser level is used
+MAX_CELLS = 16
+
+
+def encode_geohash(latitude, longitude, precision=GEOHASH_PRECISION):
+    """The geohash of a point"""
+    south, north = -90.0, 90.0
+    west, east = -180.0, 180.0
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        # Bits alternate between longitude and latitude, longitude first
+        if even:
+            middle = (west + east) / 2
+            bit = longitude >= middle
+            if bit:
+                west = middle
+            else:
+                east = middle
+        else:
+            middle = (south + north) / 2
+            bit = latitude >= middle
+            if bit:
+                south = middle
+            else:
+                north = middle
+        value = value * 2 + bit
+        bits += 1
+        even = not even
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bits = 0
+            value = 0
+    return ''.join(chars)
+
+
+def cell_size(precision):
+    """(height, width) in degrees of the cells of a precision"""
+    bits = 5 * precision
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** ((bits + 1) // 2)
+
+
+def haversine_km(latitude1, longitude1, latitude2, longitude2):
+    """Great-circle distance between two points in kilometers"""
+    phi1 = math.radians(latitude1)
+    phi2 = math.radians(latitude2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(longitude2 - longitude1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(latitude, longitude, radius_km):
+    """(south, west, north, east) of a box holding the circle; west/east may pass ±180"""
+    d_latitude = math.degrees(radius_km / EARTH_RADIUS_KM)
+    south = max(-90.0, latitude - d_latitude)
+    north = min(90.0, latitude + d_latitude)
+    widest = max(abs(south), abs(north))
+    if widest >= 90.0:
+        return south, -180.0, north, 180.0
+    d_longitude = math.degrees(radius_km / (EARTH_RADIUS_KM * math.cos(math.radians(widest))))
+    if d_longitude >= 180.0:
+        return south, -180.0, north, 180.0
+    return south, longitude - d_longitude, north, longitude + d_longitude
+
+
+def covering_cells(south, west, north, east, max_cells=MAX_CELLS):
+    """The geohashes of the finest cells of which at most ``max_cells`` cover a box"""
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        height, width = cell_size(precision)
+        rows = round(180.0 / height)
+        columns = round(360.0 / width)
+        first_row = int((south + 90.0) // height)
+        last_row = min(rows - 1, int((north + 90.0) // height))
+        first_column = int((west + 180.0) // width)
+        last_column = int((east + 180.0) // width)
+        count = (last_row - first_row + 1) * min(columns, last_column - first_column + 1)
+        if count > max_cells:
+            continue
+        cells = set()
+        for row in range(first_row, last_row + 1):
+            for column in range(first_column, last_column + 1):
+                # Columns past ±180 wrap around to the other side
+                cells.add(encode_geohash(
+                    -90.0 + (row + 0.5) * height,
+                    -180.0 + (column % columns + 0.5) * width,
+                    precision
+                ))
+        return sorted(cells)
+    return ['']
+
+
+def prefix_filter(cells, field='geohash'):
+    """
+    Q matching values starting with any of the cells, as range conditions
+    an ordinary b-tree index can answer, whatever LIKE does on the backend.
+    """
+    condition = Q()
+    for cell in cells:
+        condition |= Q(**{f'{field}__gte': cell}) & following_prefix(cell, field)
+    return condition
+
+
+def following_prefix(cell, field='geohash'):
+    """Q for values sorting before the first geohash after all those in the cell"""
+    for i in range(len(cell) - 1, -1, -1):
+        position = GEOHASH_ALPHABET.index(cell[i])
+        if position < len(GEOHASH_ALPHABET) - 1:
+            return Q(**{f'{field}__lt': cell[:i] + GEOHASH_ALPHABET[position + 1]})
+    # The last cell of the grid: nothing sorts after it
+    return Q()
+
+
+def nearby(queryset, latitude, longitude, radius_km):
+    """
+    The objects of a queryset of located work orders within ``radius_km``
+    of a point, closest first. Each gets a ``distance_km`` attribute.
+    """
+    cells = covering_cells(*bounding_box(latitude, longitude, radius_km))
+    candidates = queryset.exclude(geohash='').filter(prefix_filter(cells))
+    results = []
+    for work_order in candidates:
+        distance = haversine_km(latitude, longitude, work_order.latitude, work_order.longitude)
+        if distance <= radius_km:
+            work_order.distance_km = distance
+            results.append(work_order)
+    results.sort(key=lambda work_order: work_order.distance_km)
+    return results
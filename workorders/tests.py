@@ -1,8 +1,67 @@
-from django.test import TestCase
+import importlib
+import io
+import mailbox
+import os
+import random
+import smtplib
+import tempfile
+import time
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from unittest import mock
+import httpx
+from asgiref.sync import async_to_sync
+from django.apps import apps as django_apps
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.db.models.signals import post_init
+from django.test import Client, override_settings
+from django.test import TestCase as DjangoTestCase
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User
 from django.utils import timezone
 from datetime import timedelta
-from workorders.models import WorkOrder, TaskType, TaskCategory, UserProfile
+from workorders.models import (
+    WorkOrder, TaskType, TaskCategory, UserProfile, EmailAccount, OutboundEmail,
+    EmailTemplate, EmailMessageIndex, ProcessedEmail, EmailProcessingRun,
+    EmailAccountLease, GeocodeCache, WorkOrderComment, POP3SeenMessage
+)
+from workorders.email_service import (
+    EmailProcessor, get_retry_delay, parse_message_bytes, parse_raw_email, process_all_email_accounts
+)
+from workorders.tests_support.fake_mail_servers import (
+    FakeIMAPServer, FakePOP3Server, FakeSMTPServer, generate_messages
+)
+from workorders.geocoding import (
+    Gazetteer, GazetteerBackend, GeocodingClient, GeocodingError, GeocodingRateLimited, RateLimiter,
+    ageocode, geocode, normalize_location, recent_results, reset_backends
+)
+from workorders.geocode_backfill import GeocodeBackfill
+from workorders.spatial import encode_geohash, haversine_km, nearby
+from workorders.assignment import get_open_ticket_counts, pick_assignee
+from workorders.caching import bump_versions, get_versions
+from workorders.forms import WorkOrderForm
+from workorders.reference import forget_reference_data, get_reference_data
+from workorders.html_text import html_to_text
+from workorders.mail_sources import LocalMailboxSource
+from workorders.notifications import (
+    queue_email, send_pending_emails, render_notification
+)
+
+
+class TestCase(DjangoTestCase):
+    """
+    TestCase that starts without a reference data snapshot. Test data is
+    rolled back, never committed, so no version is bumped for it and a
+    snapshot loaded by an earlier test would otherwise still be current.
+    """
+    
+    def run(self, result=None):
+        forget_reference_data()
+        return super().run(result)
 
 
 class PointsDistributionTestCase(TestCase):
@@ -274,3 +333,1872 @@ class WorkOrderModelTestCase(TestCase):
         work_order.save()
         
         self.assertIsNotNone(work_order.resolved_at)
+
+
+class WorkOrderDetailViewTestCase(TestCase):
+    """Test cases for the work order detail page"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user('tech', password='password')
+        self.client.force_login(self.user)
+        self.work_order = WorkOrder.objects.create(
+            title="Printer </script><b>jam</b>",
+            description="Paper stuck",
+            task_type=TaskType.objects.create(name="Onsite", points_base=10),
+            task_category=TaskCategory.objects.create(name="Field"),
+            requester=self.user,
+            location_name="Makati Head Office",
+            latitude=14.5547,
+            longitude=121.0244
+        )
+    
+    def test_location_map_is_drawn_in_the_browser(self):
+        """Test that the map is sent as escaped coordinates, not as server-built HTML"""
+        with mock.patch('folium.Map') as folium_map:
+            response = self.client.get(f'/work-orders/{self.work_order.pk}/')
+        
+        folium_map.assert_not_called()
+        self.assertContains(response, 'id="location-map-data"')
+        self.assertContains(response, '14.5547')
+        self.assertNotContains(response, '</script><b>jam</b>')
+    
+    def test_no_map_without_coordinates(self):
+        """Test that tickets without coordinates get no map"""
+        WorkOrder.objects.filter(pk=self.work_order.pk).update(latitude=None, longitude=None)
+        response = self.client.get(f'/work-orders/{self.work_order.pk}/')
+        self.assertNotContains(response, 'location-map-data')
+
+
+class SpatialIndexTestCase(TestCase):
+    """Test cases for the geohash index and nearby work order queries"""
+    
+    # Makati, Metro Manila
+    HERE = (14.5547, 121.0244)
+    
+    def setUp(self):
+        self.task_type = TaskType.objects.create(name="Onsite", points_base=10)
+        self.task_category = TaskCategory.objects.create(name="Field")
+        self.user = User.objects.create_user('tech', password='password')
+    
+    def work_order(self, latitude=None, longitude=None, **kwargs):
+        return WorkOrder.objects.create(
+            title="Printer", description="", task_type=self.task_type, task_category=self.task_category,
+            requester=self.user, latitude=latitude, longitude=longitude, **kwargs
+        )
+    
+    def test_geohash_follows_the_coordinates(self):
+        """Test that save() keeps the geohash in step, also with update_fields"""
+        work_order = self.work_order(57.64911, 10.40744)
+        self.assertEqual(work_order.geohash, 'u4pruydqq')
+        
+        work_order.latitude, work_order.longitude = self.HERE
+        work_order.save(update_fields=['latitude', 'longitude'])
+        work_order.refresh_from_db()
+        self.assertEqual(work_order.geohash, encode_geohash(*self.HERE))
+        
+        work_order.latitude = None
+        work_order.save()
+        self.assertEqual(WorkOrder.objects.get(pk=work_order.pk).geohash, '')
+    
+    def test_nearby_matches_a_full_scan(self):
+        """Test that the cell prefilter finds exactly what a full scan finds"""
+        rng = random.Random(0)
+        for _ in range(300):
+            self.work_order(self.HERE[0] + rng.uniform(-0.2, 0.2), self.HERE[1] + rng.uniform(-0.2, 0.2))
+        self.work_order()
+        
+        for radius in (0.5, 2, 5, 15):
+            expected = sorted(
+                (haversine_km(*self.HERE, wo.latitude, wo.longitude), wo.pk)
+                for wo in WorkOrder.objects.exclude(latitude=None)
+                if haversine_km(*self.HERE, wo.latitude, wo.longitude) <= radius
+            )
+            results = nearby(WorkOrder.objects.all(), *self.HERE, radius)
+            self.assertEqual([wo.pk for wo in results], [pk for distance, pk in expected])
+    
+    def test_cells_across_the_antimeridian(self):
+        """Test that the covering cells wrap around at ±180 degrees"""
+        east = self.work_order(0.0, 179.99)
+        west = self.work_order(0.0, -179.99)
+        results = nearby(WorkOrder.objects.all(), 0.0, 179.995, 5)
+        self.assertEqual({wo.pk for wo in results}, {east.pk, west.pk})
+    
+    def test_nearby_view(self):
+        """Test the nearby tickets endpoint"""
+        self.client.force_login(self.user)
+        close = self.work_order(14.56, 121.03, location_name="Makati Head Office")
+        self.work_order(14.56, 121.03, status='resolved')
+        self.work_order(14.70, 121.10)
+        
+        response = self.client.get('/work-orders/nearby/', {'lat': self.HERE[0], 'lng': self.HERE[1], 'radius': 5})
+        data = response.json()
+        self.assertEqual(data['count'], 1)
+        self.assertEqual(data['work_orders'][0]['ticket_number'], close.ticket_number)
+        self.assertLess(data['work_orders'][0]['distance_km'], 2)
+        
+        response = self.client.get('/work-orders/nearby/', {'lat': 'here', 'lng': 121})
+        self.assertEqual(response.status_code, 400)
+    
+    def test_migration_backfills_existing_rows(self):
+        """Test that the migration indexes work orders saved before the column existed"""
+        work_order = self.work_order(*self.HERE)
+        WorkOrder.objects.update(geohash='')
+        
+        migration = importlib.import_module('workorders.migrations.0011_workorder_geohash')
+        migration.backfill_geohash(django_apps, None)
+        
+        work_order.refresh_from_db()
+        self.assertEqual(work_order.geohash, encode_geohash(*self.HERE))
+
+
+class AssignmentTestCase(TestCase):
+    """Test cases for load-aware ticket assignment"""
+    
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.task_type = TaskType.objects.create(name="Onsite", points_base=10)
+        self.task_category = TaskCategory.objects.create(name="Field")
+        self.requester = User.objects.create_user(username="client")
+        self.ana = User.objects.create_user(username="ana", is_staff=True)
+        self.ben = User.objects.create_user(username="ben", is_staff=True)
+        self.staff = [self.ana, self.ben]
+    
+    def work_order(self, *assignees, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            work_order = WorkOrder.objects.create(
+                title="Printer", description="", task_type=self.task_type,
+                task_category=self.task_category, requester=self.requester, **kwargs
+            )
+            work_order.assigned_to.add(*assignees)
+        return work_order
+    
+    def assertCounts(self, expected):
+        """The cached counts, read without recounting, match the database"""
+        with self.assertNumQueries(0):
+            counts = get_open_ticket_counts([user.pk for user in self.staff])
+        self.assertEqual(counts, {user.pk: expected[user.username] for user in self.staff})
+        for user in self.staff:
+            self.assertEqual(
+                user.assigned_tickets.filter(status__in=['open', 'in_progress', 'waiting']).count(),
+                expected[user.username]
+            )
+    
+    def test_counts_follow_assignments_and_status(self):
+        """Test that counts are adjusted incrementally instead of recounted"""
+        self.work_order(self.ana)
+        with self.assertNumQueries(1):
+            get_open_ticket_counts([self.ana.pk, self.ben.pk])
+        self.assertCounts({'ana': 1, 'ben': 0})
+        
+        work_order = self.work_order(self.ana, self.ben)
+        self.assertCounts({'ana': 2, 'ben': 1})
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            work_order.status = 'resolved'
+            work_order.save()
+        self.assertCounts({'ana': 1, 'ben': 0})
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            work_order.status = 'open'
+            work_order.save()
+            work_order.assigned_to.remove(self.ana)
+        self.assertCounts({'ana': 1, 'ben': 1})
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ana.assigned_tickets.clear()
+            work_order.delete()
+        self.assertCounts({'ana': 0, 'ben': 0})
+    
+    def test_least_loaded_staff_member_is_picked(self):
+        """Test that the staff member with the fewest open tickets gets the next one"""
+        self.work_order(self.ana)
+        self.work_order(self.ana, status='resolved')
+        User.objects.create_user(username="idle", is_staff=True, is_active=False)
+        User.objects.create_user(username="requester2")
+        
+        self.assertEqual(pick_assignee(), self.ben)
+        self.work_order(self.ben)
+        self.work_order(self.ben)
+        self.assertEqual(pick_assignee(), self.ana)
+    
+    @override_settings(ASSIGNMENT_PROXIMITY_WEIGHT=2, ASSIGNMENT_PROXIMITY_RADIUS_KM=10)
+    def test_proximity_weighting(self):
+        """Test that a technician working nearby is preferred despite a slightly higher load"""
+        self.work_order(self.ana, latitude=14.5547, longitude=121.0244)
+        self.assertEqual(pick_assignee(latitude=14.556, longitude=121.025), self.ana)
+        self.assertEqual(pick_assignee(latitude=10.3157, longitude=123.8854), self.ben)
+        self.assertEqual(pick_assignee(), self.ben)
+    
+    @override_settings(ASSIGNMENT_PROXIMITY_WEIGHT=2, ASSIGNMENT_PROXIMITY_RADIUS_KM=0)
+    def test_zero_proximity_radius_turns_weighting_off(self):
+        """Test that a radius of 0 falls back to the plain least loaded pick"""
+        self.work_order(self.ana, latitude=14.5547, longitude=121.0244)
+        self.assertEqual(pick_assignee(latitude=14.5547, longitude=121.0244), self.ben)
+    
+    def test_email_tickets_go_to_the_least_loaded(self):
+        """Test that email accounts can assign new tickets by load"""
+        self.work_order(self.ana)
+        account = EmailAccount.objects.create(
+            name="Support", email_address="support@example.com", host="localhost",
+            username="support", password="secret", default_task_type=self.task_type,
+            default_task_category=self.task_category, auto_assign_least_loaded=True
+        )
+        email_data = {
+            'sender_email': 'client@example.com', 'sender_name': 'Client', 'subject': 'Broken',
+            'body': 'Please help', 'message_id': '<broken@example.com>',
+        }
+        work_order = EmailProcessor(account)._create_work_order_from_email(email_data)
+        self.assertEqual(list(work_order.assigned_to.all()), [self.ben])
+    
+    def test_form_auto_assign(self):
+        """Test that the work order form assigns the least-loaded technician on request"""
+        self.work_order(self.ben)
+        data = {
+            'title': 'Monitor', 'description': 'Flickers', 'task_type': self.task_type.pk,
+            'task_category': self.task_category.pk, 'priority': 'medium', 'difficulty_rating': 1,
+            'auto_assign': 'on',
+        }
+        form = WorkOrderForm(data, user=self.requester)
+        self.assertTrue(form.is_valid(), form.errors)
+        with self.captureOnCommitCallbacks(execute=True):
+            work_order = form.save()
+        self.assertEqual(list(work_order.assigned_to.all()), [self.ana])
+        self.assertCounts({'ana': 1, 'ben': 1})
+
+
+class ViewCacheTestCase(TestCase):
+    """Test cases for version-keyed caching of page data"""
+    
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.user = User.objects.create_user('tech', password='password', is_staff=True)
+        self.client.force_login(self.user)
+        self.task_type = TaskType.objects.create(name="Onsite", points_base=10)
+        self.task_category = TaskCategory.objects.create(name="Field")
+        for i in range(5):
+            self.work_order(f"Printer {i}")
+    
+    def work_order(self, title, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            return WorkOrder.objects.create(
+                title=title, description="", task_type=self.task_type,
+                task_category=self.task_category, requester=self.user, **kwargs
+            )
+    
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+    
+    def test_dashboard_is_served_from_the_cache_until_a_change(self):
+        """Test that repeated dashboard views skip the statistics queries"""
+        first, cold = self.count_queries('/')
+        second, warm = self.count_queries('/')
+        self.assertLess(warm, cold)
+        self.assertContains(second, '<h5 class="card-title">5</h5>', html=False)
+        
+        self.work_order("Scanner")
+        response, queries = self.count_queries('/')
+        self.assertContains(response, '<h5 class="card-title">6</h5>', html=False)
+    
+    def test_leaderboard_sees_new_points(self):
+        """Test that saving a profile invalidates the cached leaderboard"""
+        profile = UserProfile.objects.create(user=self.user, total_points=10)
+        self.assertContains(self.client.get('/leaderboard/'), '10 pts')
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            profile.add_points(5)
+        self.assertContains(self.client.get('/leaderboard/'), '15 pts')
+    
+    def test_list_rows_are_cached_per_ticket(self):
+        """Test that cached rows skip their queries and follow assignment changes"""
+        response, cold = self.count_queries('/work-orders/')
+        response, warm = self.count_queries('/work-orders/')
+        # Type, category and assignees were loaded for each of the 5 rows
+        self.assertLessEqual(warm, cold - 15)
+        
+        work_order = WorkOrder.objects.get(title="Printer 3")
+        with self.captureOnCommitCallbacks(execute=True):
+            work_order.assigned_to.add(self.user)
+        response = self.client.get('/work-orders/')
+        self.assertContains(response, '<span class="badge bg-info me-1">tech</span>', count=1, html=False)
+    
+    def test_kpi_report_is_cached_per_date_range(self):
+        """Test that KPI data is keyed by its date range"""
+        today = timezone.now().date()
+        self.count_queries(f'/kpi-report/?start_date={today}&end_date={today}')
+        response, queries = self.count_queries(f'/kpi-report/?start_date={today}&end_date={today}')
+        self.assertEqual(response.context['total_tickets'], 5)
+        
+        response = self.client.get('/kpi-report/?start_date=2000-01-01&end_date=2000-01-02')
+        self.assertEqual(response.context['total_tickets'], 0)
+
+
+class ReferenceDataTestCase(TestCase):
+    """Test cases for the in-process cache of task types, categories and staff"""
+    
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.user = User.objects.create_user('tech', password='password', is_staff=True)
+        self.task_type = TaskType.objects.create(name="Onsite", points_base=10)
+        self.task_category = TaskCategory.objects.create(name="Field", multiplier=2.0)
+    
+    def test_snapshot_is_reused_without_queries(self):
+        """Test that reading unchanged reference data makes no queries"""
+        reference = get_reference_data()
+        self.assertEqual(list(reference.task_types.values()), [self.task_type])
+        self.assertEqual(reference.staff_users, [self.user])
+        with self.assertNumQueries(0):
+            self.assertIs(get_reference_data(), reference)
+    
+    def test_points_are_calculated_without_queries(self):
+        """Test that calculate_points reads the type and category from the cache"""
+        work_order = WorkOrder.objects.create(
+            title="Printer jam", description="", task_type=self.task_type,
+            task_category=self.task_category, requester=self.user, priority='low'
+        )
+        work_order = WorkOrder.objects.get(pk=work_order.pk)
+        get_reference_data()
+        with self.assertNumQueries(0):
+            work_order.calculate_points()
+        self.assertEqual(work_order.points_earned, 20)
+    
+    def test_changes_reload_the_snapshot(self):
+        """Test that saving a task type or a staff user is seen on the next read"""
+        get_reference_data()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.task_type.points_base = 30
+            self.task_type.save()
+        self.assertEqual(get_reference_data().task_type(self.task_type.pk).points_base, 30)
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            other = User.objects.create_user('other', password='password', is_staff=True)
+        self.assertIn(other, get_reference_data().staff_users)
+        self.assertIn((other.pk, 'other'), WorkOrderForm().fields['assigned_to'].choices)
+    
+    def test_other_workers_changes_are_seen(self):
+        """Test that a version bumped in the shared cache reloads every process"""
+        reference = get_reference_data()
+        with self.captureOnCommitCallbacks(execute=True):
+            bump_versions('taskclassification')
+        self.assertIsNot(get_reference_data(), reference)
+    
+    def test_logging_in_keeps_the_snapshot(self):
+        """Test that last_login updates do not invalidate the staff list"""
+        reference = get_reference_data()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.force_login(self.user)
+        self.assertIs(get_reference_data(), reference)
+    
+    def test_only_staff_changes_reload_the_snapshot(self):
+        """Test that saving other users keeps the staff list, and demoting staff drops it"""
+        reference = get_reference_data()
+        staff_version = get_versions('staff')
+        with self.captureOnCommitCallbacks(execute=True):
+            requester = User.objects.create_user('requester')
+            requester.first_name = 'Rita'
+            requester.save()
+        self.assertIs(get_reference_data(), reference)
+        self.assertEqual(get_versions('staff'), staff_version)
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            user = User.objects.get(pk=self.user.pk)
+            user.is_staff = False
+            user.save()
+        self.assertNotIn(self.user, get_reference_data().staff_users)
+    
+    def test_rolled_back_changes_keep_the_snapshot(self):
+        """Test that the snapshot is only reloaded for committed changes"""
+        reference = get_reference_data()
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                self.task_type.points_base = 30
+                self.task_type.save()
+                self.assertIs(get_reference_data(), reference)
+                raise ValueError
+        self.assertIs(get_reference_data(), reference)
+        self.assertEqual(reference.task_type(self.task_type.pk).points_base, 10)
+
+
+class ConditionalGetTestCase(TestCase):
+    """Test cases for answering unchanged pages with 304 Not Modified"""
+    
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.user = User.objects.create_user('tech', password='password', is_staff=True)
+        self.client.force_login(self.user)
+        self.task_type = TaskType.objects.create(name="Onsite", points_base=10)
+        self.task_category = TaskCategory.objects.create(name="Field")
+        self.work_order = WorkOrder.objects.create(
+            title="Printer jam", description="", task_type=self.task_type,
+            task_category=self.task_category, requester=self.user,
+            latitude=14.5547, longitude=121.0244
+        )
+        self.url = f'/work-orders/{self.work_order.pk}/'
+    
+    def get(self, url):
+        # The first visit sets the CSRF cookie that later pages are keyed by
+        self.client.get(url)
+        return self.client.get(url)
+    
+    def revalidate(self, url, response, client=None):
+        return (client or self.client).get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+    
+    def test_unchanged_detail_page_is_not_rendered(self):
+        """Test that revalidating an unchanged ticket returns 304 without a template"""
+        response = self.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Last-Modified', response)
+        self.assertIn('private', response['Cache-Control'])
+        
+        with CaptureQueriesContext(connection) as queries:
+            response = self.revalidate(self.url, response)
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(response.templates)
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+        # Session, user and the one validator query
+        self.assertLessEqual(len(queries), 3)
+    
+    def test_detail_page_changes_with_comments_and_edits(self):
+        """Test that a new comment or an edit gives the ticket a new ETag"""
+        first = self.get(self.url)
+        WorkOrderComment.objects.create(work_order=self.work_order, author=self.user, comment="On my way")
+        second = self.revalidate(self.url, first)
+        self.assertEqual(second.status_code, 200)
+        self.assertContains(second, "On my way")
+        
+        self.work_order.title = "Printer fixed"
+        self.work_order.save()
+        self.assertEqual(self.revalidate(self.url, second).status_code, 200)
+    
+    def test_etag_is_per_user(self):
+        """Test that another user's cached copy of a page is not confirmed"""
+        response = self.get(self.url)
+        other = Client()
+        other.force_login(User.objects.create_user('other', password='password'))
+        self.assertEqual(self.revalidate(self.url, response, other).status_code, 200)
+    
+    def test_pending_messages_are_always_rendered(self):
+        """Test that a page with a message to show is never answered with 304"""
+        response = self.get(self.url)
+        redirect = self.client.post(self.url, {'add_comment': '1', 'comment': 'Done'})
+        self.assertEqual(redirect.status_code, 302)
+        # Without the comment only the pending message differs from the first visit
+        WorkOrderComment.objects.all().delete()
+        response = self.revalidate(self.url, response)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Comment added successfully!')
+    
+    def test_list_page_changes_with_its_work_orders(self):
+        """Test that the list is revalidated per filter and changes with its tickets"""
+        response = self.get('/work-orders/?status=open')
+        not_modified = self.revalidate('/work-orders/?status=open', response)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertIn('private', not_modified['Cache-Control'])
+        self.assertEqual(self.revalidate('/work-orders/?status=closed', response).status_code, 200)
+        
+        WorkOrder.objects.create(
+            title="Scanner", description="", task_type=self.task_type,
+            task_category=self.task_category, requester=self.user
+        )
+        self.assertEqual(self.revalidate('/work-orders/?status=open', response).status_code, 200)
+
+
+class EmailUserResolutionTestCase(TestCase):
+    """Test cases for resolving email senders to users"""
+    
+    def setUp(self):
+        self.task_type = TaskType.objects.create(name="Email", points_base=10)
+        self.task_category = TaskCategory.objects.create(name="Inbox")
+        self.account = EmailAccount.objects.create(
+            name="Support",
+            email_address="support@example.com",
+            host="localhost",
+            username="support",
+            password="secret",
+            default_task_type=self.task_type,
+            default_task_category=self.task_category,
+        )
+        self.processor = EmailProcessor(self.account)
+    
+    def _email(self, address, name=''):
+        return {'sender_email': address, 'sender_name': name}
+    
+    def test_batch_resolved_with_single_query(self):
+        """Test that known senders in a batch cost one query in total"""
+        alice = User.objects.create_user(username="alice", email="alice@example.com")
+        bob = User.objects.create_user(username="bob", email="bob@example.com")
+        emails = [
+            self._email("alice@example.com"),
+            self._email("bob@example.com"),
+            self._email("alice@example.com"),
+        ]
+        
+        with self.assertNumQueries(1):
+            self.processor._prime_user_cache(emails)
+            users = [self.processor._get_or_create_user_from_email(e) for e in emails]
+        
+        self.assertEqual(users, [alice, bob, alice])
+    
+    def test_username_collision_uses_next_free_suffix(self):
+        """Test that new senders get the first free username suffix"""
+        User.objects.create_user(username="jdoe")
+        User.objects.create_user(username="jdoe_1")
+        User.objects.create_user(username="jdoe_2")
+        
+        user = self.processor._get_or_create_user_from_email(
+            self._email("jdoe@example.org", "John Doe")
+        )
+        
+        self.assertEqual(user.username, "jdoe_3")
+        self.assertEqual(user.first_name, "John")
+        self.assertEqual(user.last_name, "Doe")
+    
+    def test_username_lookup_ignores_longer_names(self):
+        """Test that only the name and its numbered variants are read for a short local part"""
+        for username in ("it", "it_1", "itsupport", "it_admin", "it.desk"):
+            User.objects.create_user(username=username)
+        
+        with CaptureQueriesContext(connection) as queries:
+            username = self.processor._generate_unique_username("it")
+        
+        self.assertEqual(username, "it_2")
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(self.processor._generate_unique_username("it.desk"), "it.desk_1")
+    
+    def test_new_sender_cached_for_rest_of_run(self):
+        """Test that a user created in this run is reused without queries"""
+        email_data = self._email("new@example.com")
+        self.processor._prime_user_cache([email_data])
+        user = self.processor._get_or_create_user_from_email(email_data)
+        
+        with self.assertNumQueries(0):
+            self.processor._prime_user_cache([email_data])
+            self.assertEqual(self.processor._get_or_create_user_from_email(email_data), user)
+
+
+class NotificationOutboxTestCase(TestCase):
+    """Test cases for the outbound notification outbox"""
+    
+    def test_pending_emails_sent_in_one_pass(self):
+        """Test that queued emails are delivered and marked as sent"""
+        for i in range(3):
+            queue_email(f"user{i}@example.com", f"Subject {i}", "Body")
+        
+        results = send_pending_emails(batch_size=2)
+        
+        self.assertEqual(results['sent'], 3)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertFalse(OutboundEmail.objects.exclude(status='sent').exists())
+    
+    def test_transient_failure_is_retried_later(self):
+        """Test that a transient SMTP error defers the email with backoff"""
+        outbound = queue_email("user@example.com", "Subject", "Body")
+        connection = mock.Mock()
+        connection.send_messages.side_effect = smtplib.SMTPServerDisconnected("gone")
+        
+        with mock.patch('workorders.notifications.get_connection', return_value=connection):
+            results = send_pending_emails()
+        
+        outbound.refresh_from_db()
+        self.assertEqual(results['deferred'], 1)
+        self.assertEqual(outbound.status, 'pending')
+        self.assertEqual(outbound.attempts, 1)
+        self.assertGreater(outbound.next_attempt_at, timezone.now())
+        
+        # Not due yet, so a second run leaves it alone
+        self.assertEqual(send_pending_emails()['sent'], 0)
+    
+    def test_permanent_failure_is_not_retried(self):
+        """Test that a refused recipient fails the email immediately"""
+        outbound = queue_email("nobody@example.com", "Subject", "Body")
+        connection = mock.Mock()
+        connection.send_messages.side_effect = smtplib.SMTPRecipientsRefused(
+            {"nobody@example.com": (550, b"No such user")}
+        )
+        
+        with mock.patch('workorders.notifications.get_connection', return_value=connection):
+            results = send_pending_emails()
+        
+        outbound.refresh_from_db()
+        self.assertEqual(results['failed'], 1)
+        self.assertEqual(outbound.status, 'failed')
+    
+    def test_temporarily_refused_recipient_is_retried(self):
+        """Test that a 4xx recipient refusal defers the email with backoff"""
+        outbound = queue_email("busy@example.com", "Subject", "Body")
+        connection = mock.Mock()
+        connection.send_messages.side_effect = smtplib.SMTPRecipientsRefused(
+            {"busy@example.com": (451, b"Try again later")}
+        )
+        
+        with mock.patch('workorders.notifications.get_connection', return_value=connection):
+            results = send_pending_emails()
+        
+        outbound.refresh_from_db()
+        self.assertEqual(results['deferred'], 1)
+        self.assertEqual(outbound.status, 'pending')
+    
+    def test_batch_sent_in_one_call(self):
+        """Test that a batch is sent in one call and a refused recipient does not hold back the rest"""
+        for recipient in ("a@example.com", "nobody@example.com", "b@example.com"):
+            queue_email(recipient, "Subject", "Body")
+        delivered = []
+        
+        def send_messages(messages):
+            for message in messages:
+                if message.to == ["nobody@example.com"]:
+                    raise smtplib.SMTPRecipientsRefused({"nobody@example.com": (550, b"No such user")})
+                delivered.append(message.to[0])
+        
+        connection = mock.Mock()
+        connection.send_messages.side_effect = send_messages
+        with mock.patch('workorders.notifications.get_connection', return_value=connection):
+            results = send_pending_emails()
+        
+        self.assertEqual(results, {'sent': 2, 'deferred': 0, 'failed': 1})
+        self.assertCountEqual(delivered, ["a@example.com", "b@example.com"])
+        self.assertEqual(connection.send_messages.call_count, 2)
+        # Only the final close; the refusal left the session usable
+        connection.close.assert_called_once()
+        self.assertEqual(OutboundEmail.objects.get(status='failed').recipient, "nobody@example.com")
+    
+    def test_backend_failing_up_front_falls_back_to_single_messages(self):
+        """Test that a backend raising before it takes any message is retried one message at a time"""
+        for recipient in ("a@example.com", "b@example.com"):
+            queue_email(recipient, "Subject", "Body")
+        calls = []
+        
+        def send_messages(messages):
+            calls.append(messages)
+            if len(calls) == 1:
+                raise smtplib.SMTPServerDisconnected("gone")
+            return len(list(messages))
+        
+        connection = mock.Mock()
+        connection.send_messages.side_effect = send_messages
+        with mock.patch('workorders.notifications.get_connection', return_value=connection):
+            results = send_pending_emails()
+        
+        self.assertEqual(results, {'sent': 2, 'deferred': 0, 'failed': 0})
+        # The whole batch, then the first message alone, then the rest
+        self.assertEqual(len(calls), 3)
+
+
+class EmailTemplateCacheTestCase(TestCase):
+    """Test cases for compiled email templates and status notifications"""
+    
+    def setUp(self):
+        self.task_type = TaskType.objects.create(name="Email", points_base=10)
+        self.task_category = TaskCategory.objects.create(name="Inbox")
+        self.requester = User.objects.create_user(
+            username="requester", email="requester@example.com", first_name="Rita"
+        )
+        self.work_order = WorkOrder.objects.create(
+            title="Printer jammed",
+            description="Paper stuck",
+            task_type=self.task_type,
+            task_category=self.task_category,
+            requester=self.requester
+        )
+        self.template = EmailTemplate.objects.create(
+            name="Created",
+            template_type='ticket_created',
+            subject="Ticket {{ ticket_number }}",
+            body="Hello {{ requester.first_name }}, we got {{ title }}."
+        )
+    
+    def test_cached_render_needs_no_queries(self):
+        """Test that a second render uses the compiled template cache"""
+        render_notification('ticket_created', self.work_order)
+        
+        with self.assertNumQueries(0):
+            subject, body = render_notification('ticket_created', self.work_order)
+        
+        self.assertEqual(subject, f"Ticket {self.work_order.ticket_number}")
+        self.assertEqual(body, "Hello Rita, we got Printer jammed.")
+    
+    def test_template_save_invalidates_cache(self):
+        """Test that editing a template is picked up on the next render"""
+        render_notification('ticket_created', self.work_order)
+        
+        self.template.subject = "New {{ ticket_number }}"
+        self.template.save()
+        
+        subject, body = render_notification('ticket_created', self.work_order)
+        self.assertEqual(subject, f"New {self.work_order.ticket_number}")
+        
+        self.template.delete()
+        self.assertIsNone(render_notification('ticket_created', self.work_order))
+    
+    def test_changes_from_other_processes_are_looked_up(self):
+        """Test that active templates are looked up again once they are old enough"""
+        render_notification('ticket_created', self.work_order)
+        # An update without signals, as seen by a process that did not make it
+        EmailTemplate.objects.filter(pk=self.template.pk).update(
+            subject="Other {{ ticket_number }}", updated_at=timezone.now()
+        )
+        subject, body = render_notification('ticket_created', self.work_order)
+        self.assertEqual(subject, f"Ticket {self.work_order.ticket_number}")
+        
+        with override_settings(NOTIFICATION_TEMPLATE_LOOKUP_SECONDS=0):
+            render_notification('ticket_created', self.work_order)
+            subject, body = render_notification('ticket_created', self.work_order)
+        self.assertEqual(subject, f"Other {self.work_order.ticket_number}")
+    
+    def test_status_change_queues_configured_notification(self):
+        """Test that resolving a ticket queues the ticket_resolved template"""
+        EmailTemplate.objects.create(
+            name="Resolved",
+            template_type='ticket_resolved',
+            subject="Resolved {{ ticket_number }}",
+            body="Status: {{ status }}"
+        )
+        
+        self.work_order.status = 'in_progress'
+        self.work_order.save()
+        self.assertFalse(OutboundEmail.objects.exists())
+        
+        self.work_order.status = 'resolved'
+        self.work_order.save()
+        
+        outbound = OutboundEmail.objects.get()
+        self.assertEqual(outbound.recipient, "requester@example.com")
+        self.assertEqual(outbound.subject, f"Resolved {self.work_order.ticket_number}")
+        self.assertEqual(outbound.body, "Status: Resolved")
+    
+    def test_status_change_of_loaded_ticket_seen_by_both_handlers(self):
+        """Test that the stored status is kept without a post_init receiver"""
+        EmailTemplate.objects.create(
+            name="Resolved", template_type='ticket_resolved', subject="Resolved", body="Done"
+        )
+        self.assertFalse(post_init.has_listeners(WorkOrder))
+        
+        work_order = WorkOrder.objects.get(pk=self.work_order.pk)
+        work_order.status = 'resolved'
+        with mock.patch('workorders.assignment.adjust_open_ticket_counts') as adjust_counts:
+            work_order.save()
+            work_order.save()
+        
+        adjust_counts.assert_called_once()
+        self.assertEqual(adjust_counts.call_args[0][1], -1)
+        self.assertEqual(OutboundEmail.objects.get().subject, "Resolved")
+
+
+class EmailParsingTestCase(TestCase):
+    """Test cases for streaming MIME parsing of incoming emails"""
+    
+    def setUp(self):
+        self.processor = EmailProcessor(None)
+    
+    def _message_with_attachment(self, attachment_size):
+        message = MIMEMultipart()
+        message['Subject'] = 'Laptop screen broken'
+        message['From'] = 'Jane Roe <jane@example.com>'
+        message['Message-ID'] = '<abc@example.com>'
+        message.attach(MIMEText('The screen is cracked.', 'plain'))
+        attachment = MIMEApplication(b'\0' * attachment_size, Name='photo.bin')
+        attachment['Content-Disposition'] = 'attachment; filename="photo.bin"'
+        message.attach(attachment)
+        return message.as_bytes()
+    
+    def test_attachment_payload_not_kept(self):
+        """Test that attachment payloads are dropped while parsing"""
+        email_message = parse_message_bytes(self._message_with_attachment(200000), max_size=0)
+        
+        attachment = email_message.get_payload()[1]
+        self.assertEqual(attachment.get_payload(), '')
+        
+        parsed = self.processor._parse_email(email_message)
+        self.assertEqual(parsed['body'], 'The screen is cracked.')
+        self.assertEqual(parsed['sender_email'], 'jane@example.com')
+        self.assertNotIn('raw_message', parsed)
+    
+    def test_oversized_message_truncated(self):
+        """Test that only max_size bytes are parsed from a large message"""
+        raw = self._message_with_attachment(500000)
+        
+        email_message = parse_message_bytes(raw, max_size=4096)
+        parsed = self.processor._parse_email(email_message)
+        
+        self.assertEqual(parsed['subject'], 'Laptop screen broken')
+        self.assertEqual(parsed['body'], 'The screen is cracked.')
+    
+    def test_parse_from_line_chunks(self):
+        """Test parsing from an iterable of lines as POP3 returns them"""
+        raw = self._message_with_attachment(10)
+        lines = (line + b'\n' for line in raw.split(b'\n'))
+        
+        parsed = self.processor._parse_email(parse_message_bytes(lines))
+        self.assertEqual(parsed['message_id'], '<abc@example.com>')
+        self.assertEqual(parsed['body'], 'The screen is cracked.')
+    
+    def test_worker_parsing_reuses_one_processor(self):
+        """Test that parse_raw_email builds its EmailProcessor once per process"""
+        raw = self._message_with_attachment(10)
+        
+        with mock.patch('workorders.email_service._parse_processor', None), \
+                mock.patch('workorders.email_service.EmailProcessor', wraps=EmailProcessor) as processor_class:
+            parsed = [parse_raw_email(raw) for _ in range(3)]
+        
+        self.assertEqual(processor_class.call_count, 1)
+        self.assertEqual([email['subject'] for email in parsed], ['Laptop screen broken'] * 3)
+
+
+class HTMLToTextTestCase(TestCase):
+    """Test cases for converting HTML email bodies to text"""
+    
+    def test_drops_non_content_and_decodes_entities(self):
+        """Test that styles and scripts are dropped and entities decoded"""
+        html = (
+            '<html><head><title>Mail</title><style>p {color: red}</style></head>'
+            '<body><p>Printer on the 3<sup>rd</sup>&nbsp;floor &amp;\n lobby</p>'
+            '<script>alert(1)</script><!-- note --><ul><li>one</li><li>two</li></ul>'
+            '<table><tr><td>Asset</td><td>PRN-1</td></tr></table></body></html>'
+        )
+        
+        self.assertEqual(
+            html_to_text(html),
+            'Printer on the 3rd floor & lobby\n\n- one\n- two\n\nAsset PRN-1'
+        )
+    
+    def test_output_capped(self):
+        """Test that the output is cut at max_length"""
+        text = html_to_text('<p>' + 'word ' * 10000 + '</p>', max_length=20)
+        self.assertEqual(text, 'word word word word')
+    
+    def test_capped_output_matches_whole_conversion(self):
+        """Test that converting only the start of a long body gives the same text"""
+        html = '<style>p {margin: 0}</style>' + (
+            '<p>Printer <b>3</b>&nbsp;jams &amp; beeps</p><ul><li>tray</li></ul>' * 5000
+        )
+        self.assertEqual(html_to_text(html, max_length=1000), html_to_text(html)[:1000].rstrip())
+        self.assertEqual(html_to_text('plain words ' * 5000, max_length=50), ('plain words ' * 5)[:50].strip())
+    
+    def test_unclosed_markup(self):
+        """Test that unclosed tags and head sections do not swallow text"""
+        self.assertEqual(html_to_text('<head><style>x</style><body>Hi</body>'), 'Hi')
+        self.assertEqual(html_to_text('if a <b then x'), 'if a <b then x')
+        self.assertEqual(html_to_text('a < b and c > d'), 'a < b and c > d')
+
+
+class EmailThreadingTestCase(TestCase):
+    """Test cases for threading email replies onto existing work orders"""
+    
+    def setUp(self):
+        self.task_type = TaskType.objects.create(name="Email", points_base=10)
+        self.task_category = TaskCategory.objects.create(name="Inbox")
+        self.account = EmailAccount.objects.create(
+            name="Support",
+            email_address="support@example.com",
+            host="localhost",
+            username="support",
+            password="secret",
+            default_task_type=self.task_type,
+            default_task_category=self.task_category,
+        )
+    
+    def _process(self, *messages):
+        processor = EmailProcessor(self.account)
+        emails = [processor._parse_email(parse_message_bytes(m.as_bytes())) for m in messages]
+        with mock.patch.object(processor, 'fetch_emails', return_value=emails):
+            return processor.process_emails()
+    
+    def _message(self, message_id, subject, body, **headers):
+        message = MIMEText(body)
+        message['Subject'] = subject
+        message['From'] = 'Jane Roe <jane@example.com>'
+        message['Message-ID'] = message_id
+        for name, value in headers.items():
+            message[name.replace('_', '-')] = value
+        return message
+    
+    def test_reply_to_confirmation_becomes_comment(self):
+        """Test that a reply to the confirmation email is added as a comment"""
+        self._process(self._message('<first@example.com>', 'VPN down', 'Cannot connect'))
+        work_order = WorkOrder.objects.get()
+        confirmation = OutboundEmail.objects.get(work_order=work_order)
+        self.assertTrue(
+            EmailMessageIndex.objects.filter(message_id=confirmation.message_id).exists()
+        )
+        
+        results = self._process(self._message(
+            '<second@example.com>', 'Re: Ticket Created', 'Still broken',
+            In_Reply_To=confirmation.message_id
+        ))
+        
+        self.assertEqual(results['comments'], 1)
+        self.assertEqual(results['created'], 0)
+        self.assertEqual(WorkOrder.objects.count(), 1)
+        self.assertEqual(work_order.comments.get().comment, 'Still broken')
+        self.assertEqual(
+            ProcessedEmail.objects.get(message_id='<second@example.com>').work_order,
+            work_order
+        )
+    
+    def test_references_and_subject_tag_thread_replies(self):
+        """Test threading through References and a [WO-...] subject tag"""
+        self._process(self._message('<first@example.com>', 'VPN down', 'Cannot connect'))
+        work_order = WorkOrder.objects.get()
+        
+        self._process(
+            self._message(
+                '<second@example.com>', 'Re: VPN down', 'Any news?',
+                References='<unknown@example.com> <first@example.com>'
+            ),
+            self._message(
+                '<third@example.com>', f'Update [{work_order.ticket_number}]', 'Fixed now'
+            ),
+        )
+        
+        self.assertEqual(WorkOrder.objects.count(), 1)
+        self.assertEqual(work_order.comments.count(), 2)
+
+
+class MailboxFixtureTestCase(TestCase):
+    """Base class for tests reading a local mbox of support emails"""
+    
+    def setUp(self):
+        self.task_type = TaskType.objects.create(name="Email", points_base=10)
+        self.task_category = TaskCategory.objects.create(name="Inbox")
+        self.account = EmailAccount.objects.create(
+            name="Support",
+            email_address="support@example.com",
+            host="localhost",
+            username="support",
+            password="secret",
+            default_task_type=self.task_type,
+            default_task_category=self.task_category,
+        )
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.mbox_path = os.path.join(self.tempdir.name, 'support.mbox')
+        box = mailbox.mbox(self.mbox_path)
+        for i in range(3):
+            message = MIMEText(f'Problem number {i}')
+            message['Subject'] = f'Problem {i}'
+            message['From'] = f'user{i}@example.com'
+            message['Message-ID'] = f'<problem-{i}@example.com>'
+            box.add(message)
+        box.close()
+
+
+class MailboxReplayTestCase(MailboxFixtureTestCase):
+    """Test cases for replaying local mailboxes through process_emails"""
+    
+    def _run(self, *args):
+        out = io.StringIO()
+        call_command(
+            'process_emails', '--account', 'Support', '--source', f'mbox:{self.mbox_path}',
+            *args, stdout=out
+        )
+        return out.getvalue()
+    
+    def test_mbox_replay_creates_tickets(self):
+        """Test that an mbox replay creates tickets and reports throughput"""
+        output = self._run()
+        
+        self.assertEqual(WorkOrder.objects.count(), 3)
+        self.assertEqual(OutboundEmail.objects.count(), 3)
+        self.assertIn('Throughput:', output)
+        self.assertIn('parse', output)
+        
+        # Replaying the same mailbox again finds only duplicates
+        self.assertIn('Duplicates: 3', self._run())
+        self.assertEqual(WorkOrder.objects.count(), 3)
+    
+    def test_dry_run_rolls_back(self):
+        """Test that a dry run reports what it would do and changes nothing"""
+        output = self._run('--dry-run')
+        
+        self.assertIn('would create WO-000001', output)
+        self.assertIn('Created: 3', output)
+        self.assertFalse(WorkOrder.objects.exists())
+        self.assertFalse(ProcessedEmail.objects.exists())
+        self.assertFalse(OutboundEmail.objects.exists())
+        self.assertFalse(User.objects.exists())
+
+
+class EmailRunHistoryTestCase(MailboxFixtureTestCase):
+    """Test cases for per-run stage timings of the email pipeline"""
+    
+    def test_run_is_recorded_and_logged(self):
+        """Test that a run saves its stage timings and logs them as structured lines"""
+        source = LocalMailboxSource.from_spec(f'mbox:{self.mbox_path}')
+        with self.assertLogs('workorders.email', level='INFO') as logs:
+            result = EmailProcessor(self.account, source=source).process_emails(limit=None)
+        
+        run = EmailProcessingRun.objects.get()
+        self.assertEqual(run.source, str(source))
+        self.assertEqual(run.fetched_messages, 3)
+        self.assertEqual(run.fetched_bytes, result['stages']['fetch']['bytes'])
+        self.assertGreater(run.fetched_bytes, 0)
+        self.assertEqual(run.created, 3)
+        self.assertEqual(
+            set(run.stages), {'fetch', 'parse', 'dedup', 'create', 'notify'}
+        )
+        self.assertEqual(run.stages['parse']['count'], 3)
+        self.assertTrue(any('stage=parse' in line for line in logs.output))
+        self.assertTrue(any(
+            'email_run account="Support"' in line and 'created=3' in line
+            for line in logs.output
+        ))
+    
+    def test_dry_run_is_recorded(self):
+        """Test that a dry run keeps its run history while rolling back the rest"""
+        source = LocalMailboxSource.from_spec(f'mbox:{self.mbox_path}')
+        EmailProcessor(self.account, source=source, dry_run=True).process_emails(limit=None)
+        
+        run = EmailProcessingRun.objects.get()
+        self.assertTrue(run.dry_run)
+        self.assertEqual(run.created, 3)
+        self.assertFalse(WorkOrder.objects.exists())
+    
+    def test_connection_failure_is_recorded(self):
+        """Test that a run which cannot reach the mail server records why"""
+        with mock.patch('imaplib.IMAP4_SSL', side_effect=OSError('Connection refused')), \
+                self.assertLogs('workorders.email', level='ERROR'):
+            EmailProcessor(self.account).process_emails()
+        
+        run = EmailProcessingRun.objects.get()
+        self.assertEqual(run.error, 'Connection refused')
+        self.assertEqual(run.fetched_messages, 0)
+
+
+class EmailAccountLeaseTestCase(MailboxFixtureTestCase):
+    """Test cases for the per-account lease shared by concurrent runners"""
+    
+    def test_lease_is_exclusive_until_released(self):
+        """Test that a second runner skips an account another runner holds"""
+        source = LocalMailboxSource.from_spec(f'mbox:{self.mbox_path}')
+        first = EmailProcessor(self.account, source=source)
+        second = EmailProcessor(self.account, source=source)
+        
+        self.assertTrue(first.acquire_lease())
+        self.assertFalse(second.acquire_lease())
+        self.assertEqual(second.process_emails(limit=None), {
+            'skipped': 'Another runner is processing this account'
+        })
+        self.assertFalse(WorkOrder.objects.exists())
+        
+        first.release_lease()
+        self.assertEqual(second.process_emails(limit=None)['created'], 3)
+        # process_emails releases the lease when it is done
+        self.assertEqual(EmailAccountLease.objects.get().owner, '')
+    
+    def test_expired_lease_is_taken_over(self):
+        """Test that a runner that died does not block the account forever"""
+        EmailAccountLease.objects.create(
+            email_account=self.account,
+            owner='crashed-host:1:dead',
+            expires_at=timezone.now() - timedelta(seconds=1)
+        )
+        processor = EmailProcessor(self.account)
+        self.assertTrue(processor.acquire_lease())
+        self.assertEqual(EmailAccountLease.objects.get().owner, processor.lease_owner)
+    
+    def test_lost_lease_stops_processing(self):
+        """Test that a runner stops once another runner has taken its expired lease"""
+        source = LocalMailboxSource.from_spec(f'mbox:{self.mbox_path}')
+        processor = EmailProcessor(self.account, source=source)
+        
+        def take_over(*args):
+            EmailAccountLease.objects.update(owner='other', expires_at=timezone.now() + timedelta(hours=1))
+            return False
+        
+        with mock.patch.object(EmailProcessor, '_keep_lease', side_effect=take_over), \
+                self.assertLogs('workorders.email', level='WARNING'):
+            result = processor.process_emails(limit=None)
+        
+        self.assertEqual(result['processed'], 0)
+        self.assertEqual(EmailAccountLease.objects.get().owner, 'other')
+
+
+class EmailRetryTestCase(MailboxFixtureTestCase):
+    """Test cases for retrying failed emails from the stored copy"""
+    
+    def _fail_first_run(self):
+        source = LocalMailboxSource.from_spec(f'mbox:{self.mbox_path}')
+        with mock.patch.object(EmailProcessor, '_create_work_order_from_email', return_value=None):
+            return EmailProcessor(self.account, source=source).process_emails(limit=None)
+    
+    def test_failed_emails_are_retried_without_fetching(self):
+        """Test that due failed emails become tickets on a retry-only run"""
+        self.assertEqual(self._fail_first_run()['errors'], 3)
+        failed = ProcessedEmail.objects.filter(processing_status='failed')
+        self.assertEqual(failed.count(), 3)
+        self.assertTrue(all(record.attempts == 1 and record.next_attempt_at for record in failed))
+        self.assertEqual(failed.get(message_id='<problem-1@example.com>').retry_data['body'], 'Problem number 1')
+        
+        # Not due yet
+        result = EmailProcessor(self.account).process_emails(retry_only=True)
+        self.assertEqual(result['retried'], 0)
+        
+        ProcessedEmail.objects.update(next_attempt_at=timezone.now())
+        with mock.patch.object(EmailProcessor, 'connect') as connect:
+            result = EmailProcessor(self.account).process_emails(retry_only=True)
+        connect.assert_not_called()
+        
+        self.assertEqual(result['retried'], 3)
+        self.assertEqual(result['created'], 3)
+        self.assertEqual(WorkOrder.objects.get(title='Problem 1').description, 'Problem number 1')
+        self.assertFalse(ProcessedEmail.objects.exclude(processing_status='success').exists())
+        self.assertFalse(ProcessedEmail.objects.exclude(retry_data={}).exists())
+    
+    def _collide_ticket_numbers(self):
+        # Tickets are numbered by count + 1, which collides once an older one is deleted
+        requester = User.objects.create_user('requester')
+        for title in ('First', 'Second'):
+            WorkOrder.objects.create(
+                title=title, description='', task_type=self.task_type,
+                task_category=self.task_category, requester=requester
+            )
+        WorkOrder.objects.get(title='First').delete()
+    
+    def test_database_error_schedules_a_retry(self):
+        """Test that an IntegrityError while creating a ticket still records the email as failed"""
+        self._collide_ticket_numbers()
+        source = LocalMailboxSource.from_spec(f'mbox:{self.mbox_path}')
+        processor = EmailProcessor(self.account, source=source)
+        with self.assertLogs('workorders.email', level='ERROR'):
+            result = processor.process_emails(limit=None)
+        
+        # Recorded inside the ingest transaction, not by the crash handler
+        self.assertEqual(result['processed'], 3)
+        self.assertEqual(result['errors'], 3)
+        failed = ProcessedEmail.objects.filter(processing_status='failed', next_attempt_at__isnull=False)
+        self.assertEqual(failed.count(), 3)
+        record = failed.get(message_id='<problem-0@example.com>')
+        self.assertEqual(record.processing_notes, 'Could not create a ticket or comment from this email')
+        self.assertEqual(record.retry_data['body'], 'Problem number 0')
+    
+    def test_rolled_back_users_are_not_cached(self):
+        """Test that a sender whose new user was rolled back is not reused from the run's cache"""
+        self._collide_ticket_numbers()
+        processor = EmailProcessor(self.account)
+        email_data = {
+            'message_id': '<problem-0@example.com>', 'subject': 'Problem 0', 'body': 'Problem number 0',
+            'sender_email': 'user0@example.com', 'sender_name': '', 'received_date': timezone.now(),
+            'in_reply_to': [], 'references': [],
+        }
+        with self.assertLogs('workorders.email', level='ERROR'):
+            processor._ingest_email(email_data)
+        
+        self.assertFalse(User.objects.filter(email='user0@example.com').exists())
+        self.assertNotIn('user0@example.com', processor._user_cache)
+    
+    @override_settings(EMAIL_RETRY_MAX_ATTEMPTS=2, EMAIL_RETRY_BASE_SECONDS=60, EMAIL_RETRY_MAX_SECONDS=100)
+    def test_backoff_and_giving_up(self):
+        """Test capped exponential backoff and that retries stop after the last attempt"""
+        self.assertEqual(get_retry_delay(1), timedelta(seconds=60))
+        self.assertEqual(get_retry_delay(2), timedelta(seconds=100))
+        
+        before = timezone.now()
+        self._fail_first_run()
+        record = ProcessedEmail.objects.get(message_id='<problem-0@example.com>')
+        self.assertLessEqual(record.next_attempt_at - before, timedelta(seconds=61))
+        
+        ProcessedEmail.objects.update(next_attempt_at=timezone.now())
+        with mock.patch.object(EmailProcessor, '_create_work_order_from_email', return_value=None):
+            result = EmailProcessor(self.account).process_emails(retry_only=True)
+        self.assertEqual(result['errors'], 3)
+        record.refresh_from_db()
+        self.assertEqual(record.attempts, 2)
+        self.assertIsNone(record.next_attempt_at)
+    
+    def test_admin_requeue_action(self):
+        """Test that the admin action makes given-up emails due again"""
+        self._fail_first_run()
+        ProcessedEmail.objects.update(attempts=5, next_attempt_at=None)
+        admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(admin_user)
+        
+        response = self.client.post('/admin/workorders/processedemail/', {
+            'action': 'requeue',
+            '_selected_action': list(ProcessedEmail.objects.values_list('pk', flat=True)),
+        }, follow=True)
+        
+        self.assertContains(response, '3 email(s) will be retried')
+        self.assertFalse(ProcessedEmail.objects.filter(next_attempt_at__isnull=True).exists())
+        self.assertFalse(ProcessedEmail.objects.exclude(attempts=0).exists())
+
+
+class EmailBackfillTestCase(MailboxFixtureTestCase):
+    """Test cases for importing mailbox history with backfill_emails"""
+    
+    def test_backfill_imports_with_worker_pool(self):
+        """Test that a backfill creates tickets, threads replies and is resumable"""
+        box = mailbox.mbox(self.mbox_path)
+        reply = MIMEText('Same problem again')
+        reply['Subject'] = 'Re: Problem 0'
+        reply['From'] = 'user0@example.com'
+        reply['Message-ID'] = '<reply@example.com>'
+        reply['In-Reply-To'] = '<problem-0@example.com>'
+        reply['Date'] = 'Tue, 02 Jan 2018 10:00:00 +0000'
+        box.add(reply)
+        box.close()
+        
+        out = io.StringIO()
+        call_command(
+            'backfill_emails', '--account', 'Support', '--source', f'mbox:{self.mbox_path}',
+            '--workers', '2', '--batch-size', '2', stdout=out
+        )
+        
+        self.assertIn('Created: 3', out.getvalue())
+        self.assertEqual(WorkOrder.objects.filter(status='closed').count(), 3)
+        first = WorkOrder.objects.get(title='Problem 0')
+        comment = first.comments.get()
+        self.assertEqual(comment.comment, 'Same problem again')
+        self.assertEqual(comment.created_at.year, 2018)
+        self.assertFalse(OutboundEmail.objects.exists())
+        
+        # Importing again skips everything already imported
+        out = io.StringIO()
+        call_command(
+            'backfill_emails', '--account', 'Support', '--source', f'mbox:{self.mbox_path}',
+            '--workers', '2', stdout=out
+        )
+        self.assertIn('Duplicates: 4', out.getvalue())
+        self.assertEqual(WorkOrder.objects.count(), 3)
+    
+    def test_backfill_invalidates_cached_pages(self):
+        """Test that imported tickets drop pages cached from tickets, though no signal is sent"""
+        versions = get_versions('workorder', 'assignment')
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command(
+                'backfill_emails', '--account', 'Support', '--source', f'mbox:{self.mbox_path}',
+                '--workers', '2', stdout=io.StringIO()
+            )
+        self.assertNotEqual(get_versions('workorder', 'assignment'), versions)
+
+
+class EmailProcessorEndToEndTestCase(TestCase):
+    """Test cases running EmailProcessor against local fake mail servers"""
+    
+    def setUp(self):
+        self.task_type = TaskType.objects.create(name="Email", points_base=10)
+        self.task_category = TaskCategory.objects.create(name="Inbox")
+        self.messages = generate_messages(20, seed=1)
+    
+    def _serve(self, server):
+        server.start()
+        self.addCleanup(server.stop)
+        return server
+    
+    def _account(self, server, protocol='imap', password='secret', name="Support"):
+        return EmailAccount.objects.create(
+            name=name,
+            email_address="support@example.com",
+            protocol=protocol,
+            host=server.host,
+            port=server.port,
+            username="support",
+            password=password,
+            use_ssl=False,
+            default_task_type=self.task_type,
+            default_task_category=self.task_category,
+        )
+    
+    def test_imap_end_to_end(self):
+        """Test that unread IMAP messages become tickets and replies, and are marked as read"""
+        server = self._serve(FakeIMAPServer(self.messages))
+        account = self._account(server)
+        
+        processor = EmailProcessor(account)
+        result = processor.process_emails(limit=100)
+        processor.disconnect()
+        
+        self.assertEqual(result['errors'], 0)
+        self.assertEqual(result['created'] + result['comments'], 20)
+        self.assertGreater(result['comments'], 0)
+        self.assertEqual(WorkOrder.objects.count(), result['created'])
+        self.assertEqual(OutboundEmail.objects.count(), result['created'])
+        self.assertTrue(all(message.seen for message in server.messages))
+        
+        # Everything was read, so a second run finds nothing new
+        processor = EmailProcessor(account)
+        self.assertEqual(processor.process_emails(limit=100)['processed'], 0)
+        processor.disconnect()
+    
+    def test_imap_dry_run_leaves_messages_unread(self):
+        """Test that a dry run peeks at IMAP messages and creates nothing"""
+        server = self._serve(FakeIMAPServer(self.messages))
+        processor = EmailProcessor(self._account(server), dry_run=True)
+        result = processor.process_emails(limit=100)
+        processor.disconnect()
+        
+        self.assertEqual(result['created'] + result['comments'], 20)
+        self.assertFalse(WorkOrder.objects.exists())
+        self.assertFalse(any(message.seen for message in server.messages))
+    
+    @override_settings(EMAIL_MAX_MESSAGE_SIZE=8 * 1024)
+    def test_pop3_end_to_end(self):
+        """Test POP3 ingestion, including oversized messages and reruns"""
+        server = self._serve(FakePOP3Server(self.messages))
+        account = self._account(server, protocol='pop3')
+        
+        processor = EmailProcessor(account)
+        result = processor.process_emails(limit=100)
+        processor.disconnect()
+        self.assertEqual(result['errors'], 0)
+        self.assertEqual(result['created'] + result['comments'], 20)
+        
+        # POP3 has no read flag; messages handled before are known by their
+        # unique ids and not downloaded again
+        downloads = server.commands['RETR'] + server.commands['TOP']
+        processor = EmailProcessor(account)
+        self.assertEqual(processor.process_emails(limit=100)['processed'], 0)
+        processor.disconnect()
+        self.assertEqual(server.commands['RETR'] + server.commands['TOP'], downloads)
+        self.assertEqual(POP3SeenMessage.objects.filter(email_account=account).count(), 20)
+    
+    def test_pop3_unparsable_message_not_downloaded_again(self):
+        """Test that a POP3 message that cannot be parsed is remembered with the error"""
+        server = self._serve(FakePOP3Server(self.messages))
+        account = self._account(server, protocol='pop3')
+        parse_email = EmailProcessor._parse_email
+        
+        def parse_all_but_issue_3(processor, email_message):
+            return None if email_message['Subject'] == 'Issue 3' else parse_email(processor, email_message)
+        
+        with mock.patch.object(EmailProcessor, '_parse_email', parse_all_but_issue_3):
+            processor = EmailProcessor(account)
+            processor.process_emails(limit=100)
+            processor.disconnect()
+            downloads = server.commands['RETR']
+            
+            processor = EmailProcessor(account)
+            self.assertEqual(processor.process_emails(limit=100)['processed'], 0)
+            processor.disconnect()
+        
+        self.assertEqual(server.commands['RETR'], downloads)
+        failed = POP3SeenMessage.objects.exclude(error='')
+        self.assertEqual([seen.uid for seen in failed], [server.messages[3].uid])
+        self.assertEqual(failed.get().error, 'Could not parse the message')
+    
+    def test_backlog_drains_oldest_first(self):
+        """Test that backlog mode processes every unread message, oldest first"""
+        server = self._serve(FakeIMAPServer(self.messages))
+        processor = EmailProcessor(self._account(server))
+        result = processor.process_emails(limit=5, time_budget=60)
+        processor.disconnect()
+        
+        self.assertEqual(result['created'] + result['comments'], 20)
+        self.assertEqual(result['backlog'], 0)
+        self.assertEqual(WorkOrder.objects.get(ticket_number='WO-000001').title, 'Issue 0')
+        self.assertTrue(all(message.seen for message in server.messages))
+    
+    def test_backlog_stops_at_time_budget(self):
+        """Test that backlog mode stops when the budget is spent and reports what is left"""
+        server = self._serve(FakeIMAPServer(self.messages))
+        processor = EmailProcessor(self._account(server))
+        result = processor.process_emails(limit=5, time_budget=0.000001)
+        processor.disconnect()
+        
+        self.assertEqual(result['processed'], 5)
+        self.assertEqual(result['backlog'], 15)
+        self.assertEqual(sum(message.seen for message in server.messages), 5)
+        self.assertFalse(any(message.seen for message in server.messages[5:]))
+    
+    def test_pop3_backlog_skips_processed_messages(self):
+        """Test that POP3 backlog mode only downloads messages not processed before"""
+        server = self._serve(FakePOP3Server(self.messages))
+        account = self._account(server, protocol='pop3')
+        processor = EmailProcessor(account)
+        processor.process_emails(limit=5)
+        processor.disconnect()
+        
+        processor = EmailProcessor(account)
+        result = processor.process_emails(limit=5, time_budget=60)
+        processor.disconnect()
+        self.assertEqual(result['duplicates'], 0)
+        self.assertEqual(result['processed'], 15)
+        self.assertEqual(result['stages']['fetch']['count'], 15)
+        self.assertEqual(ProcessedEmail.objects.count(), 20)
+        # Only the headers of the 15 messages not seen before were read
+        self.assertEqual(server.commands['TOP'], 15)
+        
+        processor = EmailProcessor(account)
+        result = processor.process_emails(limit=5, time_budget=60)
+        processor.disconnect()
+        self.assertEqual(result['processed'], 0)
+        self.assertEqual(server.commands['TOP'], 15)
+        self.assertEqual(server.commands['RETR'], 20)
+    
+    def test_pop3_forgets_deleted_messages(self):
+        """Test that unique ids of messages no longer on the server are dropped"""
+        server = self._serve(FakePOP3Server(self.messages))
+        account = self._account(server, protocol='pop3')
+        processor = EmailProcessor(account)
+        processor.process_emails(limit=100)
+        processor.disconnect()
+        
+        del server.messages[:5]
+        processor = EmailProcessor(account)
+        self.assertEqual(processor.process_emails(limit=100)['processed'], 0)
+        processor.disconnect()
+        self.assertEqual(POP3SeenMessage.objects.filter(email_account=account).count(), 15)
+    
+    def test_time_budget_is_shared_by_all_accounts(self):
+        """Test that accounts reached after the time budget ran out are skipped"""
+        server = self._serve(FakeIMAPServer(self.messages))
+        self._account(server)
+        EmailAccount.objects.filter(name="Support").update(email_address="first@example.com")
+        self._account(server, name="Second")
+        budgets = []
+        
+        def spend_budget(processor, retry_only=False, time_budget=None):
+            budgets.append(time_budget)
+            time.sleep(time_budget)
+            return {'processed': 0}
+        
+        with mock.patch.object(EmailProcessor, 'process_emails', spend_budget):
+            results = process_all_email_accounts(time_budget=0.05)
+        
+        # Neither account was processed yet, so they go by name
+        self.assertEqual(len(budgets), 1)
+        self.assertLessEqual(budgets[0], 0.05)
+        self.assertEqual(results['Second'], {'processed': 0})
+        self.assertIn('skipped', results['Support'])
+    
+    def test_login_failure_is_recorded(self):
+        """Test that a rejected login creates nothing and records the error"""
+        server = self._serve(FakeIMAPServer(self.messages))
+        account = self._account(server, password='wrong')
+        
+        with self.assertLogs('workorders.email', level='ERROR'):
+            result = EmailProcessor(account).process_emails()
+        
+        self.assertEqual(result['processed'], 0)
+        self.assertIn('Invalid credentials', EmailProcessingRun.objects.get().error)
+    
+    def test_confirmations_delivered_over_smtp(self):
+        """Test that queued confirmations reach the SMTP server with their Message-ID"""
+        imap_server = self._serve(FakeIMAPServer(self.messages))
+        smtp_server = self._serve(FakeSMTPServer(rejected_recipients=['user0@example.com']))
+        processor = EmailProcessor(self._account(imap_server))
+        processor.process_emails()
+        processor.disconnect()
+        
+        with override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST=smtp_server.host,
+            EMAIL_PORT=smtp_server.port,
+            EMAIL_HOST_USER='',
+            EMAIL_HOST_PASSWORD='',
+            EMAIL_USE_TLS=False,
+            EMAIL_USE_SSL=False,
+        ):
+            results = send_pending_emails()
+        
+        delivered = OutboundEmail.objects.filter(status='sent')
+        self.assertGreater(results['sent'], 0)
+        self.assertGreater(results['failed'], 0)
+        self.assertEqual(results['sent'], len(smtp_server.received))
+        self.assertEqual(results['sent'] + results['failed'], OutboundEmail.objects.count())
+        for outbound in delivered:
+            self.assertTrue(any(
+                envelope['to'] == [outbound.recipient]
+                and f'Message-ID: {outbound.message_id}'.encode() in envelope['data']
+                for envelope in smtp_server.received
+            ))
+        for outbound in OutboundEmail.objects.filter(status='failed'):
+            self.assertEqual(outbound.recipient, 'user0@example.com')
+        # Refused recipients do not cost a reconnect
+        self.assertEqual(smtp_server.sessions, 1)
+    
+    def test_benchmark_command(self):
+        """Test that the ingestion benchmark reports throughput and leaves no data behind"""
+        out = io.StringIO()
+        call_command('benchmark_email_ingestion', '--sizes', '10', stdout=out)
+        
+        self.assertIn('q/msg', out.getvalue())
+        self.assertFalse(WorkOrder.objects.exists())
+        self.assertFalse(EmailAccount.objects.exists())
+
+
+class GeocodeCacheTestCase(TestCase):
+    """Test cases for cached geocoding lookups"""
+    
+    PLACE = {'latitude': 14.55, 'longitude': 121.02, 'display_name': 'Makati, Metro Manila'}
+    
+    def setUp(self):
+        recent_results.clear()
+        self.addCleanup(recent_results.clear)
+        patcher = mock.patch.object(GeocodingClient, 'search', return_value=self.PLACE)
+        self.lookup = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(GeocodingClient, 'asearch', return_value=self.PLACE)
+        self.async_lookup = patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def test_normalize_location(self):
+        """Test that case, spacing and separators do not change the key"""
+        self.assertEqual(normalize_location('  Makati ,  Metro   Manila. '), 'makati metro manila')
+        self.assertEqual(normalize_location('MAKATI, METRO MANILA'), 'makati metro manila')
+    
+    def test_repeated_lookups_do_not_hit_the_network(self):
+        """Test that a location is looked up once, then served from memory or the table"""
+        self.assertEqual(geocode('Makati, Metro Manila'), self.PLACE)
+        self.assertEqual(geocode('makati  metro manila'), self.PLACE)
+        self.assertEqual(self.lookup.call_count, 1)
+        
+        # Another process only has the table
+        recent_results.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(geocode('Makati, Metro Manila'), self.PLACE)
+        self.assertEqual(self.lookup.call_count, 1)
+        self.assertTrue(GeocodeCache.objects.get(query='makati metro manila').found)
+    
+    def test_not_found_is_cached(self):
+        """Test negative caching of unknown places"""
+        self.lookup.return_value = None
+        self.assertIsNone(geocode('Nowhere at all'))
+        recent_results.clear()
+        self.assertIsNone(geocode('Nowhere at all'))
+        self.assertEqual(self.lookup.call_count, 1)
+        self.assertFalse(GeocodeCache.objects.get(query='nowhere at all').found)
+    
+    def test_expired_entry_is_looked_up_again(self):
+        """Test that entries past their TTL are refreshed"""
+        geocode('Makati')
+        GeocodeCache.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        recent_results.clear()
+        geocode('Makati')
+        self.assertEqual(self.lookup.call_count, 2)
+        self.assertGreater(GeocodeCache.objects.get().expires_at, timezone.now())
+    
+    def test_service_errors_are_not_cached(self):
+        """Test that a failed lookup is retried on the next call"""
+        self.lookup.side_effect = GeocodingError('Request timed out. Please try again.')
+        with self.assertRaises(GeocodingError):
+            geocode('Makati')
+        self.assertFalse(GeocodeCache.objects.exists())
+    
+    def test_geocode_view(self):
+        """Test the geocoding endpoint's JSON responses"""
+        user = User.objects.create_user('tech', password='password')
+        self.client.force_login(user)
+        
+        response = self.client.post('/geocode/', {'location_name': 'Makati'})
+        self.assertEqual(response.json(), {'success': True, **self.PLACE})
+        
+        self.lookup.side_effect = GeocodingError('Request timed out. Please try again.')
+        response = self.client.post('/geocode/', {'location_name': 'Taguig'})
+        self.assertEqual(response.json(), {'success': False, 'error': 'Request timed out. Please try again.'})
+        # Under WSGI the pooled sync client is used, not one per request's event loop
+        self.async_lookup.assert_not_called()
+    
+    def test_geocode_view_under_asgi(self):
+        """Test that the endpoint uses the async client when served over ASGI"""
+        user = User.objects.create_user('tech', password='password')
+        self.async_client.force_login(user)
+        
+        response = async_to_sync(self.async_client.post)('/geocode/', {'location_name': 'Makati'})
+        self.assertEqual(response.json(), {'success': True, **self.PLACE})
+        self.async_lookup.assert_called_once_with('Makati')
+        self.lookup.assert_not_called()
+
+
+class GeocodingClientTestCase(TestCase):
+    """Test cases for the rate-limited geocoding client"""
+    
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.geocoder = GeocodingClient(url='https://geocoder.invalid/search', rate=1, burst=1)
+    
+    def _response(self, status_code=200, payload=None, headers=None):
+        response = mock.Mock(status_code=status_code, headers=headers or {})
+        response.json.return_value = payload
+        return response
+    
+    def test_rate_limiter_is_shared_through_the_cache(self):
+        """Test that two limiters on the same key share one bucket"""
+        first = RateLimiter('test:bucket', rate=1, burst=2)
+        second = RateLimiter('test:bucket', rate=1, burst=2)
+        with mock.patch('workorders.geocoding.time.time', return_value=1000.5):
+            self.assertEqual(first.take(), 0)
+            self.assertEqual(second.take(), 0)
+            self.assertAlmostEqual(first.take(), 0.5)
+        with mock.patch('workorders.geocoding.time.time', return_value=1001.0):
+            self.assertEqual(second.take(), 0)
+    
+    def test_rate_limiter_refills_gradually(self):
+        """Test that a full bucket does not let a second burst through right after the first"""
+        limiter = RateLimiter('test:bucket', rate=1, burst=2)
+        with mock.patch('workorders.geocoding.time.time', return_value=1001.9):
+            self.assertEqual(limiter.take(), 0)
+            self.assertEqual(limiter.take(), 0)
+        with mock.patch('workorders.geocoding.time.time', return_value=1002.0):
+            self.assertEqual(limiter.take(), 0)
+            self.assertAlmostEqual(limiter.take(), 1.0)
+    
+    def test_search_reuses_the_session(self):
+        """Test that lookups go through the pooled session with query parameters"""
+        payload = [{'lat': '14.5', 'lon': '121.0', 'display_name': 'Makati'}]
+        with mock.patch.object(self.geocoder.session, 'get', return_value=self._response(payload=payload)) as get:
+            result = self.geocoder.search('Makati')
+        
+        self.assertEqual(result, {'latitude': 14.5, 'longitude': 121.0, 'display_name': 'Makati'})
+        self.assertEqual(get.call_args.kwargs['params']['q'], 'Makati')
+    
+    def test_no_token_means_retry_later(self):
+        """Test that a second lookup in the same second fails fast without a request"""
+        with mock.patch.object(self.geocoder.session, 'get', return_value=self._response(payload=[])) as get:
+            self.assertIsNone(self.geocoder.search('Nowhere'))
+            with self.assertRaises(GeocodingRateLimited) as raised:
+                self.geocoder.search('Elsewhere')
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(raised.exception.retry_after, 1)
+    
+    def test_throttled_response_pauses_every_worker(self):
+        """Test that a 429 from the service stops lookups for its Retry-After"""
+        throttled = self._response(status_code=429, headers={'Retry-After': '30'})
+        with mock.patch.object(self.geocoder.session, 'get', return_value=throttled):
+            with self.assertRaises(GeocodingRateLimited):
+                self.geocoder.search('Makati')
+        
+        other_worker = GeocodingClient(url='https://geocoder.invalid/search', rate=100, burst=100)
+        with mock.patch.object(other_worker.session, 'get') as get:
+            with self.assertRaises(GeocodingRateLimited) as raised:
+                other_worker.search('Taguig')
+        get.assert_not_called()
+        self.assertGreaterEqual(raised.exception.retry_after, 29)
+    
+    def test_async_search(self):
+        """Test that asearch() asks the service with the async client and caches the result"""
+        requests = []
+        
+        def handler(request):
+            requests.append(request)
+            return httpx.Response(200, json=[{'lat': '14.5', 'lon': '121.0', 'display_name': 'Makati'}])
+        
+        async def lookup():
+            transport_session = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            with mock.patch.object(self.geocoder, 'async_session', return_value=transport_session):
+                with mock.patch('workorders.geocoding.get_client', return_value=self.geocoder):
+                    result = await ageocode('Makati')
+                    again = await ageocode('Makati')
+            await transport_session.aclose()
+            return result, again
+        
+        recent_results.clear()
+        result, again = async_to_sync(lookup)()
+        self.assertEqual(result, {'latitude': 14.5, 'longitude': 121.0, 'display_name': 'Makati'})
+        self.assertEqual(again, result)
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(requests[0].url.params['q'], 'Makati')
+        self.assertTrue(GeocodeCache.objects.get(query='makati').found)
+    
+    def test_async_throttled_response_pauses_every_worker(self):
+        """Test that a 429 seen by the async client also stops the sync one"""
+        async def lookup():
+            transport_session = httpx.AsyncClient(
+                transport=httpx.MockTransport(lambda request: httpx.Response(429, headers={'Retry-After': '30'}))
+            )
+            with mock.patch.object(self.geocoder, 'async_session', return_value=transport_session):
+                with self.assertRaises(GeocodingRateLimited):
+                    await self.geocoder.asearch('Makati')
+            await transport_session.aclose()
+        
+        async_to_sync(lookup)()
+        other_worker = GeocodingClient(url='https://geocoder.invalid/search', rate=100, burst=100)
+        with self.assertRaises(GeocodingRateLimited):
+            other_worker.search('Taguig')
+    
+    def test_view_returns_429_when_rate_limited(self):
+        """Test that the endpoint answers "retry later" at once"""
+        user = User.objects.create_user('tech', password='password')
+        self.client.force_login(user)
+        recent_results.clear()
+        with mock.patch.object(GeocodingClient, 'search', side_effect=GeocodingRateLimited(2)):
+            response = self.client.post('/geocode/', {'location_name': 'Makati'})
+        
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '2')
+        self.assertFalse(response.json()['success'])
+
+
+class GeocodeBackfillTestCase(TestCase):
+    """Test cases for geocoding the locations of existing work orders"""
+    
+    PLACE = {'latitude': 14.55, 'longitude': 121.02, 'display_name': 'Makati, Metro Manila'}
+    
+    def setUp(self):
+        cache.clear()
+        recent_results.clear()
+        self.addCleanup(recent_results.clear)
+        task_type = TaskType.objects.create(name="Onsite", points_base=10)
+        task_category = TaskCategory.objects.create(name="Field")
+        requester = User.objects.create_user(username="requester")
+        
+        def work_order(location_name, **kwargs):
+            return WorkOrder.objects.create(
+                title=f"At {location_name}", description="", task_type=task_type,
+                task_category=task_category, requester=requester, location_name=location_name, **kwargs
+            )
+        
+        self.makati = [work_order('Makati, Metro Manila') for _ in range(3)]
+        self.makati.append(work_order('makati  metro manila'))
+        self.nowhere = work_order('Nowhere')
+        self.located = work_order('Makati, Metro Manila', latitude=1.0, longitude=2.0)
+        work_order('')
+        
+        patcher = mock.patch.object(
+            GeocodingClient, 'search',
+            side_effect=lambda location: self.PLACE if 'makati' in location.lower() else None
+        )
+        self.search = patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def test_backfill_resolves_each_location_once(self):
+        """Test that distinct locations are looked up once and reruns do nothing"""
+        out = io.StringIO()
+        call_command('geocode_backfill', stdout=out)
+        
+        self.assertEqual(self.search.call_count, 2)
+        self.assertIn('Work orders updated: 4', out.getvalue())
+        for work_order in self.makati:
+            work_order.refresh_from_db()
+            self.assertEqual((work_order.latitude, work_order.longitude), (14.55, 121.02))
+            self.assertEqual(work_order.geohash, encode_geohash(14.55, 121.02))
+        self.nowhere.refresh_from_db()
+        self.assertIsNone(self.nowhere.latitude)
+        self.located.refresh_from_db()
+        self.assertEqual(self.located.latitude, 1.0)
+        
+        # "Nowhere" is cached as not found, so a rerun asks nobody
+        out = io.StringIO()
+        call_command('geocode_backfill', stdout=out)
+        self.assertEqual(self.search.call_count, 2)
+        self.assertIn('Not found: 1', out.getvalue())
+    
+    def test_backfilled_ticket_gets_a_new_etag(self):
+        """Test that a ticket page cached before the backfill is not confirmed after it"""
+        self.client.force_login(User.objects.create_user('tech', password='password', is_staff=True))
+        url = f'/work-orders/{self.makati[0].pk}/'
+        # The first visit sets the CSRF cookie that later pages are keyed by
+        self.client.get(url)
+        before = self.client.get(url)
+        
+        versions = get_versions('workorder', 'assignment')
+        with self.captureOnCommitCallbacks(execute=True):
+            GeocodeBackfill().run()
+        # bulk_update sends no signal, so the backfill bumps the versions itself
+        self.assertNotEqual(get_versions('workorder', 'assignment'), versions)
+        
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=before['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], before['ETag'])
+    
+    def test_backfill_waits_out_the_rate_limit(self):
+        """Test that the backfill sleeps instead of skipping rate-limited lookups"""
+        self.search.side_effect = [GeocodingRateLimited(3), self.PLACE, None]
+        sleep = mock.Mock()
+        results = GeocodeBackfill(sleep=sleep).run()
+        
+        sleep.assert_called_once_with(3)
+        self.assertEqual(results['resolved'], 1)
+        self.assertEqual(results['updated'], 4)
+    
+    def test_geocoding_command(self):
+        """Test that test_geocoding prints the result of the shared client"""
+        out = io.StringIO()
+        call_command('test_geocoding', 'Makati', stdout=out)
+        self.assertIn('Latitude: 14.55', out.getvalue())
+
+
+class GazetteerTestCase(TestCase):
+    """Test cases for the local gazetteer geocoding backend"""
+    
+    HEAD_OFFICE = {'latitude': 14.5547, 'longitude': 121.0244, 'display_name': 'Makati Head Office, Ayala Avenue'}
+    
+    def setUp(self):
+        recent_results.clear()
+        self.addCleanup(recent_results.clear)
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.path = os.path.join(self.tempdir.name, 'sites.csv')
+        self.write_csv(
+            'name,latitude,longitude,display_name\n'
+            'Makati Head Office,14.5547,121.0244,"Makati Head Office, Ayala Avenue"\n'
+            'Building A,14.6,121.1,\n'
+            'Building B,14.7,121.2,\n'
+            'Broken row,north,east,\n'
+        )
+        settings = override_settings(GEOCODE_GAZETTEER_PATH=self.path)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        reset_backends()
+        self.addCleanup(reset_backends)
+        patcher = mock.patch.object(GeocodingClient, 'search', return_value=None)
+        self.remote = patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def write_csv(self, content):
+        with open(self.path, 'w') as f:
+            f.write(content)
+    
+    def test_known_places_are_found_without_the_network(self):
+        """Test that gazetteer places resolve with no remote call and no query"""
+        with self.assertNumQueries(0):
+            self.assertEqual(geocode('makati head office'), self.HEAD_OFFICE)
+            self.assertEqual(geocode('Building A')['display_name'], 'Building A')
+        self.remote.assert_not_called()
+        self.assertFalse(GeocodeCache.objects.exists())
+    
+    def test_prefix_and_similar_names(self):
+        """Test matches on details after a name, unique prefixes and typos"""
+        gazetteer = Gazetteer.from_csv(self.path)
+        self.assertEqual(len(gazetteer), 3)
+        self.assertEqual(gazetteer.search('Building B, 3rd floor, room 301')['latitude'], 14.7)
+        self.assertEqual(gazetteer.search('Makati Head'), self.HEAD_OFFICE)
+        self.assertEqual(gazetteer.search('Makatti Head Ofice'), self.HEAD_OFFICE)
+        self.assertIsNone(gazetteer.search('Building'))
+        self.assertIsNone(gazetteer.search('Building C'))
+    
+    def test_similar_name_beats_a_shorter_prefix(self):
+        """Test that a known name at the start of the query only wins when nothing is closer"""
+        makati = {'latitude': 14.55, 'longitude': 121.02, 'display_name': 'Makati'}
+        gazetteer = Gazetteer([('Makati', makati), ('Makati Head Office', self.HEAD_OFFICE)])
+        self.assertEqual(gazetteer.search('Makati Head Ofice'), self.HEAD_OFFICE)
+        self.assertEqual(gazetteer.search('Makati, Ayala Avenue'), makati)
+    
+    def test_unknown_places_go_to_the_remote_service(self):
+        """Test that the remote service is still asked for other places"""
+        self.remote.return_value = {'latitude': 10.3, 'longitude': 123.9, 'display_name': 'Cebu City'}
+        self.assertEqual(geocode('Cebu City')['display_name'], 'Cebu City')
+        self.remote.assert_called_once_with('Cebu City')
+        self.assertTrue(GeocodeCache.objects.filter(query='cebu city').exists())
+    
+    def test_changed_file_is_reloaded(self):
+        """Test that edits to the CSV file are picked up without a restart"""
+        backend = GazetteerBackend(self.path)
+        self.assertIsNone(backend.search('Taguig Annex'))
+        self.write_csv('name,latitude,longitude\nTaguig Annex,14.52,121.05\n')
+        os.utime(self.path, (0, 0))
+        self.assertEqual(backend.search('Taguig Annex')['longitude'], 121.05)
+    
+    def test_missing_file_knows_nothing(self):
+        """Test that a missing gazetteer does not break geocoding"""
+        backend = GazetteerBackend(os.path.join(self.tempdir.name, 'missing.csv'))
+        self.assertIsNone(backend.search('Building A'))
+
+
+class StartupImportTestCase(TestCase):
+    """Test cases for keeping slow imports out of manage.py startup"""
+    
+    def test_lazy_modules_are_not_imported_at_startup(self):
+        """Test that folium and other slow libraries load only when used"""
+        out = io.StringIO()
+        call_command('benchmark_startup', '--runs', '1', stdout=out)
+        self.assertIn('No lazily imported module was loaded at startup', out.getvalue())
+        
+        with self.assertRaisesMessage(CommandError, 'Imported at startup: django'):
+            call_command('benchmark_startup', '--runs', '1', '--lazy', 'django', stdout=io.StringIO())
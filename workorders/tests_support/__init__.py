@@ -0,0 +1,6 @@
+"""
+Helpers for the tests and benchmark commands.
+
+Nothing the application runs imports from here; only tests.py and the
+benchmark management commands do.
+"""
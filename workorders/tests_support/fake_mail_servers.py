@@ -0,0 +1,356 @@
+"""
+In-process stand-ins for IMAP, POP3 and SMTP servers.
+
+Each server listens on an ephemeral loopback port and serves every
+connection from its own thread, so tests and benchmarks can point an
+EmailAccount or Django's SMTP backend at it. Only the commands the
+email pipeline actually sends are implemented.
+"""
+import hashlib
+import random
+import re
+import socketserver
+import threading
+from collections import Counter
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+
+def generate_messages(count, seed=0, reply_ratio=0.2, html_ratio=0.3, attachment_ratio=0.1):
+    """
+    Build ``count`` raw support emails, oldest first.
+
+    Senders come from a pool about a tenth the size of the mailbox, some
+    bodies are HTML only, some carry an attachment, and some are replies
+    to an earlier message in the same mailbox. The same seed always
+    gives the same messages.
+    """
+    rng = random.Random(seed)
+    senders = [f'user{i}@example.com' for i in range(max(1, count // 10))]
+    start = datetime(2024, 1, 1, 8, 0, tzinfo=timezone.utc)
+    messages = []
+    threads = []
+
+    for i in range(count):
+        text = (
+            f'Request {i}: the {rng.choice(["printer", "laptop", "VPN", "monitor", "phone"])} '
+            f'in room {rng.randint(100, 999)} stopped working this morning.\n\n'
+            + 'Please have a look as soon as possible. ' * rng.randint(1, 20)
+        )
+        if rng.random() < html_ratio:
+            paragraphs = ''.join(f'<p>{line}</p>' for line in text.split('\n') if line)
+            body = MIMEText(
+                f'<html><head><style>p {{margin:0}}</style></head><body>{paragraphs}</body></html>',
+                'html'
+            )
+        else:
+            body = MIMEText(text)
+
+        if rng.random() < attachment_ratio:
+            message = MIMEMultipart()
+            message.attach(body)
+            attachment = MIMEApplication(rng.randbytes(rng.randint(1, 64) * 1024), Name='screenshot.png')
+            attachment['Content-Disposition'] = 'attachment; filename="screenshot.png"'
+            message.attach(attachment)
+        else:
+            message = body
+
+        message_id = f'<msg-{seed}-{i}@example.com>'
+        if threads and rng.random() < reply_ratio:
+            parent_id, parent_subject, sender = rng.choice(threads)
+            message['Subject'] = f'Re: {parent_subject}'
+            message['In-Reply-To'] = parent_id
+            message['References'] = parent_id
+        else:
+            sender = rng.choice(senders)
+            message['Subject'] = f'Issue {i}'
+            threads.append((message_id, message['Subject'], sender))
+        message['From'] = f'User {sender.split("@")[0]} <{sender}>'
+        message['To'] = 'support@example.com'
+        message['Message-ID'] = message_id
+        message['Date'] = format_datetime(start + timedelta(minutes=i))
+        messages.append(message.as_bytes())
+
+    return messages
+
+
+class FakeMessage:
+    """A message stored on a fake server"""
+
+    def __init__(self, data):
+        # Servers speak CRLF, whatever the generator used
+        self.data = re.sub(rb'\r?\n', b'\r\n', data)
+        self.seen = False
+        # POP3 unique id, which stays the same across sessions
+        self.uid = hashlib.sha1(self.data).hexdigest()
+
+
+class FakeMailServer:
+    """Base class running a threaded TCP server on 127.0.0.1"""
+
+    handler_class = None
+
+    def __init__(self, messages=(), username='support', password='secret'):
+        self.messages = [FakeMessage(data) for data in messages]
+        self.username = username
+        self.password = password
+        self.lock = threading.Lock()
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), self.handler_class)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.thread = None
+
+    @property
+    def host(self):
+        return self.server.server_address[0]
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class LineHandler(socketserver.StreamRequestHandler):
+    """Request handler for line based protocols"""
+
+    # Replies are written in several pieces; without this every round trip
+    # waits for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def send(self, *lines):
+        self.wfile.write(b''.join(
+            (line if isinstance(line, bytes) else line.encode()) + b'\r\n' for line in lines
+        ))
+
+    def read_line(self):
+        line = self.rfile.readline()
+        return line.rstrip(b'\r\n').decode('utf-8', errors='replace') if line else None
+
+
+class IMAPHandler(LineHandler):
+    FETCH_RE = re.compile(r'BODY(?P<peek>\.PEEK)?\[\](?:<0\.(?P<size>\d+)>)?', re.IGNORECASE)
+
+    def handle(self):
+        self.send('* OK [CAPABILITY IMAP4rev1] Fake IMAP server ready')
+        authenticated = False
+        while True:
+            line = self.read_line()
+            if line is None:
+                return
+            tag, _, rest = line.partition(' ')
+            command, _, args = rest.partition(' ')
+            command = command.upper()
+
+            if command == 'CAPABILITY':
+                self.send('* CAPABILITY IMAP4rev1', f'{tag} OK CAPABILITY completed')
+            elif command == 'LOGIN':
+                username, _, password = args.partition(' ')
+                if (username.strip('"'), password.strip('"')) == (self.fake.username, self.fake.password):
+                    authenticated = True
+                    self.send(f'{tag} OK LOGIN completed')
+                else:
+                    self.send(f'{tag} NO [AUTHENTICATIONFAILED] Invalid credentials')
+            elif command == 'LOGOUT':
+                self.send('* BYE Logging out', f'{tag} OK LOGOUT completed')
+                return
+            elif not authenticated:
+                self.send(f'{tag} BAD Not authenticated')
+            elif command in ('SELECT', 'EXAMINE'):
+                mode = 'READ-ONLY' if command == 'EXAMINE' else 'READ-WRITE'
+                self.send(f'* {len(self.fake.messages)} EXISTS', f'{tag} OK [{mode}] {command} completed')
+            elif command == 'SEARCH':
+                criteria = args.upper().split()
+                with self.fake.lock:
+                    numbers = [
+                        str(number) for number, message in enumerate(self.fake.messages, 1)
+                        if 'UNSEEN' not in criteria or not message.seen
+                    ]
+                self.send(f'* SEARCH {" ".join(numbers)}'.rstrip(), f'{tag} OK SEARCH completed')
+            elif command == 'FETCH':
+                self.fetch(tag, args)
+            elif command in ('CLOSE', 'NOOP'):
+                self.send(f'{tag} OK {command} completed')
+            else:
+                self.send(f'{tag} BAD Unknown command')
+
+    def fetch(self, tag, args):
+        message_set, _, items = args.partition(' ')
+        match = self.FETCH_RE.search(items)
+        if not match:
+            self.send(f'{tag} BAD Only BODY[] can be fetched')
+            return
+        size = int(match.group('size')) if match.group('size') else None
+        item = 'BODY[]<0>' if size is not None else 'BODY[]'
+
+        for number in message_set.split(','):
+            with self.fake.lock:
+                message = self.fake.messages[int(number) - 1]
+                if not match.group('peek'):
+                    message.seen = True
+            data = message.data[:size] if size is not None else message.data
+            self.wfile.write(f'* {number} FETCH ({item} {{{len(data)}}}\r\n'.encode() + data + b')\r\n')
+        self.send(f'{tag} OK FETCH completed')
+
+
+class FakeIMAPServer(FakeMailServer):
+    """IMAP4rev1 server with a single INBOX; fetching BODY[] marks messages as seen"""
+
+    handler_class = IMAPHandler
+
+
+class POP3Handler(LineHandler):
+
+    def handle(self):
+        self.send('+OK Fake POP3 server ready')
+        username = None
+        authenticated = False
+        while True:
+            line = self.read_line()
+            if line is None:
+                return
+            command, _, args = line.partition(' ')
+            command = command.upper()
+            with self.fake.lock:
+                self.fake.commands[command] += 1
+
+            if command == 'USER':
+                username = args
+                self.send('+OK')
+            elif command == 'PASS':
+                authenticated = (username, args) == (self.fake.username, self.fake.password)
+                self.send('+OK Logged in' if authenticated else '-ERR Invalid credentials')
+            elif command == 'QUIT':
+                self.send('+OK Bye')
+                return
+            elif not authenticated:
+                self.send('-ERR Not authenticated')
+            elif command == 'STAT':
+                total = sum(len(message.data) for message in self.fake.messages)
+                self.send(f'+OK {len(self.fake.messages)} {total}')
+            elif command == 'LIST':
+                self.send(
+                    f'+OK {len(self.fake.messages)} messages',
+                    *(f'{number} {len(message.data)}' for number, message in enumerate(self.fake.messages, 1)),
+                    '.'
+                )
+            elif command == 'UIDL':
+                self.send(
+                    f'+OK {len(self.fake.messages)} messages',
+                    *(f'{number} {message.uid}' for number, message in enumerate(self.fake.messages, 1)),
+                    '.'
+                )
+            elif command in ('RETR', 'TOP'):
+                number, _, lines = args.partition(' ')
+                message = self.fake.messages[int(number) - 1]
+                data = message.data
+                if command == 'TOP':
+                    headers, _, body = data.partition(b'\r\n\r\n')
+                    data = headers + b'\r\n\r\n' + b'\r\n'.join(body.split(b'\r\n')[:int(lines)])
+                self.send(
+                    f'+OK {len(data)} octets',
+                    # Dot-stuffing per RFC 1939
+                    *(b'.' + line if line.startswith(b'.') else line for line in data.split(b'\r\n')),
+                    '.'
+                )
+            elif command == 'NOOP':
+                self.send('+OK')
+            else:
+                self.send('-ERR Unknown command')
+
+
+class FakePOP3Server(FakeMailServer):
+    """POP3 server; messages are never deleted. ``commands`` counts the commands received."""
+
+    handler_class = POP3Handler
+
+    def __init__(self, messages=(), username='support', password='secret'):
+        super().__init__(messages, username, password)
+        self.commands = Counter()
+
+
+class SMTPHandler(LineHandler):
+
+    def handle(self):
+        with self.fake.lock:
+            self.fake.sessions += 1
+        self.send('220 localhost Fake SMTP server ready')
+        envelope = None
+        while True:
+            line = self.read_line()
+            if line is None:
+                return
+            command = line[:4].upper()
+
+            if command == 'EHLO':
+                self.send('250-localhost', '250 8BITMIME')
+            elif command == 'HELO':
+                self.send('250 localhost')
+            elif command == 'MAIL':
+                envelope = {'from': line[10:].strip(' <>'), 'to': []}
+                self.send('250 OK')
+            elif command == 'RCPT':
+                recipient = line[8:].strip(' <>')
+                if recipient in self.fake.rejected_recipients:
+                    self.send('550 No such user')
+                else:
+                    envelope['to'].append(recipient)
+                    self.send('250 OK')
+            elif command == 'DATA':
+                self.send('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                while True:
+                    data = self.rfile.readline()
+                    if not data or data == b'.\r\n':
+                        break
+                    lines.append(data[1:] if data.startswith(b'..') else data)
+                envelope['data'] = b''.join(lines)
+                with self.fake.lock:
+                    self.fake.received.append(envelope)
+                envelope = None
+                self.send('250 OK')
+            elif command in ('RSET', 'NOOP'):
+                envelope = None
+                self.send('250 OK')
+            elif command == 'QUIT':
+                self.send('221 Bye')
+                return
+            else:
+                self.send('502 Command not implemented')
+
+
+class FakeSMTPServer(FakeMailServer):
+    """
+    SMTP server that keeps every message it accepts in ``received`` as
+    {'from', 'to', 'data'} dicts, and refuses ``rejected_recipients``.
+    ``sessions`` counts the connections made to it.
+    """
+
+    handler_class = SMTPHandler
+
+    def __init__(self, rejected_recipients=()):
+        super().__init__()
+        self.received = []
+        self.rejected_recipients = set(rejected_recipients)
+        self.sessions = 0
@@ -5,6 +5,7 @@ urlpatterns = [
     path('', views.dashboard, name='dashboard'),
     path('work-orders/', views.work_order_list, name='work_order_list'),
     path('work-orders/create/', views.work_order_create, name='work_order_create'),
+    path('work-orders/nearby/', views.nearby_work_orders, name='nearby_work_orders'),
     path('work-orders/<int:pk>/', views.work_order_detail, name='work_order_detail'),
     path('work-orders/<int:pk>/edit/', views.work_order_edit, name='work_order_edit'),
     path('profile/', views.user_profile, name='user_profile'),
@@ -2,21 +2,36 @@ from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib import messages
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
 from django.http import JsonResponse
-from django.db.models import Count, Q, Avg
+from django.db.models import Count, Q, Avg, Max
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from django.utils import timezone
 from datetime import datetime, timedelta
-import folium
+import hashlib
 import json
+from asgiref.sync import sync_to_async
 from .models import (
     WorkOrder, WorkOrderComment, TaskType, TaskCategory, 
     UserProfile, KPIReport
 )
 from .forms import WorkOrderForm, WorkOrderCommentForm, WorkOrderStatusForm
+from .caching import cached, get_versions, get_view_cache_ttl
+from .reference import get_reference_data
+from .geocoding import GeocodingError, GeocodingRateLimited, ageocode, geocode
+from .spatial import nearby
 
 
 def dashboard(request):
     """Main dashboard view"""
+    context = cached('dashboard', ['workorder', 'userprofile', 'taskclassification'], dashboard_data)
+    return render(request, 'workorders/dashboard.html', context)
+
+
+def dashboard_data():
+    """Everything the dashboard shows, evaluated so it can be cached"""
     # Get statistics
     total_tickets = WorkOrder.objects.count()
     open_tickets = WorkOrder.objects.filter(status='open').count()
@@ -24,20 +39,22 @@ def dashboard(request):
     resolved_tickets = WorkOrder.objects.filter(status='resolved').count()
     
     # Recent tickets
-    recent_tickets = WorkOrder.objects.all()[:10]
+    recent_tickets = list(WorkOrder.objects.all()[:10])
     
     # Ticket stats by category
-    category_stats = TaskCategory.objects.annotate(
+    category_stats = list(TaskCategory.objects.annotate(
         ticket_count=Count('workorder')
-    ).values('name', 'ticket_count', 'color')
+    ).values('name', 'ticket_count', 'color'))
     
     # Top performers
-    top_performers = UserProfile.objects.order_by('-total_points')[:5]
+    top_performers = list(UserProfile.objects.select_related('user').order_by('-total_points')[:5])
     
-    # Create map with work order locations
+    # Create map with work order locations; folium is slow to import, so
+    # only the dashboard loads it
+    from .maps import create_work_order_map
     map_data = create_work_order_map()
     
-    context = {
+    return {
         'total_tickets': total_tickets,
         'open_tickets': open_tickets,
         'in_progress_tickets': in_progress_tickets,
@@ -47,12 +64,43 @@ def dashboard(request):
         'top_performers': top_performers,
         'map_html': map_data,
     }
-    return render(request, 'workorders/dashboard.html', context)
 
 
-@login_required
-def work_order_list(request):
-    """List all work orders"""
+def conditional_etag(request, *parts):
+    """
+    ETag of a page built from ``parts`` for the user asking, or None when
+    the page must be rendered anyway because it has messages to show.
+    """
+    if len(messages.get_messages(request)):
+        return None
+    # The page embeds the user's name and CSRF token as well
+    csrf_cookie = request.COOKIES.get(settings.CSRF_COOKIE_NAME, '')
+    key = repr((request.user.pk, csrf_cookie, *parts)).encode()
+    return f'"{hashlib.md5(key, usedforsecurity=False).hexdigest()}"'
+
+
+def page_validators(request, compute):
+    """(ETag, Last-Modified) of a request, computed once for both condition() callbacks"""
+    if not hasattr(request, '_page_validators'):
+        request._page_validators = compute()
+    return request._page_validators
+
+
+def work_order_list_validators(request):
+    def compute():
+        latest = filtered_work_orders(request).aggregate(
+            last_modified=Max('updated_at'), count=Count('id')
+        )
+        etag = conditional_etag(
+            request, request.GET.urlencode(), latest['count'], latest['last_modified'],
+            get_versions('assignment', 'taskclassification', 'staff')
+        )
+        return etag, latest['last_modified']
+    return page_validators(request, compute)
+
+
+def filtered_work_orders(request):
+    """The work orders matching the list page's filters"""
     work_orders = WorkOrder.objects.all()
     
     # Filter by status
@@ -78,21 +126,61 @@ def work_order_list(request):
             Q(description__icontains=search) |
             Q(ticket_number__icontains=search)
         )
+    return work_orders
+
+
+@login_required
+@cache_control(private=True, no_cache=True)
+@condition(
+    etag_func=lambda request: work_order_list_validators(request)[0],
+    last_modified_func=lambda request: work_order_list_validators(request)[1]
+)
+def work_order_list(request):
+    """List all work orders"""
+    work_orders = filtered_work_orders(request)
     
     # Get filter options
-    task_types = TaskType.objects.all()
-    staff_users = User.objects.filter(is_staff=True)
+    reference = get_reference_data()
+    task_types = reference.task_types.values()
+    staff_users = reference.staff_users
     
     context = {
         'work_orders': work_orders,
         'task_types': task_types,
         'staff_users': staff_users,
         'status_choices': WorkOrder.STATUS_CHOICES,
+        # Rows are cached per ticket and updated_at, and dropped when
+        # assignments or task types and categories change
+        'row_cache_ttl': get_view_cache_ttl(),
+        'row_version': get_versions('assignment', 'taskclassification'),
     }
     return render(request, 'workorders/work_order_list.html', context)
 
 
+def work_order_detail_validators(request, pk):
+    def compute():
+        # The page changes with the ticket and when comments are added or deleted
+        row = WorkOrder.objects.filter(pk=pk).annotate(
+            last_comment=Max('comments__created_at'), comment_count=Count('comments')
+        ).values_list('updated_at', 'last_comment', 'comment_count').first()
+        if row is None:
+            return None, None
+        updated_at, last_comment, comment_count = row
+        last_modified = max(updated_at, last_comment) if last_comment else updated_at
+        etag = conditional_etag(
+            request, pk, updated_at, last_comment, comment_count,
+            get_versions('assignment', 'taskclassification')
+        )
+        return etag, last_modified
+    return page_validators(request, compute)
+
+
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(
+    etag_func=lambda request, pk: work_order_detail_validators(request, pk)[0],
+    last_modified_func=lambda request, pk: work_order_detail_validators(request, pk)[1]
+)
 def work_order_detail(request, pk):
     """Work order detail view"""
     work_order = get_object_or_404(WorkOrder, pk=pk)
@@ -129,19 +217,15 @@ def work_order_detail(request, pk):
     else:
         status_form = WorkOrderStatusForm(instance=work_order)
     
-    # Create location map if coordinates exist
+    # The map itself is drawn by Leaflet in the browser from these values
     location_map = None
     if work_order.latitude and work_order.longitude:
-        m = folium.Map(
-            location=[work_order.latitude, work_order.longitude],
-            zoom_start=15
-        )
-        folium.Marker(
-            [work_order.latitude, work_order.longitude],
-            popup=f"{work_order.ticket_number}: {work_order.title}",
-            tooltip=work_order.location_name
-        ).add_to(m)
-        location_map = m._repr_html_()
+        location_map = {
+            'latitude': work_order.latitude,
+            'longitude': work_order.longitude,
+            'popup': f"{work_order.ticket_number}: {work_order.title}",
+            'tooltip': work_order.location_name,
+        }
     
     context = {
         'work_order': work_order,
@@ -227,7 +311,10 @@ def user_profile(request, user_id=None):
 @login_required
 def leaderboard(request):
     """Leaderboard view"""
-    profiles = UserProfile.objects.select_related('user').order_by('-total_points')[:20]
+    profiles = cached(
+        'leaderboard', ['userprofile'],
+        lambda: list(UserProfile.objects.select_related('user').order_by('-total_points')[:20])
+    )
     
     context = {
         'profiles': profiles,
@@ -247,6 +334,15 @@ def kpi_report(request):
     if request.GET.get('end_date'):
         end_date = datetime.strptime(request.GET.get('end_date'), '%Y-%m-%d').date()
     
+    context = cached(
+        'kpi_report', ['workorder', 'userprofile'],
+        lambda: kpi_data(start_date, end_date), start_date, end_date
+    )
+    return render(request, 'workorders/kpi_report.html', context)
+
+
+def kpi_data(start_date, end_date):
+    """The KPIs of work orders created between two dates"""
     # Calculate KPIs
     work_orders = WorkOrder.objects.filter(
         created_at__date__range=[start_date, end_date]
@@ -300,7 +396,7 @@ def kpi_report(request):
         ]
     }
     
-    context = {
+    return {
         'start_date': start_date,
         'end_date': end_date,
         'total_tickets': total_tickets,
@@ -311,53 +407,57 @@ def kpi_report(request):
         'status_data': json.dumps(status_data),
         'priority_data': json.dumps(priority_data),
     }
-    return render(request, 'workorders/kpi_report.html', context)
 
 
-def create_work_order_map():
-    """Create a map with all work order locations"""
-    # Get work orders with location data
-    work_orders = WorkOrder.objects.filter(
-        latitude__isnull=False,
-        longitude__isnull=False
+@login_required
+def nearby_work_orders(request):
+    """
+    Work orders within ``radius`` km (default 5) of ``lat``/``lng``,
+    closest first. Only unresolved ones unless ``status`` is given.
+    """
+    try:
+        latitude = float(request.GET['lat'])
+        longitude = float(request.GET['lng'])
+        radius = float(request.GET.get('radius', 5))
+        limit = int(request.GET.get('limit', 50))
+    except (KeyError, ValueError):
+        return JsonResponse({'success': False, 'error': 'Please provide numeric lat, lng and radius'}, status=400)
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180) or not 0 < radius <= 500 or limit < 1:
+        return JsonResponse({'success': False, 'error': 'Coordinates or radius out of range'}, status=400)
+    
+    statuses = request.GET.getlist('status') or ['open', 'in_progress', 'waiting']
+    work_orders = WorkOrder.objects.filter(status__in=statuses).only(
+        'ticket_number', 'title', 'status', 'priority', 'location_name', 'latitude', 'longitude'
     )
+    results = nearby(work_orders, latitude, longitude, radius)
     
-    if not work_orders.exists():
-        return None
-    
-    # Calculate center point
-    center_lat = sum(wo.latitude for wo in work_orders) / len(work_orders)
-    center_lng = sum(wo.longitude for wo in work_orders) / len(work_orders)
-    
-    # Create map
-    m = folium.Map(location=[center_lat, center_lng], zoom_start=10)
-    
-    # Add markers for each work order
-    for wo in work_orders:
-        color = {
-            'open': 'red',
-            'in_progress': 'orange',
-            'waiting': 'yellow',
-            'resolved': 'green',
-            'closed': 'blue'
-        }.get(wo.status, 'gray')
-        
-        folium.Marker(
-            [wo.latitude, wo.longitude],
-            popup=f"""<b>{wo.ticket_number}</b><br>
-                     {wo.title}<br>
-                     Status: {wo.get_status_display()}<br>
-                     Priority: {wo.get_priority_display()}""",
-            tooltip=wo.location_name,
-            icon=folium.Icon(color=color)
-        ).add_to(m)
-    
-    return m._repr_html_()
+    return JsonResponse({
+        'success': True,
+        'count': len(results),
+        'work_orders': [{
+            'id': work_order.pk,
+            'ticket_number': work_order.ticket_number,
+            'title': work_order.title,
+            'status': work_order.status,
+            'priority': work_order.priority,
+            'location_name': work_order.location_name,
+            'latitude': work_order.latitude,
+            'longitude': work_order.longitude,
+            'distance_km': round(work_order.distance_km, 3),
+        } for work_order in results[:limit]],
+    })
 
 
 @login_required
-def geocode_location(request):
-    """Geocode location using a free service"""
+async def geocode_location(request):
+    """
+    Geocode location using a free service.
+
+    Async, so under ASGI a slow geocoding service keeps only this request
+    waiting instead of a worker. Under WSGI each request gets an event
+    loop of its own, which would need an HTTP client of its own too, so
+    the lookup goes through the pooled sync client instead.
+    """
     if request.method != 'POST':
         return JsonResponse({'success': False, 'error': 'Only POST requests are allowed'})
     
@@ -366,75 +466,30 @@ def geocode_location(request):
         return JsonResponse({'success': False, 'error': 'Please provide a location name'})
     
     try:
-        import requests
-        from urllib.parse import quote_plus
-        
-        # URL encode the location name to handle special characters
-        encoded_location = quote_plus(location_name.strip())
-        
-        # Using OpenStreetMap Nominatim API (free)
-        url = f"https://nominatim.openstreetmap.org/search?format=json&q={encoded_location}&limit=1&addressdetails=1"
-        
-        # Make the request with proper headers and timeout
-        response = requests.get(
-            url, 
-            headers={
-                'User-Agent': 'IT-Support-System/1.0 (Django Application)',
-                'Accept': 'application/json'
-            },
-            timeout=10  # 10 second timeout
-        )
-        
-        # Check if the request was successful
-        if response.status_code != 200:
-            return JsonResponse({
-                'success': False,
-                'error': f'Geocoding service returned status {response.status_code}'
-            })
-        
-        # Parse the JSON response
-        data = response.json()
-        
-        if data and len(data) > 0:
-            location = data[0]
-            return JsonResponse({
-                'success': True,
-                'latitude': float(location['lat']),
-                'longitude': float(location['lon']),
-                'display_name': location.get('display_name', location_name),
-                'raw_data': location  # For debugging
-            })
+        if isinstance(request, ASGIRequest):
+            result = await ageocode(location_name)
         else:
-            return JsonResponse({
-                'success': False,
-                'error': f'No results found for "{location_name}". Try being more specific or use a different search term.'
-            })
-            
-    except requests.exceptions.Timeout:
-        return JsonResponse({
-            'success': False,
-            'error': 'Request timed out. Please try again.'
-        })
-    except requests.exceptions.ConnectionError:
-        return JsonResponse({
-            'success': False,
-            'error': 'Could not connect to geocoding service. Please check your internet connection.'
-        })
-    except requests.exceptions.RequestException as e:
-        return JsonResponse({
-            'success': False,
-            'error': f'Network error: {str(e)}'
-        })
-    except ValueError as e:
+            result = await sync_to_async(geocode)(location_name)
+    except GeocodingRateLimited as e:
+        # Tell the browser when to come back rather than holding the worker
+        response = JsonResponse({'success': False, 'error': str(e), 'retry_after': e.retry_after}, status=429)
+        response['Retry-After'] = str(e.retry_after)
+        return response
+    except GeocodingError as e:
+        return JsonResponse({'success': False, 'error': str(e)})
+    except Exception as e:
         return JsonResponse({
             'success': False,
-            'error': f'Invalid response from geocoding service: {str(e)}'
+            'error': f'Unexpected error: {str(e)}'
         })
-    except Exception as e:
+    
+    if result is None:
         return JsonResponse({
             'success': False,
-            'error': f'Unexpected error: {str(e)}'
+            'error': f'No results found for "{location_name}". Try being more specific or use a different search term.'
         })
+    
+    return JsonResponse({'success': True, **result})
 
 
 @login_required